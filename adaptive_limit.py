@@ -0,0 +1,257 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+import asyncio
+import math
+import time
+import httpx
+from circuit_breaker import RejectedError, is_upstream_failure
+from deadline import is_deadline_timeout
+from metrics import registry
+
+T = TypeVar("T")
+
+
+# 所有已创建的并发限制器,用于统计接口
+limiters: Dict[str, "AdaptiveLimiter"] = {}
+
+
+class ConcurrencyLimitedError(RejectedError):
+    """等待并发名额超时,调用被本地拒绝"""
+
+    def __init__(self, upstream: str, limit: int):
+        super().__init__(f"{upstream} 并发已达上限({limit}),排队超时")
+        self.upstream = upstream
+        self.limit = limit
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发限制(按轮次的梯度调整),在所有请求间共享
+
+    每轮(至少 ROUND_SAMPLES 个且不少于当前上限个调用)结束时根据整轮的统计调整一次:
+    - 本轮出现超时、429 或 5xx 时并发上限乘以 backoff
+    - 并发上限被用到一半以上且本轮延迟中位数连续 SUSTAINED_ROUNDS 轮超过基线的 tolerance 倍时乘以 backoff
+    - 否则并发名额曾用满时并发上限加1
+    - 超出上限的调用按先后顺序排队
+
+    基线延迟取最近各轮延迟中位数的低分位数,近似上游空载时的中位延迟;
+    单个慢请求或负载很低时的尾延迟不会降低上限。
+    """
+
+    # 每轮的最少样本数
+    ROUND_SAMPLES = 10
+    # 用于计算基线的轮数和分位数
+    BASELINE_ROUNDS = 50
+    BASELINE_QUANTILE = 0.1
+    # 计算基线前至少需要的轮数
+    MIN_BASELINE_ROUNDS = 3
+    # 延迟连续超标多少轮才缩小上限
+    SUSTAINED_ROUNDS = 3
+
+    def __init__(
+        self,
+        name: str,
+        enabled: bool = True,
+        initial_limit: int = 10,
+        min_limit: int = 2,
+        max_limit: int = 50,
+        tolerance: float = 2.0,
+        backoff: float = 0.9
+    ):
+        """
+        Args:
+            name: 上游名称
+            enabled: 是否启用,关闭时不限制并发
+            initial_limit: 初始并发上限
+            min_limit: 最小并发上限
+            max_limit: 最大并发上限
+            tolerance: 一轮的延迟中位数超过基线的倍数时视为过载
+            backoff: 过载时并发上限的缩小比例
+        """
+        self.name = name
+        self.enabled = enabled
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._medians: Deque[float] = deque(maxlen=self.BASELINE_ROUNDS)
+        self._baseline: Optional[float] = None
+        # 当前轮的统计
+        self._round: List[float] = []
+        self._round_errors = 0
+        self._round_saturated = False
+        self._round_peak = 0
+        self._slow_rounds = 0
+        self.decreases = 0
+        self.rejected = 0
+        limiters[name] = self
+
+    @property
+    def current_limit(self) -> int:
+        """当前的并发上限(整数)"""
+        return max(1, int(self.limit))
+
+    async def acquire(self, timeout: Optional[float] = None):
+        """
+        获取一个并发名额
+
+        Args:
+            timeout: 最长排队时间(秒),为None时一直等待
+
+        Raises:
+            ConcurrencyLimitedError: 排队超时
+        """
+        if not self._waiters and self.in_flight < self.current_limit:
+            self.in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            if timeout is None:
+                await waiter
+            else:
+                await asyncio.wait_for(waiter, timeout=max(0.0, timeout))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # 名额已分配但调用方放弃,归还名额
+                self._release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise ConcurrencyLimitedError(self.name, self.current_limit) from None
+            raise
+
+    def _release(self):
+        """归还名额并唤醒排队的调用"""
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.current_limit:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _on_sample(self, latency: float, overloaded: bool, saturated: bool, in_flight: int):
+        """记录一次调用的结果,一轮结束时调整并发上限"""
+        if overloaded:
+            self._round_errors += 1
+        else:
+            self._round.append(latency)
+        self._round_saturated |= saturated
+        self._round_peak = max(self._round_peak, in_flight)
+        if len(self._round) + self._round_errors >= max(self.ROUND_SAMPLES, self.current_limit):
+            self._end_round()
+
+    def _end_round(self):
+        """按一轮的统计调整并发上限"""
+        latencies = sorted(self._round)
+        median = latencies[len(latencies) // 2] if latencies else None
+        slow = (
+            median is not None
+            and self._baseline is not None
+            and median > self._baseline * self.tolerance
+            # 并发远低于上限时延迟升高与本服务的并发无关,缩小上限也无济于事
+            and self._round_peak * 2 >= self.current_limit
+        )
+        self._slow_rounds = self._slow_rounds + 1 if slow else 0
+
+        if self._round_errors > 0 or self._slow_rounds >= self.SUSTAINED_ROUNDS:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            self.decreases += 1
+            self._slow_rounds = 0
+        elif not slow and self._round_saturated:
+            self.limit = min(self.max_limit, self.limit + 1.0)
+            self._wake()
+
+        # 过载的轮次不计入基线
+        if median is not None and not slow and self._round_errors == 0:
+            self._medians.append(median)
+            if len(self._medians) >= self.MIN_BASELINE_ROUNDS:
+                ordered = sorted(self._medians)
+                self._baseline = ordered[max(0, math.ceil(self.BASELINE_QUANTILE * len(ordered)) - 1)]
+
+        self._round = []
+        self._round_errors = 0
+        self._round_saturated = False
+        self._round_peak = 0
+
+    async def run(self, factory: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        """
+        在并发限制下执行调用,并根据延迟和结果调整上限
+
+        Args:
+            factory: 创建实际调用的函数
+            timeout: 最长排队时间(秒)
+
+        Returns:
+            T: 调用结果
+        """
+        if not self.enabled:
+            return await factory()
+
+        await self.acquire(timeout)
+        in_flight = self.in_flight
+        saturated = in_flight >= self.current_limit
+        start_time = time.perf_counter()
+        try:
+            result = await factory()
+        except Exception as e:
+            # 请求自身的延迟预算用完不代表上游过载
+            if not is_deadline_timeout(e):
+                self._on_sample(time.perf_counter() - start_time, is_upstream_failure(e), saturated, in_flight)
+            raise
+        finally:
+            self._release()
+
+        overloaded = isinstance(result, httpx.Response) and (
+            result.status_code == 429 or result.status_code >= 500
+        )
+        self._on_sample(time.perf_counter() - start_time, overloaded, saturated, in_flight)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回并发限制统计信息"""
+        return {
+            "enabled": self.enabled,
+            "limit": self.current_limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "baseline_latency_ms": round(self._baseline * 1000, 1) if self._baseline is not None else None,
+            "decreases": self.decreases,
+            "rejected": self.rejected
+        }
+
+
+registry.callback(
+    "concurrency_limit",
+    "Current adaptive concurrency limit",
+    ["upstream"],
+    lambda: {(name,): limiter.current_limit for name, limiter in limiters.items() if limiter.enabled}
+)
+registry.callback(
+    "concurrency_in_flight",
+    "Calls holding a concurrency slot",
+    ["upstream"],
+    lambda: {(name,): limiter.in_flight for name, limiter in limiters.items() if limiter.enabled}
+)
+registry.callback(
+    "concurrency_queued",
+    "Calls waiting for a concurrency slot",
+    ["upstream"],
+    lambda: {(name,): len(limiter._waiters) for name, limiter in limiters.items() if limiter.enabled}
+)
+registry.callback(
+    "concurrency_rejected_total",
+    "Calls rejected after waiting too long for a concurrency slot",
+    ["upstream"],
+    lambda: {(name,): limiter.rejected for name, limiter in limiters.items() if limiter.enabled},
+    type="counter"
+)
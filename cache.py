@@ -0,0 +1,161 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+from collections import OrderedDict
+import hashlib
+import time
+import unicodedata
+from metrics import registry
+
+
+# 句末标点(NFKC之后),不影响问题的含义
+_TRAILING_PUNCTUATION = "?!.。;~…,、"
+
+
+def normalize_text(text: str) -> str:
+    """
+    归一化文本,用于生成缓存键
+
+    - 全角/半角统一(NFKC)
+    - 忽略大小写
+    - 合并连续空白
+    - 去除句末标点
+
+    词中的符号保留(如 "C#"、"C++" 与 "C" 含义不同)。
+
+    Args:
+        text: 原始文本
+
+    Returns:
+        str: 归一化后的文本
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = " ".join(text.split())
+    return text.rstrip(_TRAILING_PUNCTUATION + " ")
+
+
+def hash_text(text: str) -> str:
+    """计算文本的哈希值(允许孤立的代理字符)"""
+    return hashlib.sha1((text or "").encode("utf-8", "surrogatepass")).hexdigest()
+
+
+# 所有已创建的缓存,用于统计和管理接口
+caches: Dict[str, "TTLCache"] = {}
+
+
+class TTLCache:
+    """带过期时间的LRU缓存"""
+
+    def __init__(self, name: str, ttl: float, max_size: int):
+        """
+        Args:
+            name: 缓存名称
+            ttl: 过期时间(秒)
+            max_size: 最大条目数,超出时淘汰最久未使用的条目
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        caches[name] = self
+
+    def get(self, key: Hashable, accept: Optional[Callable[[Any], bool]] = None) -> Optional[Any]:
+        """
+        读取缓存,未命中或已过期时返回None
+
+        Args:
+            key: 缓存键
+            accept: 可选的校验函数,返回False时视为未命中
+        """
+        value = self.peek(key)
+        if value is None or (accept is not None and not accept(value)):
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """读取缓存但不计入命中统计、不调整LRU顺序"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return None
+        return value
+
+    def contains(self, key: Hashable) -> bool:
+        """判断键是否存在且未过期(不影响统计和LRU顺序)"""
+        return self.peek(key) is not None
+
+    def set(self, key: Hashable, value: Any):
+        """写入缓存"""
+        if self.max_size <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        """删除单个缓存条目"""
+        self._data.pop(key, None)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        删除所有键满足条件的条目
+
+        Args:
+            predicate: 判断键是否需要删除
+
+        Returns:
+            int: 删除的条目数
+        """
+        keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self) -> int:
+        """清空缓存,返回删除的条目数"""
+        count = len(self._data)
+        self._data.clear()
+        return count
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+def _cache_stat(field: str) -> Callable[[], Dict[tuple, float]]:
+    """缓存统计指标回调"""
+    return lambda: {(name,): getattr(cache, field) for name, cache in caches.items()}
+
+
+registry.callback("cache_hits_total", "Cache hits", ["cache"], _cache_stat("hits"), type="counter")
+registry.callback("cache_misses_total", "Cache misses", ["cache"], _cache_stat("misses"), type="counter")
+registry.callback("cache_evictions_total", "Cache evictions", ["cache"], _cache_stat("evictions"), type="counter")
+registry.callback(
+    "cache_entries",
+    "Current number of cache entries",
+    ["cache"],
+    lambda: {(name,): len(cache._data) for name, cache in caches.items()}
+)
@@ -0,0 +1,173 @@
+"""
+级联重排序评估工具 - 在回放的请求上对比全量Rerank与级联Rerank的召回和延迟
+
+对每个请求模板: 用原始问题检索所有知识库得到候选片段,先把全部候选发送给Reranker
+作为参考结果,再对每个级联系数只发送粗排(Dify分数+BM25)后的前M个候选,
+统计 recall@rerank_top_k(选出的片段中全量Rerank分数不低于参考第k名的比例)、发送的片段数和延迟。
+
+使用方法:
+    python cascade_eval.py --templates replay.jsonl --factors 2,3,4,6 --min 10 --output cascade.json
+
+上游地址和Key读取 .env 配置(与服务相同)。
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from load_test import load_templates, summarize
+from dify_client import dify_client
+from lexical_rerank import cascade_prefilter
+from models import RetrievalQuery
+from rerank_service import rerank_service
+
+
+async def evaluate_template(template: Dict[str, Any], factors: List[float], minimum: int) -> Optional[Dict[str, Any]]:
+    """
+    评估单个请求模板
+
+    Returns:
+        Optional[Dict[str, Any]]: 全量和各级联系数的结果,候选不足时返回None
+    """
+    question = template["question"]
+    queries = [
+        RetrievalQuery(dataset_id=dataset["dataset_id"], query=question)
+        for dataset in template["datasets"]
+    ]
+    segments = await dify_client.batch_retrieve(
+        queries,
+        api_key=template["dataset_api_key"],
+        top_k=template.get("top_k", 10),
+        score_threshold=template.get("score_threshold", 0.4),
+        semantic_weight=template.get("semantic_weight", 0.7)
+    )
+    top_k = template.get("rerank_top_k", 5)
+    if len(segments) <= top_k:
+        return None
+
+    query = rerank_service.build_query(question, template.get("document"))
+
+    # 与服务相同按token预算截断;不使用分数缓存,否则后续的级联轮次会命中全量轮次的缓存而无法比较延迟
+    start_time = time.perf_counter()
+    scores = await rerank_service.score_documents(query, [seg.content for seg in segments], use_cache=False)
+    full_latency = time.perf_counter() - start_time
+    # 按片段记录全量Rerank分数;与第k名同分的片段都算作命中,避免同分时的任意排序影响召回
+    full_scores = {id(segments[index]): score for index, score in scores.items()}
+    ranked = sorted(full_scores.values(), reverse=True)
+    kth_score = ranked[min(top_k, len(ranked)) - 1]
+
+    result = {"candidates": len(segments), "full": {"latency": full_latency, "sent": len(segments)}, "cascade": {}}
+    for factor in factors:
+        keep = max(minimum, math.ceil(factor * top_k))
+        start_time = time.perf_counter()
+        candidates = cascade_prefilter(query, segments, keep)
+        prefilter_latency = time.perf_counter() - start_time
+        scores = await rerank_service.score_documents(query, [seg.content for seg in candidates], top_k, use_cache=False)
+        latency = time.perf_counter() - start_time
+        hits = sum(1 for index in scores if full_scores.get(id(candidates[index]), float("-inf")) >= kth_score)
+        result["cascade"][factor] = {
+            "latency": latency,
+            "prefilter_latency": prefilter_latency,
+            "sent": len(candidates),
+            "recall": min(hits, top_k) / min(top_k, len(ranked))
+        }
+    return result
+
+
+def build_report(results: List[Dict[str, Any]], factors: List[float], minimum: int) -> Dict[str, Any]:
+    """汇总各级联系数的召回和延迟"""
+    full_latencies = [r["full"]["latency"] for r in results]
+    full_sent = sum(r["full"]["sent"] for r in results)
+    full_summary = summarize(full_latencies)
+    report = {
+        "config": {"factors": factors, "min": minimum},
+        "requests": len(results),
+        "full": {"sent": full_sent, "latency": full_summary},
+        "cascade": {}
+    }
+    for factor in factors:
+        rows = [r["cascade"][factor] for r in results]
+        latency = summarize([row["latency"] for row in rows])
+        sent = sum(row["sent"] for row in rows)
+        recalls = sorted(row["recall"] for row in rows)
+        report["cascade"][str(factor)] = {
+            "sent": sent,
+            "sent_ratio": round(sent / max(full_sent, 1), 3),
+            "recall_mean": round(sum(recalls) / len(recalls), 4),
+            "recall_min": round(recalls[0], 4),
+            "perfect_recall_ratio": round(sum(1 for r in recalls if r >= 1.0) / len(recalls), 4),
+            "prefilter": summarize([row["prefilter_latency"] for row in rows]),
+            "latency": latency,
+            "p50_saved_ms": round(full_summary["p50_ms"] - latency["p50_ms"], 2),
+            "p99_saved_ms": round(full_summary["p99_ms"] - latency["p99_ms"], 2)
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    """打印报告"""
+    print("\n" + "=" * 86)
+    print(f"📊 级联重排序评估: {report['requests']} 个请求 (RERANK_CASCADE_MIN={report['config']['min']})")
+    print("=" * 86)
+    full = report["full"]
+    header = f"{'':<12}{'发送片段':>10}{'占比':>8}{'recall':>9}{'最低':>8}{'全中':>8}{'粗排p50':>10}{'p50':>9}{'p99':>9}"
+    print(header)
+    print(f"{'全量':<12}{full['sent']:>10}{1.0:>8}{1.0:>9}{1.0:>8}{1.0:>8}{'-':>10}"
+          f"{full['latency']['p50_ms']:>9}{full['latency']['p99_ms']:>9}")
+    for factor, row in report["cascade"].items():
+        print(f"{'factor=' + factor:<12}{row['sent']:>10}{row['sent_ratio']:>8}{row['recall_mean']:>9}"
+              f"{row['recall_min']:>8}{row['perfect_recall_ratio']:>8}{row['prefilter']['p50_ms']:>10}"
+              f"{row['latency']['p50_ms']:>9}{row['latency']['p99_ms']:>9}")
+    print("(延迟单位: 毫秒;recall 为选出片段中达到全量Rerank第k名分数的比例,全中为 recall=1 的请求比例)")
+    print("=" * 86 + "\n")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="级联重排序召回/延迟评估工具")
+    parser.add_argument("--templates", default="examples.json", help="回放的请求模板文件(JSON或JSONL)")
+    parser.add_argument("--factors", default="2,3,4,6", help="要评估的级联系数(逗号分隔),M = max(min, factor*rerank_top_k)")
+    parser.add_argument("--min", type=int, default=10, help="每次至少发送给Reranker的候选数")
+    parser.add_argument("--output", default=None, help="结果JSON输出路径")
+    return parser.parse_args(argv)
+
+
+async def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    templates = load_templates(args.templates)
+    factors = [float(value) for value in args.factors.split(",") if value.strip()]
+    # 评估Reranker本身的延迟,不使用分数缓存
+    rerank_service.score_cache = None
+    print(f"🚀 评估开始: {len(templates)} 个请求模板, 级联系数 {factors}")
+
+    results = []
+    try:
+        for template in templates:
+            result = await evaluate_template(template, factors, args.min)
+            if result is not None:
+                results.append(result)
+    finally:
+        await dify_client.close()
+        await rerank_service.close()
+
+    if not results:
+        print("没有候选片段多于 rerank_top_k 的请求,无法评估")
+        return {}
+
+    report = build_report(results, factors, args.min)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit(130)
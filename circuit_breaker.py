@@ -0,0 +1,265 @@
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+import time
+import httpx
+from config import settings
+from metrics import registry
+from deadline import is_deadline_timeout
+
+T = TypeVar("T")
+
+
+# 所有已创建的熔断器,用于统计接口
+breakers: Dict[str, "CircuitBreaker"] = {}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class RejectedError(Exception):
+    """调用在本地被拒绝,未发往上游(不计入熔断)"""
+
+
+class CircuitOpenError(RejectedError):
+    """熔断器打开,调用被直接拒绝"""
+
+    def __init__(self, breaker: str, key: Hashable):
+        super().__init__(f"熔断器已打开: {breaker}[{key}]")
+        self.breaker = breaker
+        self.key = key
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    判断异常是否说明上游不可用(计入熔断)
+
+    连接错误、超时、429 和 5xx 计入;其余 HTTP 状态码说明上游正常响应,不计入。
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def is_connection_failure(error: BaseException) -> bool:
+    """判断异常是否说明无法连接上游(与具体请求内容无关)"""
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+class _KeyState:
+    """单个键的熔断状态"""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+        self.rejected = 0
+
+
+class CircuitBreaker:
+    """
+    按键(上游或知识库)熔断
+
+    - closed: 正常调用,连续失败 failure_threshold 次后打开
+    - open: 直接拒绝调用,recovery_timeout 秒后进入半开
+    - half_open: 只放行一个探测调用,成功则关闭,失败则重新打开
+    """
+
+    def __init__(
+        self,
+        name: str,
+        enabled: bool = True,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        metric_key: Callable[[Hashable], str] = str
+    ):
+        """
+        Args:
+            name: 熔断器名称
+            enabled: 是否启用,关闭时所有调用都放行
+            failure_threshold: 触发熔断的连续失败次数
+            recovery_timeout: 熔断后多久开始探测恢复(秒)
+            metric_key: 键在指标中的标签值(键来自请求时用于汇总,避免时间序列无限增长)
+        """
+        self.name = name
+        self.metric_key = metric_key
+        self.enabled = enabled
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._states: Dict[Hashable, _KeyState] = {}
+        breakers[name] = self
+
+    def _get_state(self, key: Hashable) -> _KeyState:
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState()
+        return state
+
+    def allow(self, key: Hashable) -> bool:
+        """判断是否放行调用(半开状态下放行的调用即为探测调用)"""
+        if not self.enabled:
+            return True
+
+        state = self._get_state(key)
+        now = time.monotonic()
+        if state.state == OPEN:
+            if now - state.opened_at < self.recovery_timeout:
+                state.rejected += 1
+                return False
+            state.state = HALF_OPEN
+            state.probe_started_at = None
+
+        if state.state == HALF_OPEN:
+            # 探测调用未结束(且未超时)时拒绝其余调用
+            if state.probe_started_at is not None and now - state.probe_started_at < self.recovery_timeout:
+                state.rejected += 1
+                return False
+            state.probe_started_at = now
+        return True
+
+    def record_success(self, key: Hashable):
+        """记录成功调用"""
+        state = self._get_state(key)
+        if state.state != CLOSED:
+            print(f"[熔断] {self.name}[{key}] 已恢复")
+        state.state = CLOSED
+        state.failures = 0
+        state.probe_started_at = None
+
+    def record_failure(self, key: Hashable):
+        """记录失败调用"""
+        state = self._get_state(key)
+        state.failures += 1
+        state.probe_started_at = None
+        if state.state == HALF_OPEN or (state.state == CLOSED and state.failures >= self.failure_threshold):
+            print(f"[熔断] {self.name}[{key}] 连续失败{state.failures}次,{self.recovery_timeout:g}秒内直接拒绝")
+            state.state = OPEN
+            state.opened_at = time.monotonic()
+
+    def _release(self, key: Hashable):
+        """调用被取消时释放探测名额"""
+        state = self._get_state(key)
+        if state.state == HALF_OPEN:
+            state.probe_started_at = None
+
+    @asynccontextmanager
+    async def guard(
+        self,
+        key: Hashable,
+        is_failure: Callable[[BaseException], bool] = is_upstream_failure
+    ) -> AsyncIterator[None]:
+        """
+        在熔断保护下执行代码块,根据是否抛出异常记录结果
+
+        Args:
+            key: 熔断键
+            is_failure: 判断异常是否计入失败
+
+        Raises:
+            CircuitOpenError: 熔断器打开时
+        """
+        if not self.allow(key):
+            raise CircuitOpenError(self.name, key)
+        try:
+            yield
+        except RejectedError:
+            # 内层熔断器或限流器拒绝,不代表本层的健康状况
+            self._release(key)
+            raise
+        except Exception as e:
+            if is_deadline_timeout(e):
+                # 请求自身的延迟预算用完,不代表上游不可用
+                self._release(key)
+            elif is_failure(e):
+                self.record_failure(key)
+            else:
+                self.record_success(key)
+            raise
+        except BaseException:
+            # 调用被取消
+            self._release(key)
+            raise
+        self.record_success(key)
+
+    async def call(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable[T]],
+        is_failure: Callable[[BaseException], bool] = is_upstream_failure
+    ) -> T:
+        """
+        在熔断保护下执行调用
+
+        Args:
+            key: 熔断键
+            factory: 创建实际调用的函数
+            is_failure: 判断异常是否计入失败
+
+        Returns:
+            T: 调用结果
+
+        Raises:
+            CircuitOpenError: 熔断器打开时
+        """
+        async with self.guard(key, is_failure):
+            return await factory()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回非关闭状态的键及拒绝次数"""
+        return {
+            str(key): {
+                "state": state.state,
+                "failures": state.failures,
+                "rejected": state.rejected
+            }
+            for key, state in self._states.items()
+            if state.state != CLOSED or state.rejected
+        }
+
+
+# 各上游服务的熔断器(键为上游名称)
+upstream_breaker = CircuitBreaker(
+    "upstream",
+    enabled=settings.circuit_breaker_enabled,
+    failure_threshold=settings.circuit_failure_threshold,
+    recovery_timeout=settings.circuit_recovery_timeout
+)
+
+
+def _breaker_states() -> Dict[tuple, float]:
+    """熔断状态指标回调(标签值相同的键取最严重的状态)"""
+    values: Dict[tuple, float] = {}
+    for name, breaker in breakers.items():
+        for key, state in breaker._states.items():
+            label = (name, breaker.metric_key(key))
+            values[label] = max(values.get(label, 0), _STATE_VALUES[state.state])
+    return values
+
+
+def _breaker_rejections() -> Dict[tuple, float]:
+    """熔断拒绝次数指标回调(标签值相同的键累加)"""
+    values: Dict[tuple, float] = {}
+    for name, breaker in breakers.items():
+        for key, state in breaker._states.items():
+            label = (name, breaker.metric_key(key))
+            values[label] = values.get(label, 0) + state.rejected
+    return values
+
+
+registry.callback(
+    "circuit_breaker_state",
+    "Circuit breaker state (0=closed, 1=half_open, 2=open)",
+    ["breaker", "key"],
+    _breaker_states
+)
+registry.callback(
+    "circuit_breaker_rejected_total",
+    "Calls rejected by an open circuit breaker",
+    ["breaker", "key"],
+    _breaker_rejections,
+    type="counter"
+)
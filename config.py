@@ -18,6 +18,29 @@ class Settings(BaseSettings):
     reranker_api_url: str
     reranker_api_key: str
     reranker_model_name: str = "bge-reranker-v2-m3"
+    # remote: 调用Reranker接口; local: 使用本地BM25(不调用Reranker)
+    rerank_mode: str = "remote"
+    # Reranker不可用时用本地BM25排序(否则按Dify分数排序)
+    rerank_lexical_fallback: bool = True
+    # 级联重排序: 先按Dify分数+BM25粗排,只把前 max(min, factor*top_k) 个候选发送给Reranker (factor 为 0 表示不启用)
+    rerank_cascade_factor: float = 0.0
+    rerank_cascade_min: int = 20
+    # 跨请求合并Rerank调用的时间窗口(秒, 0 表示不合并)和提前发送的文档数
+    rerank_microbatch_window: float = 0.0
+    rerank_microbatch_max_documents: int = 64
+    # Rerank分片: 单次最多发送的文档数(0 表示不限制);设置目标延迟后按观测吞吐缩小分片(0 表示只按上限拆分)
+    rerank_max_batch: int = 64
+    rerank_min_shard: int = 8
+    rerank_shard_target_latency: float = 0.0
+    # Rerank token预算: 每个(查询, 文档)对不超过模型的最大token数,查询最多占 rerank_query_token_share,
+    # 超出的查询只保留问题和前文中最相关的一段,超出的文档截取与查询最相关的一段
+    # reranker_max_tokens 按模型覆盖内置值,格式 "模型=token数",逗号分隔(不带模型名的数值作用于所有模型)
+    rerank_token_budget_enabled: bool = True
+    reranker_max_tokens: str = ""
+    rerank_query_token_share: float = 0.25
+    # 多查询重排序: 同时用原始问题和LLM生成的检索查询重排序并融合(rrf: 倒数排名融合, mean: 平均分)
+    multi_query_rerank_enabled: bool = False
+    multi_query_rerank_fusion: str = "rrf"
 
     # Application Configuration
     app_host: str = "0.0.0.0"
@@ -30,6 +53,88 @@ class Settings(BaseSettings):
     default_score_threshold: float = 0.4
     default_semantic_weight: float = 0.7
 
+    # HTTP Connection Pool Configuration
+    dify_max_connections: int = 50
+    llm_max_connections: int = 20
+    reranker_max_connections: int = 20
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http2_enabled: bool = False
+
+    # Pipeline Configuration
+    speculative_retrieval_enabled: bool = False
+    llm_streaming_enabled: bool = False
+    singleflight_enabled: bool = True
+    rerank_batch_size: int = 16
+
+    # Fan-out Quorum Configuration (0 表示不启用)
+    dify_quorum: int = 0
+    dify_soft_deadline: float = 0.0
+    dify_enough_segments: int = 0
+    dify_high_score: float = 0.8
+
+    # Hedging Configuration
+    dify_hedging_enabled: bool = False
+    dify_hedge_budget: float = 0.05
+    dify_hedge_quantile: float = 0.95
+    dify_hedge_min_samples: int = 20
+
+    # Deadline Configuration (请求未指定延迟预算时使用 default_request_timeout, 0 表示不限制)
+    default_request_timeout: float = 0.0
+    deadline_llm_share: float = 0.4
+    deadline_dify_share: float = 0.7
+    deadline_min_rerank: float = 0.05
+
+    # Circuit Breaker Configuration
+    circuit_breaker_enabled: bool = True
+    circuit_failure_threshold: int = 5
+    circuit_recovery_timeout: float = 30.0
+    dify_negative_cache_ttl: float = 60.0
+
+    # Rate Limit Configuration (每个API Key每秒请求数, 0 表示不限速, 仍会处理429)
+    dify_rate_limit: float = 0.0
+    dify_rate_burst: int = 10
+    llm_rate_limit: float = 0.0
+    llm_rate_burst: int = 5
+    reranker_rate_limit: float = 0.0
+    reranker_rate_burst: int = 5
+    rate_limit_max_wait: float = 2.0
+    llm_api_key_pool: str = ""
+    reranker_api_key_pool: str = ""
+
+    # Adaptive Concurrency Configuration (Dify并发上限按每轮的延迟中位数自动调整, max 为 0 时使用 dify_max_connections)
+    # 默认关闭: 需根据实际的Dify延迟分布调整 tolerance 后再启用
+    dify_adaptive_concurrency_enabled: bool = False
+    dify_concurrency_initial: int = 10
+    dify_concurrency_min: int = 2
+    dify_concurrency_max: int = 0
+    dify_concurrency_tolerance: float = 2.0
+
+    # Document Condensation Configuration (携带的文档超出预算时只保留与问题最相关的句子, 0 表示不压缩)
+    document_condense_enabled: bool = True
+    document_llm_max_tokens: int = 1024
+    document_centrality_weight: float = 0.3
+
+    # Cache Configuration
+    decision_cache_enabled: bool = True
+    decision_cache_ttl: float = 600.0
+    decision_cache_max_size: int = 10000
+    dify_cache_enabled: bool = True
+    dify_cache_ttl: float = 300.0
+    dify_cache_max_size: int = 20000
+    rerank_cache_enabled: bool = True
+    rerank_cache_ttl: float = 3600.0
+    rerank_cache_max_size: int = 100000
+    document_cache_enabled: bool = True
+    document_cache_ttl: float = 3600.0
+    document_cache_max_size: int = 1000
+
+    # Metrics Configuration (按知识库的指标只单独输出列出的知识库ID,逗号分隔,其余汇总为 other)
+    metrics_dataset_ids: str = ""
+
+    # Admin Configuration (为空时管理接口不校验)
+    admin_api_key: Optional[str] = None
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -0,0 +1,85 @@
+from typing import Union
+import time
+import httpx
+
+
+# 截止时间已过时使用的最小超时(秒),使请求立即超时而不是无限等待
+MIN_TIMEOUT = 0.001
+
+
+class Deadline:
+    """
+    请求的整体延迟预算
+
+    流水线按比例把剩余时间分给各阶段,各服务据此缩短上游请求的超时,
+    而不是每个阶段都使用固定的超时。
+    """
+
+    def __init__(self, budget: float):
+        """
+        Args:
+            budget: 从现在开始的可用时间(秒)
+        """
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        """剩余时间(秒),已过期时为0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        """是否已过期"""
+        return self.remaining() <= 0.0
+
+    def stage(self, share: float) -> "Deadline":
+        """
+        为下一个阶段分配剩余时间的一部分
+
+        Args:
+            share: 分给该阶段的比例(0~1)
+
+        Returns:
+            Deadline: 该阶段的截止时间
+        """
+        return Deadline(self.remaining() * share)
+
+    def clamp(self, timeout: Union[float, httpx.Timeout]) -> Union[float, httpx.Timeout]:
+        """
+        将上游请求的超时限制在剩余时间内
+
+        Args:
+            timeout: 服务的默认超时
+
+        Returns:
+            Union[float, httpx.Timeout]: 不超过剩余时间的超时
+        """
+        remaining = max(MIN_TIMEOUT, self.remaining())
+        if isinstance(timeout, httpx.Timeout):
+            return httpx.Timeout(
+                connect=_min_timeout(timeout.connect, remaining),
+                read=_min_timeout(timeout.read, remaining),
+                write=_min_timeout(timeout.write, remaining),
+                pool=_min_timeout(timeout.pool, remaining)
+            )
+        return _min_timeout(timeout, remaining)
+
+
+def is_deadline_timeout(error: BaseException) -> bool:
+    """
+    判断超时是否由请求的延迟预算耗尽引起(而不是上游变慢)
+
+    各服务通过 extensions={"deadline": deadline} 把截止时间附在上游请求上。
+    """
+    if not isinstance(error, httpx.TimeoutException):
+        return False
+    try:
+        deadline = error.request.extensions.get("deadline")
+    except RuntimeError:
+        return False
+    return deadline is not None and deadline.expired
+
+
+def _min_timeout(timeout, remaining: float) -> float:
+    """取较小的超时(None 表示不限制)"""
+    return remaining if timeout is None else min(timeout, remaining)
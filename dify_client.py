@@ -1,8 +1,97 @@
-from typing import List, Dict, Any
+from typing import List, Any, AsyncIterator, Optional, Tuple
 import asyncio
+import time
 import httpx
 from models import DocumentSegment, RetrievalQuery
 from config import settings
+from http_pool import create_http_client
+from cache import TTLCache, hash_text
+from singleflight import SingleFlight
+from hedging import HedgeAttempt, HedgedRequests
+from deadline import Deadline
+from circuit_breaker import CircuitBreaker, CircuitOpenError, upstream_breaker, is_connection_failure
+from rate_limit import RateGovernor, RateLimitedError
+from adaptive_limit import AdaptiveLimiter, ConcurrencyLimitedError
+from metrics import dataset_duration, dataset_label, segments_total, fallbacks_total
+
+
+# 说明配置错误(API Key、权限或知识库ID)的状态码,短时间内重试也不会成功
+PERMANENT_ERROR_STATUS = (401, 403, 404)
+
+
+class FailedRetrieval(list):
+    """
+    检索失败时返回的空结果
+
+    仍是空列表,调用方可以按普通结果合并;iter_completed 不把它计为已返回的知识库。
+    """
+
+    def __init__(self, reason: str):
+        super().__init__()
+        self.reason = reason
+
+
+def is_answered(result: Any) -> bool:
+    """判断 iter_completed 产出的结果是否为知识库成功返回的片段列表(不含异常和失败)"""
+    return isinstance(result, list) and not isinstance(result, FailedRetrieval)
+
+
+def failure_reason(result: Any) -> Optional[str]:
+    """iter_completed 产出的结果的失败原因,成功时返回None"""
+    if isinstance(result, FailedRetrieval):
+        return result.reason
+    if isinstance(result, asyncio.CancelledError):
+        return "cancelled"
+    if isinstance(result, BaseException):
+        return "error"
+    return None
+
+
+def incomplete_datasets(dataset_ids: List[str], results: List[Any]) -> List[str]:
+    """
+    结果不完整的知识库: 至少有一个检索查询未返回(被跳过)或检索失败
+
+    Args:
+        dataset_ids: 各检索查询对应的知识库ID
+        results: 各检索查询的结果,未返回的为None
+
+    Returns:
+        List[str]: 知识库ID列表(去重,保持原顺序)
+    """
+    incomplete = []
+    for dataset_id, result in zip(dataset_ids, results):
+        if not is_answered(result) and dataset_id not in incomplete:
+            incomplete.append(dataset_id)
+    return incomplete
+
+
+class CachedRetrieval:
+    """缓存的检索结果,记录获取时使用的检索参数"""
+
+    def __init__(self, top_k: int, score_threshold: float, record_count: int, segments: List[DocumentSegment]):
+        self.top_k = top_k
+        self.score_threshold = score_threshold
+        self.record_count = record_count
+        self.segments = segments
+
+    def covers(self, top_k: int, score_threshold: float) -> bool:
+        """
+        判断该结果能否回答更窄的请求
+
+        阈值不低于缓存阈值,且 top_k 不超过缓存的 top_k
+        (或缓存结果未达到 top_k,说明已返回全部满足阈值的片段)。
+        """
+        if score_threshold < self.score_threshold:
+            return False
+        return top_k <= self.top_k or self.record_count < self.top_k
+
+    def select(self, top_k: int, score_threshold: float) -> List[DocumentSegment]:
+        """在本地按阈值和数量过滤,返回片段副本"""
+        return [
+            seg.model_copy(deep=True)
+            for seg in self.segments
+            if seg.score >= score_threshold
+        ][:top_k]
 
 
 class DifyClient:
@@ -10,6 +99,79 @@ class DifyClient:
 
     def __init__(self):
         self.api_base_url = settings.dify_api_base_url.rstrip('/')
+        # 超时设置
+        self.timeout = httpx.Timeout(
+            connect=10.0,
+            read=30.0,
+            write=10.0,
+            pool=10.0
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight = SingleFlight("dify", enabled=settings.singleflight_enabled)
+        # 按知识库统计延迟,超过p95仍未返回时对冲
+        self._hedger = HedgedRequests(
+            "dify",
+            enabled=settings.dify_hedging_enabled,
+            budget=settings.dify_hedge_budget,
+            quantile=settings.dify_hedge_quantile,
+            min_samples=settings.dify_hedge_min_samples,
+            metric_key=dataset_label
+        )
+        self.result_cache: Optional[TTLCache] = None
+        if settings.dify_cache_enabled:
+            self.result_cache = TTLCache(
+                "dify",
+                ttl=settings.dify_cache_ttl,
+                max_size=settings.dify_cache_max_size
+            )
+        # 按知识库熔断,并短时间缓存永久性错误(负缓存)
+        self._breaker = CircuitBreaker(
+            "dify_dataset",
+            enabled=settings.circuit_breaker_enabled,
+            failure_threshold=settings.circuit_failure_threshold,
+            recovery_timeout=settings.circuit_recovery_timeout,
+            metric_key=dataset_label
+        )
+        # 按API Key限流
+        self._governor = RateGovernor(
+            "dify",
+            rate=settings.dify_rate_limit,
+            burst=settings.dify_rate_burst,
+            max_wait=settings.rate_limit_max_wait
+        )
+        # 所有请求共享的自适应并发上限,避免大量并发压垮Dify
+        self._limiter = AdaptiveLimiter(
+            "dify",
+            enabled=settings.dify_adaptive_concurrency_enabled,
+            initial_limit=settings.dify_concurrency_initial,
+            min_limit=settings.dify_concurrency_min,
+            max_limit=settings.dify_concurrency_max or settings.dify_max_connections,
+            tolerance=settings.dify_concurrency_tolerance
+        )
+        self.error_cache: Optional[TTLCache] = None
+        if settings.dify_negative_cache_ttl > 0:
+            self.error_cache = TTLCache(
+                "dify_errors",
+                ttl=settings.dify_negative_cache_ttl,
+                max_size=settings.dify_cache_max_size
+            )
+
+    async def start(self):
+        """创建长连接HTTP客户端(应用启动时调用)"""
+        if self._client is None:
+            self._client = create_http_client("dify", self.timeout, settings.dify_max_connections)
+
+    async def close(self):
+        """关闭HTTP客户端(应用关闭时调用)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """获取共享HTTP客户端,未启动时按需创建"""
+        if self._client is None:
+            self._client = create_http_client("dify", self.timeout, settings.dify_max_connections)
+        return self._client
 
     async def retrieve_from_dataset(
         self,
@@ -18,7 +180,8 @@ class DifyClient:
         api_key: str,
         top_k: int = 10,
         score_threshold: float = 0.4,
-        semantic_weight: float = 0.7
+        semantic_weight: float = 0.7,
+        deadline: Optional[Deadline] = None
     ) -> List[DocumentSegment]:
         """
         从单个知识库检索
@@ -30,89 +193,74 @@ class DifyClient:
             top_k: 返回结果数量
             score_threshold: 分数阈值
             semantic_weight: 语义检索权重
+            deadline: 请求截止时间(可选),上游超时不超过剩余时间
 
         Returns:
-            List[DocumentSegment]: 检索到的文档片段列表
+            List[DocumentSegment]: 检索到的文档片段列表,检索失败时为空的 FailedRetrieval
         """
-        url = f"{self.api_base_url}/datasets/{dataset_id}/retrieve"
+        # 最近返回永久性错误的知识库直接跳过
+        error_key = (dataset_id, hash_text(api_key))
+        if self.error_cache is not None:
+            status_code = self.error_cache.get(error_key)
+            if status_code is not None:
+                fallbacks_total.inc("dify", "negative_cache")
+                return FailedRetrieval("negative_cache")
 
-        payload = {
-            "query": query,
-            "retrieval_model": {
-                "search_method": "hybrid_search",
-                "reranking_enable": False,
-                "weights": semantic_weight,
-                "top_k": top_k,
-                "score_threshold_enabled": True,
-                "score_threshold": score_threshold
-            }
-        }
+        cache_key = (dataset_id, query, semantic_weight, hash_text(api_key))
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key, accept=lambda entry: entry.covers(top_k, score_threshold))
+            if cached is not None:
+                return cached.select(top_k, score_threshold)
 
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+            # 缓存的结果不够宽时,按更宽的参数重新获取,使新结果能覆盖两者
+            previous = self.result_cache.peek(cache_key)
+            fetch_top_k = max(top_k, previous.top_k) if previous else top_k
+            fetch_threshold = min(score_threshold, previous.score_threshold) if previous else score_threshold
+        else:
+            fetch_top_k, fetch_threshold = top_k, score_threshold
 
         try:
-            import time
-            start_time = time.time()
-
-            # 配置超时设置
-            timeout = httpx.Timeout(
-                connect=10.0,
-                read=30.0,
-                write=10.0,
-                pool=10.0
+            # 相同的并发检索共享同一次Dify调用
+            segments, record_count = await self._inflight.do(
+                (cache_key, fetch_top_k, fetch_threshold),
+                lambda: self._guarded_fetch(
+                    dataset_id=dataset_id,
+                    query=query,
+                    api_key=api_key,
+                    top_k=fetch_top_k,
+                    score_threshold=fetch_threshold,
+                    semantic_weight=semantic_weight,
+                    deadline=deadline
+                )
             )
 
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                response = await client.post(url, json=payload, headers=headers)
-                response.raise_for_status()
-
-                result = response.json()
-                records = result.get("records", [])
-
-                elapsed = time.time() - start_time
-                print(f"[Dify] 检索完成: {len(records)}个片段 (耗时{elapsed:.2f}s)")
-
-                # 转换为统一的DocumentSegment格式
-                segments = []
-                for record in records:
-                    try:
-                        segment_data = record.get("segment", {})
-                        document_data = segment_data.get("document", {})
-
-                        # 修复：确保score有默认值
-                        score = record.get("score")
-                        if score is None:
-                            score = 0.0
-
-                        segment = DocumentSegment(
-                            dataset_id=dataset_id,
-                            dataset_name=None,
-                            document_id=segment_data.get("document_id", ""),
-                            document_name=document_data.get("name", ""),
-                            segment_id=segment_data.get("id", ""),
-                            content=segment_data.get("content", ""),
-                            score=score,
-                            position=segment_data.get("position"),
-                            metadata=document_data.get("doc_metadata", {})
-                        )
-                        segments.append(segment)
-                    except Exception as e:
-                        print(f"[Dify] 警告: 片段转换失败: {e}")
-                        continue
-
-                return segments
+            entry = CachedRetrieval(fetch_top_k, fetch_threshold, record_count, segments)
+            if self.result_cache is not None:
+                self.result_cache.set(cache_key, entry)
+            return entry.select(top_k, score_threshold)
 
+        except CircuitOpenError as e:
+            print(f"[Dify] 跳过知识库 [dataset_id={dataset_id}]: {e}")
+            fallbacks_total.inc("dify", "circuit_open")
+            return FailedRetrieval("circuit_open")
+        except RateLimitedError as e:
+            print(f"[Dify] 跳过知识库 [dataset_id={dataset_id}]: {e}")
+            fallbacks_total.inc("dify", "rate_limited")
+            return FailedRetrieval("rate_limited")
+        except ConcurrencyLimitedError as e:
+            print(f"[Dify] 跳过知识库 [dataset_id={dataset_id}]: {e}")
+            fallbacks_total.inc("dify", "concurrency_limited")
+            return FailedRetrieval("concurrency_limited")
         except httpx.ConnectTimeout as e:
             print(f"[Dify] ❌ 连接超时 [dataset_id={dataset_id}]: {e}")
             print(f"[Dify] 请检查: 1) API地址是否正确 2) 网络连接是否正常")
-            return []
+            fallbacks_total.inc("dify", "connect_timeout")
+            return FailedRetrieval("connect_timeout")
         except httpx.ReadTimeout as e:
             print(f"[Dify] ❌ 读取超时 [dataset_id={dataset_id}]: {e}")
             print(f"[Dify] 请检查: 1) Dify服务是否正常 2) 知识库数据量是否过大")
-            return []
+            fallbacks_total.inc("dify", "read_timeout")
+            return FailedRetrieval("read_timeout")
         except httpx.HTTPStatusError as e:
             print(f"[Dify] ❌ HTTP错误 [dataset_id={dataset_id}]:")
             print(f"[Dify]    状态码: {e.response.status_code}")
@@ -123,19 +271,172 @@ class DifyClient:
                 print(f"[Dify]    可能原因: Dataset ID 不存在或URL路径错误")
             elif e.response.status_code == 403:
                 print(f"[Dify]    可能原因: API Key 无权限访问此知识库")
-            return []
+            if e.response.status_code in PERMANENT_ERROR_STATUS and self.error_cache is not None:
+                print(f"[Dify]    {settings.dify_negative_cache_ttl:.0f}秒内将直接跳过此知识库")
+                self.error_cache.set(error_key, e.response.status_code)
+            fallbacks_total.inc("dify", "http_status")
+            return FailedRetrieval("http_status")
         except httpx.HTTPError as e:
             print(f"[Dify] ❌ HTTP请求失败 [dataset_id={dataset_id}]:")
             print(f"[Dify]    错误类型: {type(e).__name__}")
             print(f"[Dify]    错误信息: {e}")
-            return []
+            fallbacks_total.inc("dify", "http_error")
+            return FailedRetrieval("http_error")
         except Exception as e:
             print(f"[Dify] ❌ 处理响应时出错 [dataset_id={dataset_id}]:")
             print(f"[Dify]    错误类型: {type(e).__name__}")
             print(f"[Dify]    错误信息: {e}")
             import traceback
             traceback.print_exc()
-            return []
+            fallbacks_total.inc("dify", "error")
+            return FailedRetrieval("error")
+
+    async def _guarded_fetch(
+        self,
+        dataset_id: str,
+        query: str,
+        api_key: str,
+        top_k: int,
+        score_threshold: float,
+        semantic_weight: float,
+        deadline: Optional[Deadline] = None
+    ) -> Tuple[List[DocumentSegment], int]:
+        """
+        在Dify上游和知识库两级熔断保护下检索,慢调用由对冲请求兜底(不处理异常)
+
+        上游熔断只统计连接失败,超时和5xx可能只与单个知识库有关,由知识库熔断统计。
+
+        Returns:
+            Tuple[List[DocumentSegment], int]: 文档片段列表和Dify返回的记录数
+        """
+        def fetch(attempt: Optional[HedgeAttempt]):
+            return self._fetch_from_dataset(
+                dataset_id=dataset_id,
+                query=query,
+                api_key=api_key,
+                top_k=top_k,
+                score_threshold=score_threshold,
+                semantic_weight=semantic_weight,
+                deadline=deadline,
+                attempt=attempt
+            )
+
+        return await upstream_breaker.call(
+            "dify",
+            lambda: self._breaker.call(dataset_id, lambda: self._hedger.do(dataset_id, fetch)),
+            is_failure=is_connection_failure
+        )
+
+    async def _fetch_from_dataset(
+        self,
+        dataset_id: str,
+        query: str,
+        api_key: str,
+        top_k: int,
+        score_threshold: float,
+        semantic_weight: float,
+        deadline: Optional[Deadline] = None,
+        attempt: Optional[HedgeAttempt] = None
+    ) -> Tuple[List[DocumentSegment], int]:
+        """
+        调用Dify检索接口(不处理异常)
+
+        Args:
+            dataset_id: 知识库ID
+            query: 检索查询
+            api_key: API密钥
+            top_k: 返回结果数量
+            score_threshold: 分数阈值
+            semantic_weight: 语义检索权重
+            deadline: 请求截止时间(可选)
+            attempt: 对冲的首次调用计时(可选),只统计HTTP请求本身,不含限流和并发排队
+
+        Returns:
+            Tuple[List[DocumentSegment], int]: 文档片段列表和Dify返回的记录数
+        """
+        url = f"{self.api_base_url}/datasets/{dataset_id}/retrieve"
+
+        payload = {
+            "query": query,
+            "retrieval_model": {
+                "search_method": "hybrid_search",
+                "reranking_enable": False,
+                "weights": semantic_weight,
+                "top_k": top_k,
+                "score_threshold_enabled": True,
+                "score_threshold": score_threshold
+            }
+        }
+
+        start_time = time.perf_counter()
+
+        client = self._get_client()
+        max_wait = deadline.remaining() if deadline is not None else None
+
+        async def post(key: str) -> httpx.Response:
+            # 排队结束后再按剩余时间计算超时
+            if attempt is not None:
+                attempt.sent()
+            request_start = time.perf_counter()
+            response = await client.post(
+                url,
+                json=payload,
+                headers={
+                    "Authorization": f"Bearer {key}",
+                    "Content-Type": "application/json"
+                },
+                timeout=deadline.clamp(self.timeout) if deadline is not None else self.timeout,
+                extensions={"deadline": deadline}
+            )
+            if attempt is not None and response.is_success:
+                attempt.record(time.perf_counter() - request_start)
+            return response
+
+        # 按API Key排队,收到429时按Retry-After等待后重试;发送前再按上游的自适应并发上限排队
+        response = await self._governor.send(
+            [api_key],
+            lambda key: self._limiter.run(
+                lambda: post(key),
+                timeout=deadline.remaining() if deadline is not None else None
+            ),
+            max_wait=max_wait
+        )
+        response.raise_for_status()
+
+        result = response.json()
+        records = result.get("records", [])
+
+        dataset_duration.observe(time.perf_counter() - start_time, dataset_label(dataset_id))
+
+        # 转换为统一的DocumentSegment格式
+        segments = []
+        for record in records:
+            try:
+                segment_data = record.get("segment", {})
+                document_data = segment_data.get("document", {})
+
+                # 修复：确保score有默认值
+                score = record.get("score")
+                if score is None:
+                    score = 0.0
+
+                segment = DocumentSegment(
+                    dataset_id=dataset_id,
+                    dataset_name=None,
+                    document_id=segment_data.get("document_id", ""),
+                    document_name=document_data.get("name", ""),
+                    segment_id=segment_data.get("id", ""),
+                    content=segment_data.get("content", ""),
+                    score=score,
+                    position=segment_data.get("position"),
+                    metadata=document_data.get("doc_metadata", {})
+                )
+                segments.append(segment)
+            except Exception as e:
+                print(f"[Dify] 警告: 片段转换失败: {e}")
+                continue
+
+        return segments, len(records)
 
     async def batch_retrieve(
         self,
@@ -160,38 +461,172 @@ class DifyClient:
         """
         # 创建并发任务
         tasks = [
-            self.retrieve_from_dataset(
+            asyncio.create_task(self.retrieve_from_dataset(
                 dataset_id=query.dataset_id,
                 query=query.query,
                 api_key=api_key,
                 top_k=top_k,
                 score_threshold=score_threshold,
                 semantic_weight=semantic_weight
-            )
+            ))
             for query in retrieval_queries
         ]
 
-        # 并行执行所有检索任务
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # 并行执行所有检索任务(满足法定数量或超出时间预算时提前结束)
+        dataset_ids = [query.dataset_id for query in retrieval_queries]
+        results: List[Any] = [None] * len(tasks)
+        async for index, result in self.iter_completed(tasks, dataset_ids=dataset_ids):
+            results[index] = result
+
+        skipped = incomplete_datasets(dataset_ids, results)
+        if skipped:
+            print(f"[Dify] 未返回或检索失败的知识库: {skipped}")
+
+        return self.merge_results(results)
 
-        # 合并所有结果，并根据 segment_id 去重
-        seen_segment_ids = set()
-        all_segments = []
+    async def iter_completed(
+        self,
+        tasks: List[asyncio.Task],
+        dataset_ids: Optional[List[str]] = None,
+        quorum: Optional[int] = None,
+        soft_deadline: Optional[float] = None,
+        enough_segments: Optional[int] = None,
+        high_score: Optional[float] = None
+    ) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        按完成顺序产出检索结果,满足以下任一条件时提前结束并取消其余任务:
+        - 已有 quorum 个不同的知识库成功返回结果(同一知识库的多个查询只计一次,检索失败不计入)
+        - 超出时间预算 soft_deadline(秒,从调用时开始计算)
+        - 已收集 enough_segments 个分数不低于 high_score 的片段
+
+        Args:
+            tasks: 检索任务列表
+            dataset_ids: 各任务对应的知识库ID,为None时每个任务视为一个知识库
+            quorum: 法定数量(知识库数),为None时使用配置,0表示等待全部
+            soft_deadline: 时间预算,为None时使用配置,0表示不限制
+            enough_segments: 高分片段数量,为None时使用配置,0表示不启用
+            high_score: 高分片段的分数阈值,为None时使用配置
 
+        Yields:
+            Tuple[int, Any]: (任务下标, 片段列表或异常),未产出的任务即被跳过的任务
+        """
+        quorum = settings.dify_quorum if quorum is None else quorum
+        soft_deadline = settings.dify_soft_deadline if soft_deadline is None else soft_deadline
+        enough_segments = settings.dify_enough_segments if enough_segments is None else enough_segments
+        high_score = settings.dify_high_score if high_score is None else high_score
+
+        deadline = time.monotonic() + soft_deadline if soft_deadline > 0 else None
+        pending = {task: index for index, task in enumerate(tasks)}
+        answered = set()
+        high_score_segments = 0
+        reason = None
+
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    reason = "deadline"
+                    break
+
+                for task in done:
+                    index = pending.pop(task)
+                    if task.cancelled():
+                        result = asyncio.CancelledError()
+                    elif task.exception() is not None:
+                        result = task.exception()
+                    else:
+                        result = task.result()
+                    if is_answered(result):
+                        answered.add(index if dataset_ids is None else dataset_ids[index])
+                    if isinstance(result, list):
+                        high_score_segments += sum(1 for seg in result if seg.score >= high_score)
+                    yield index, result
+
+                if pending and quorum > 0 and len(answered) >= quorum:
+                    reason = "quorum"
+                    break
+                if pending and enough_segments > 0 and high_score_segments >= enough_segments:
+                    reason = "enough_segments"
+                    break
+        finally:
+            # 取消未返回的知识库检索(包括调用方提前停止迭代时)
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+            if pending and reason is not None:
+                fallbacks_total.inc("dify", reason, amount=len(pending))
+
+    def invalidate_dataset(self, dataset_id: str) -> int:
+        """
+        删除某个知识库的所有缓存结果(包括缓存的错误)
+
+        Args:
+            dataset_id: 知识库ID
+
+        Returns:
+            int: 删除的条目数
+        """
+        removed = 0
+        if self.error_cache is not None:
+            removed += self.error_cache.invalidate(lambda key: key[0] == dataset_id)
+        if self.result_cache is not None:
+            removed += self.result_cache.invalidate(lambda key: key[0] == dataset_id)
+        return removed
+
+    def merge_results(self, results: List[Any]) -> List[DocumentSegment]:
+        """
+        合并多个检索任务的结果,并根据 segment_id 去重
+
+        Args:
+            results: 各检索任务的返回值(片段列表或异常)
+
+        Returns:
+            List[DocumentSegment]: 合并去重后的文档片段
+        """
+        merger = SegmentMerger()
         for result in results:
-            if isinstance(result, list):
-                for segment in result:
-                    # 根据 segment_id 去重
-                    if segment.segment_id not in seen_segment_ids:
-                        seen_segment_ids.add(segment.segment_id)
-                        all_segments.append(segment)
-            elif isinstance(result, Exception):
-                print(f"[Dify] 检索任务失败: {result}")
-
-        total_before = sum(len(r) if isinstance(r, list) else 0 for r in results)
-        print(f"[Dify] 去重后剩余 {len(all_segments)} 个片段 (去重前: {total_before}, 去重: {total_before - len(all_segments)})")
-
-        return all_segments
+            merger.add(result)
+        return merger.finish()
+
+
+class SegmentMerger:
+    """按到达顺序增量合并检索结果,并根据 segment_id 去重"""
+
+    def __init__(self):
+        self.segments: List[DocumentSegment] = []
+        self._seen_segment_ids = set()
+        self._total_before = 0
+
+    def add(self, result: Any) -> List[DocumentSegment]:
+        """
+        加入一个检索任务的结果
+
+        Args:
+            result: 检索任务的返回值(片段列表或异常)
+
+        Returns:
+            List[DocumentSegment]: 本次新增的(未重复的)文档片段
+        """
+        added = []
+        if isinstance(result, list):
+            self._total_before += len(result)
+            for segment in result:
+                # 根据 segment_id 去重
+                if segment.segment_id not in self._seen_segment_ids:
+                    self._seen_segment_ids.add(segment.segment_id)
+                    added.append(segment)
+        elif isinstance(result, Exception):
+            print(f"[Dify] 检索任务失败: {result}")
+
+        self.segments.extend(added)
+        return added
+
+    def finish(self) -> List[DocumentSegment]:
+        """记录去重统计并返回所有片段"""
+        segments_total.inc("before_dedupe", amount=self._total_before)
+        segments_total.inc("after_dedupe", amount=len(self.segments))
+        return self.segments
 
 
 # 创建全局实例
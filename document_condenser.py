@@ -0,0 +1,202 @@
+from typing import Dict, List, Optional, Tuple
+import re
+import numpy as np
+from cache import TTLCache, hash_text
+from config import settings
+from lexical_rerank import bm25_scores, hashed_term_matrix
+from metrics import registry
+from token_budget import estimate_tokens, estimate_tokens_many, window
+
+
+# 句子结束位置: 中英文句末标点、分号和换行之后,连续的标点和后引号归入同一句(英文句点需后跟空白,避免拆开小数)
+_END = "[。！？!?；;…\n]"
+_CLOSE = "[”’」』）)\"']"
+_SENTENCE_END = re.compile(
+    rf"(?<={_END})(?!{_END}|{_CLOSE})|(?<={_END}{_CLOSE})(?!{_CLOSE})|(?<=\.)(?=\s)"
+)
+# 没有标点的长段落按该长度切分
+MAX_SENTENCE_CHARS = 200
+
+# TextRank 参数
+DAMPING = 0.85
+ITERATIONS = 30
+# 句子较多时改用与全文词频中心的相似度代替TextRank(避免 n×n 的相似度矩阵)
+MAX_TEXTRANK_SENTENCES = 2000
+
+# 不相邻的句子之间的分隔
+GAP = " … "
+# 剩余预算少于该值时不再截取长句的片段
+MIN_FRAGMENT_TOKENS = 16
+
+
+condensed_documents_total = registry.counter(
+    "document_condensed_total",
+    "Attached documents condensed to the token budget",
+    ["target"]
+)
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    按句末标点和换行切分句子(保留句中的原文和标点)
+
+    Args:
+        text: 文本
+
+    Returns:
+        List[str]: 句子列表(不含只有空白的片段)
+    """
+    sentences = []
+    for piece in _SENTENCE_END.split(text):
+        for start in range(0, len(piece), MAX_SENTENCE_CHARS):
+            chunk = piece[start:start + MAX_SENTENCE_CHARS]
+            if chunk.strip():
+                sentences.append(chunk)
+    return sentences
+
+
+def centrality(sentences: List[str]) -> np.ndarray:
+    """
+    句子在文档中的中心度(TextRank)
+
+    句子之间按词频向量的余弦相似度连边,用幂迭代计算PageRank;
+    句子过多时使用与全文词频中心的余弦相似度。
+
+    Args:
+        sentences: 句子列表
+
+    Returns:
+        np.ndarray: 每个句子的中心度
+    """
+    count = len(sentences)
+    if count == 0:
+        return np.zeros(0)
+
+    vectors = np.log1p(hashed_term_matrix(sentences))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.maximum(norms, 1e-9)
+
+    if count > MAX_TEXTRANK_SENTENCES:
+        center = vectors.mean(axis=0)
+        return (vectors @ center).astype(np.float64)
+
+    similarity = (vectors @ vectors.T).astype(np.float64)
+    np.fill_diagonal(similarity, 0.0)
+    out_weights = similarity.sum(axis=1, keepdims=True)
+    # 与其他句子都没有共同词的句子均匀跳转
+    transition = np.where(out_weights > 0, similarity / np.maximum(out_weights, 1e-12), 1.0 / count)
+    ranks = np.full(count, 1.0 / count)
+    for _ in range(ITERATIONS):
+        updated = (1.0 - DAMPING) / count + DAMPING * (transition.T @ ranks)
+        if np.abs(updated - ranks).sum() < 1e-6:
+            return updated
+        ranks = updated
+    return ranks
+
+
+class DocumentCondenser:
+    """
+    携带文档的抽取式压缩
+
+    文档超出token预算时把文档切分为句子,按与问题的BM25相关度和TextRank中心度打分,
+    在预算内按分数选取句子并按原文顺序拼接,放不下的长句(如没有标点的段落)截取与问题最相关的一段。
+    切分和中心度与问题无关,按文档哈希缓存。
+    """
+
+    def __init__(self):
+        self.enabled = settings.document_condense_enabled
+        self.centrality_weight = settings.document_centrality_weight
+        self.cache: Optional[TTLCache] = None
+        if settings.document_cache_enabled:
+            self.cache = TTLCache(
+                "document",
+                ttl=settings.document_cache_ttl,
+                max_size=settings.document_cache_max_size
+            )
+
+    def _analyze(self, document: str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """
+        切分句子并计算各句的token数和中心度(按文档哈希缓存)
+
+        Returns:
+            Tuple[List[str], np.ndarray, np.ndarray]: 句子、token数、中心度
+        """
+        key = hash_text(document)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        sentences = split_sentences(document)
+        analysis = (sentences, estimate_tokens_many(sentences), centrality(sentences))
+        if self.cache is not None:
+            self.cache.set(key, analysis)
+        return analysis
+
+    def condense(self, document: str, question: str, max_tokens: int, target: str = "llm") -> str:
+        """
+        把文档压缩到不超过 max_tokens
+
+        Args:
+            document: 携带的文档
+            question: 用户问题
+            max_tokens: 最大token数
+            target: 用途(llm / rerank),用于统计
+
+        Returns:
+            str: 压缩后的文档(未超出预算或未启用时原样返回,预算小于 MIN_FRAGMENT_TOKENS 时为空)
+        """
+        if not self.enabled or not document or estimate_tokens(document) <= max_tokens:
+            return document
+        if max_tokens < MIN_FRAGMENT_TOKENS:
+            condensed_documents_total.inc(target)
+            return ""
+
+        sentences, tokens, ranks = self._analyze(document)
+        if not sentences:
+            return document
+
+        relevance = bm25_scores(question, sentences)
+        scores = self.centrality_weight * ranks / max(ranks.max(), 1e-12)
+        if relevance.max() > 0:
+            scores = scores + relevance / relevance.max()
+
+        # 按分数贪心选取句子(跳过重复的句子);放不下的长句截取与问题最相关的一段填满剩余预算
+        gap_tokens = estimate_tokens(GAP)
+        chosen: Dict[int, str] = {}
+        truncated = set()
+        seen = set()
+        used = 0.0
+        for index in np.argsort(-scores, kind="stable"):
+            sentence = sentences[index].strip()
+            remaining = max_tokens - used - gap_tokens
+            if remaining < MIN_FRAGMENT_TOKENS:
+                break
+            if sentence in seen:
+                continue
+            text = sentences[index]
+            if tokens[index] > remaining:
+                text = window(question, text, int(remaining))
+                truncated.add(int(index))
+            chosen[int(index)] = text
+            seen.add(sentence)
+            used += estimate_tokens(text) + gap_tokens
+        if not chosen:
+            # 预算小于最短片段: 截取与问题最相关的一段
+            condensed_documents_total.inc(target)
+            return window(question, document, max_tokens)
+
+        parts = []
+        previous = None
+        for index in sorted(chosen):
+            # 不相邻或截取过的句子之间加分隔
+            if previous is not None and (index != previous + 1 or {index, previous} & truncated):
+                parts.append(GAP)
+            parts.append(chosen[index])
+            previous = index
+        condensed_documents_total.inc(target)
+        return "".join(parts).strip()
+
+
+# 创建全局实例
+document_condenser = DocumentCondenser()
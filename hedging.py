@@ -0,0 +1,226 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, TypeVar
+import asyncio
+import math
+import time
+from metrics import registry
+
+T = TypeVar("T")
+
+
+# 所有已创建的对冲器,用于统计接口
+hedgers: Dict[str, "HedgedRequests"] = {}
+
+
+class _KeyStats:
+    """单个键(如知识库)的延迟样本和对冲统计"""
+
+    def __init__(self, window: int):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        self.budget_exhausted = 0
+
+
+class HedgeAttempt:
+    """
+    首次调用的上游计时
+
+    调用方在请求真正发给上游时(本地限流和并发排队之后)调用 sent(),
+    成功返回后用 record() 记录请求本身的延迟。
+    """
+
+    def __init__(self, latencies: Deque[float]):
+        self._latencies = latencies
+        self._sent_at: Optional[float] = None
+        self.started = asyncio.Event()
+
+    def sent(self):
+        """请求已发出,开始计算对冲延迟"""
+        if self._sent_at is None:
+            self._sent_at = time.perf_counter()
+        self.started.set()
+
+    def record_cancelled(self):
+        """对冲请求先返回时,以已等待的时间作为被取消的首次调用的延迟(下限),避免统计只剩快的调用"""
+        if self._sent_at is not None:
+            self._latencies.append(time.perf_counter() - self._sent_at)
+
+    def record(self, latency: float):
+        """记录上游延迟(秒)"""
+        self._latencies.append(latency)
+
+
+class HedgedRequests:
+    """
+    对冲请求: 调用超过该键近期延迟的分位数(如p95)仍未返回时,
+    再发送一个相同的请求,取先返回的结果并取消另一个。
+
+    额外请求按键限额: 对冲次数不超过请求次数的 budget 比例。
+    """
+
+    # 每个键保留的延迟样本数
+    WINDOW = 200
+
+    def __init__(
+        self,
+        name: str,
+        enabled: bool = True,
+        budget: float = 0.05,
+        quantile: float = 0.95,
+        min_samples: int = 20,
+        min_delay: float = 0.05,
+        metric_key: Callable[[Hashable], str] = str
+    ):
+        """
+        Args:
+            name: 对冲器名称
+            enabled: 是否启用对冲,关闭时只记录延迟
+            budget: 对冲请求占总请求的最大比例
+            quantile: 触发对冲的延迟分位数
+            min_samples: 样本数不足时不对冲
+            min_delay: 最小对冲延迟(秒)
+            metric_key: 键在指标中的标签值(键来自请求时用于汇总,避免时间序列无限增长)
+        """
+        self.name = name
+        self.enabled = enabled
+        self.budget = budget
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.metric_key = metric_key
+        self._stats: Dict[Hashable, _KeyStats] = {}
+        hedgers[name] = self
+
+    def _get_stats(self, key: Hashable) -> _KeyStats:
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _KeyStats(self.WINDOW)
+        return stats
+
+    def hedge_delay(self, key: Hashable) -> Optional[float]:
+        """返回该键的对冲延迟(秒),样本不足时返回None"""
+        stats = self._stats.get(key)
+        if stats is None or len(stats.latencies) < self.min_samples:
+            return None
+        ordered = sorted(stats.latencies)
+        rank = max(1, math.ceil(self.quantile * len(ordered)))
+        return max(self.min_delay, ordered[rank - 1])
+
+    async def do(self, key: Hashable, factory: Callable[[Optional[HedgeAttempt]], Awaitable[T]]) -> T:
+        """
+        执行首次调用,请求发出后超过对冲延迟仍未返回时发送对冲请求
+
+        只统计首次调用的上游延迟(不含本地限流和并发排队),对冲延迟也从请求发出时开始计算,
+        因此本地排队不会触发对冲;对冲请求的延迟不计入统计。
+
+        Args:
+            key: 延迟统计的键(如知识库ID)
+            factory: 创建实际调用的函数,可能被调用两次;首次调用传入 HedgeAttempt,对冲调用传入None
+
+        Returns:
+            T: 先成功返回的调用结果
+        """
+        stats = self._get_stats(key)
+        stats.requests += 1
+        delay = self.hedge_delay(key) if self.enabled else None
+
+        attempt = HedgeAttempt(stats.latencies)
+        primary = asyncio.create_task(factory(attempt))
+        tasks = [primary]
+        try:
+            if delay is None:
+                return await asyncio.shield(primary)
+
+            # 等待首次调用真正发出(或在排队中结束)
+            started = asyncio.create_task(attempt.started.wait())
+            try:
+                await asyncio.wait([primary, started], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                started.cancel()
+            if primary.done():
+                return primary.result()
+
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return primary.result()
+
+            if stats.hedged + 1 > self.budget * stats.requests:
+                stats.budget_exhausted += 1
+                return await asyncio.shield(primary)
+
+            stats.hedged += 1
+            hedge = asyncio.create_task(factory(None))
+            tasks.append(hedge)
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            stats.won += 1
+                            attempt.record_cancelled()
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # 取消较慢的一方(以及调用方被取消时的所有调用)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回各键的对冲统计信息"""
+        snapshot = {}
+        for key, stats in self._stats.items():
+            delay = self.hedge_delay(key)
+            snapshot[str(key)] = {
+                "requests": stats.requests,
+                "hedged": stats.hedged,
+                "won": stats.won,
+                "budget_exhausted": stats.budget_exhausted,
+                "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None
+            }
+        return snapshot
+
+
+def _hedge_counts() -> Dict[tuple, float]:
+    """对冲计数指标回调(标签值相同的键累加)"""
+    values: Dict[tuple, float] = {}
+    for name, hedger in hedgers.items():
+        for key, stats in hedger._stats.items():
+            label = hedger.metric_key(key)
+            outcomes = {"sent": stats.hedged, "won": stats.won, "budget_exhausted": stats.budget_exhausted}
+            for outcome, count in outcomes.items():
+                values[(name, label, outcome)] = values.get((name, label, outcome), 0) + count
+    return values
+
+
+def _hedge_delays() -> Dict[tuple, float]:
+    """对冲延迟指标回调(标签值相同的键取最大值)"""
+    values: Dict[tuple, float] = {}
+    for name, hedger in hedgers.items():
+        for key in hedger._stats:
+            delay = hedger.hedge_delay(key)
+            if delay is not None:
+                label = (name, hedger.metric_key(key))
+                values[label] = max(values.get(label, 0.0), delay)
+    return values
+
+
+registry.callback(
+    "hedge_requests_total",
+    "Hedged requests sent, won by the hedge, or skipped for lack of budget",
+    ["upstream", "key", "outcome"],
+    _hedge_counts,
+    type="counter"
+)
+registry.callback(
+    "hedge_delay_seconds",
+    "Current latency quantile after which a hedge is sent",
+    ["upstream", "key"],
+    _hedge_delays
+)
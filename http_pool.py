@@ -0,0 +1,118 @@
+from typing import Dict, Optional, Tuple, Union
+import time
+import httpx
+from config import settings
+from metrics import registry, upstream_responses_total, upstream_duration
+
+
+def _http2_available() -> bool:
+    """检查是否安装了HTTP/2依赖(h2)"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """记录上游状态码和延迟的传输层"""
+
+    def __init__(self, upstream: str, transport: httpx.AsyncHTTPTransport):
+        self.upstream = upstream
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start_time = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TimeoutException:
+            upstream_responses_total.inc(self.upstream, "timeout")
+            raise
+        except httpx.TransportError:
+            upstream_responses_total.inc(self.upstream, "error")
+            raise
+        upstream_duration.observe(time.perf_counter() - start_time, self.upstream)
+        upstream_responses_total.inc(self.upstream, str(response.status_code))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def pool_stats(self) -> Optional[Tuple[int, int]]:
+        """
+        返回连接池中 (活跃连接数, 空闲连接数)
+
+        连接池是httpx/httpcore的内部实现,结构不同(如升级后)时返回None,不输出连接池指标。
+        """
+        pool = getattr(self.transport, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None:
+            return None
+        try:
+            connections = list(connections)
+            idle = sum(1 for conn in connections if conn.is_idle())
+        except (AttributeError, TypeError):
+            return None
+        return len(connections) - idle, idle
+
+
+# 各上游当前使用的传输层,用于连接池指标
+transports: Dict[str, InstrumentedTransport] = {}
+
+
+def create_http_client(
+    upstream: str,
+    timeout: Union[float, httpx.Timeout],
+    max_connections: int
+) -> httpx.AsyncClient:
+    """
+    创建带连接池的长连接HTTP客户端
+
+    每个上游服务持有一个客户端实例,在应用生命周期内复用TCP/TLS连接。
+
+    Args:
+        upstream: 上游名称(用于指标)
+        timeout: 默认超时配置
+        max_connections: 该上游允许的最大并发连接数
+
+    Returns:
+        httpx.AsyncClient: 复用连接的异步HTTP客户端
+    """
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=min(settings.http_max_keepalive_connections, max_connections),
+        keepalive_expiry=settings.http_keepalive_expiry
+    )
+
+    http2 = settings.http2_enabled
+    if http2 and not _http2_available():
+        print("[HTTP] 警告: 已启用HTTP/2但未安装h2依赖,回退到HTTP/1.1 (pip install 'httpx[http2]')")
+        http2 = False
+
+    transport = InstrumentedTransport(
+        upstream,
+        httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+    )
+    transports[upstream] = transport
+    return httpx.AsyncClient(timeout=timeout, transport=transport)
+
+
+def _pool_connections() -> Dict[Tuple[str, ...], float]:
+    """连接池指标回调"""
+    values = {}
+    for upstream, transport in transports.items():
+        stats = transport.pool_stats()
+        if stats is None:
+            continue
+        active, idle = stats
+        values[(upstream, "active")] = active
+        values[(upstream, "idle")] = idle
+    return values
+
+
+registry.callback(
+    "http_pool_connections",
+    "Pooled upstream connections by state",
+    ["upstream", "state"],
+    _pool_connections
+)
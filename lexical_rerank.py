@@ -0,0 +1,304 @@
+from typing import List, Tuple
+import numpy as np
+from models import DocumentSegment
+
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 倒数排名融合(RRF)的平滑常数
+RRF_K = 60.0
+
+# 中日韩统一表意文字(含扩展A和兼容区),均在基本多文种平面内
+_CJK_RANGES = ((0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF))
+_TABLE_SIZE = 0x10000
+
+# 英文/数字词按多项式哈希编码,最高位标记以区别于汉字单字和双字
+_WORD_FLAG = 1 << 62
+_HASH_BASE = 1000003
+_MAX_WORD_LENGTH = 64
+_POWERS = np.array(
+    [pow(_HASH_BASE, i, 1 << 61) for i in range(_MAX_WORD_LENGTH)],
+    dtype=np.int64
+)
+
+
+def _codes(text: str) -> np.ndarray:
+    """文本转为Unicode码点数组(孤立的代理字符保留为其码点)"""
+    return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32).astype(np.int64)
+
+
+def _is_cjk(codes: np.ndarray) -> np.ndarray:
+    mask = np.zeros(len(codes), dtype=bool)
+    for low, high in _CJK_RANGES:
+        mask |= (codes >= low) & (codes <= high)
+    return mask
+
+
+def _is_word_char(codes: np.ndarray) -> np.ndarray:
+    """小写字母和数字(文本已转小写)"""
+    return ((codes >= 0x61) & (codes <= 0x7A)) | ((codes >= 0x30) & (codes <= 0x39))
+
+
+def _cjk_terms(codes: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    提取汉字单字和相邻双字
+
+    Args:
+        codes: 码点数组
+        mask: 参与提取的字符
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 词ID和所在位置
+    """
+    pair = mask[:-1] & mask[1:]
+    ids = np.concatenate([codes[mask], (codes[:-1][pair] << 21) | codes[1:][pair]])
+    positions = np.concatenate([np.flatnonzero(mask), np.flatnonzero(pair)])
+    return ids, positions
+
+
+def _word_terms(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    提取英文/数字词(连续的字母数字),按前 _MAX_WORD_LENGTH 个字符哈希
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 词ID和词首位置
+    """
+    mask = _is_word_char(codes)
+    if not mask.any():
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    starts = mask.copy()
+    starts[1:] &= ~mask[:-1]
+    chars = np.flatnonzero(mask)
+    word_starts = np.flatnonzero(starts)
+    run_starts = np.flatnonzero(starts[chars])
+    offsets = chars - word_starts[np.cumsum(starts[chars]) - 1]
+    weights = np.where(offsets < _MAX_WORD_LENGTH, _POWERS[np.minimum(offsets, _MAX_WORD_LENGTH - 1)], 0)
+    hashes = np.add.reduceat(codes[chars] * weights, run_starts)
+    return (hashes & (_WORD_FLAG - 1)) | _WORD_FLAG, word_starts
+
+
+def bm25_scores(query: str, documents: List[str], k1: float = BM25_K1, b: float = BM25_B) -> np.ndarray:
+    """
+    计算文档相对查询的BM25分数(以候选文档集合计算IDF)
+
+    中文按单字和相邻双字切分,英文和数字按词切分;所有文档拼接后一次性向量化统计词频。
+
+    Args:
+        query: 查询文本
+        documents: 文档内容列表
+        k1: 词频饱和参数
+        b: 文档长度归一化参数
+
+    Returns:
+        np.ndarray: 每个文档的BM25分数
+    """
+    count = len(documents)
+    if count == 0:
+        return np.zeros(0)
+
+    query_codes = _codes(query.lower())
+    query_cjk = _is_cjk(query_codes)
+    query_ids = np.concatenate([_cjk_terms(query_codes, query_cjk)[0], _word_terms(query_codes)[0]])
+    if len(query_ids) == 0:
+        return np.zeros(count)
+    vocab, query_tf = np.unique(query_ids, return_counts=True)
+
+    # 以换行拼接(换行既不是汉字也不是字母数字,不会产生跨文档的词)
+    lowered = [document.lower() for document in documents]
+    codes = _codes("\n".join(lowered))
+    lengths = np.fromiter(map(len, lowered), dtype=np.int64, count=count) + 1
+    owners = np.repeat(np.arange(count), lengths)[:len(codes)]
+
+    # 只统计查询中出现过的汉字,减少需要查找的词
+    cjk = _is_cjk(codes)
+    query_chars = np.zeros(_TABLE_SIZE, dtype=bool)
+    query_chars[query_codes[query_cjk]] = True
+    candidates = cjk.copy()
+    candidates[cjk] = query_chars[codes[cjk]]
+
+    cjk_ids, cjk_positions = _cjk_terms(codes, candidates)
+    word_ids, word_positions = _word_terms(codes)
+    ids = np.concatenate([cjk_ids, word_ids])
+    positions = np.concatenate([cjk_positions, word_positions])
+
+    index = np.searchsorted(vocab, ids)
+    index[index == len(vocab)] = 0
+    hit = vocab[index] == ids
+    term_count = len(vocab)
+    tf = np.bincount(
+        owners[positions[hit]] * term_count + index[hit],
+        minlength=count * term_count
+    ).reshape(count, term_count).astype(np.float64)
+
+    # 文档长度: 汉字数 + 词数
+    doc_lengths = (
+        np.bincount(owners[cjk], minlength=count) + np.bincount(owners[word_positions], minlength=count)
+    ).astype(np.float64)
+    average_length = max(doc_lengths.mean(), 1.0)
+
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((count - df + 0.5) / (df + 0.5))
+    norm = k1 * (1.0 - b + b * doc_lengths / average_length)
+    return (tf * (k1 + 1.0) / (tf + norm[:, None])) @ (idf * query_tf)
+
+
+def match_positions(query: str, text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    查找文本中与查询共有的词(汉字单字、相邻双字和英文/数字词)
+
+    每个词的权重为 1/该词在文本中的出现次数,即文本中罕见的查询词权重更高,
+    任意区间内的权重和近似于该区间覆盖的查询词数。
+
+    Args:
+        query: 查询文本
+        text: 待查找的文本
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 命中的位置(text中的字符下标)和权重
+    """
+    query_codes = _codes(query.lower())
+    query_cjk = _is_cjk(query_codes)
+    vocab = np.unique(np.concatenate([_cjk_terms(query_codes, query_cjk)[0], _word_terms(query_codes)[0]]))
+    if len(vocab) == 0 or not text:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    # 只把ASCII字母转为小写,保持位置与原文一一对应
+    codes = _codes(text)
+    codes = np.where((codes >= 0x41) & (codes <= 0x5A), codes + 0x20, codes)
+    cjk = _is_cjk(codes)
+    query_chars = np.zeros(_TABLE_SIZE, dtype=bool)
+    query_chars[query_codes[query_cjk]] = True
+    candidates = cjk.copy()
+    candidates[cjk] = query_chars[codes[cjk]]
+
+    cjk_ids, cjk_positions = _cjk_terms(codes, candidates)
+    word_ids, word_positions = _word_terms(codes)
+    ids = np.concatenate([cjk_ids, word_ids])
+    positions = np.concatenate([cjk_positions, word_positions])
+    index = np.searchsorted(vocab, ids)
+    index[index == len(vocab)] = 0
+    hit = vocab[index] == ids
+    if not hit.any():
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    terms = index[hit]
+    counts = np.bincount(terms, minlength=len(vocab))
+    return positions[hit], 1.0 / counts[terms]
+
+
+def hashed_term_matrix(texts: List[str], bits: int = 10) -> np.ndarray:
+    """
+    文本的词频矩阵(汉字单字、相邻双字和英文/数字词按哈希分到 2^bits 个桶)
+
+    Args:
+        texts: 文本列表
+        bits: 哈希桶数的位数
+
+    Returns:
+        np.ndarray: (文本数, 2^bits) 的词频矩阵
+    """
+    count = len(texts)
+    dims = 1 << bits
+    if count == 0:
+        return np.zeros((0, dims), dtype=np.float32)
+
+    lowered = [text.lower() for text in texts]
+    codes = _codes("\n".join(lowered))
+    lengths = np.fromiter(map(len, lowered), dtype=np.int64, count=count) + 1
+    owners = np.repeat(np.arange(count), lengths)[:len(codes)]
+
+    cjk_ids, cjk_positions = _cjk_terms(codes, _is_cjk(codes))
+    word_ids, word_positions = _word_terms(codes)
+    ids = np.concatenate([cjk_ids, word_ids]).astype(np.uint64)
+    positions = np.concatenate([cjk_positions, word_positions])
+    # 乘法哈希,取高位作为桶号
+    buckets = ((ids * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - bits)).astype(np.int64)
+    return np.bincount(
+        owners[positions] * dims + buckets,
+        minlength=count * dims
+    ).reshape(count, dims).astype(np.float32)
+
+
+def reciprocal_rank_fusion(*scores: np.ndarray, k: float = RRF_K) -> np.ndarray:
+    """
+    倒数排名融合: 每组分数按降序排名,累加 1/(k+排名)
+
+    不同来源的分数尺度不可比(如各知识库的Dify分数与BM25分数),只使用排名;同分的取平均排名。
+
+    Args:
+        scores: 各来源的分数数组(长度相同)
+        k: 平滑常数
+
+    Returns:
+        np.ndarray: 融合后的分数
+    """
+    fused = np.zeros(len(scores[0]))
+    for values in scores:
+        fused += 1.0 / (k + _average_ranks(values))
+    return fused
+
+
+def _average_ranks(values: np.ndarray) -> np.ndarray:
+    """按降序排名(从1开始),同分的取平均排名"""
+    order = np.argsort(-values, kind="stable")
+    ordered = values[order]
+    group_starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    group_ends = np.r_[group_starts[1:], len(values)]
+    groups = np.repeat(np.arange(len(group_starts)), group_ends - group_starts)
+    ranks = np.empty(len(values))
+    ranks[order] = ((group_starts + group_ends + 1) / 2.0)[groups]
+    return ranks
+
+
+def cascade_prefilter(query: str, segments: List[DocumentSegment], keep: int) -> List[DocumentSegment]:
+    """
+    级联重排序的第一阶段: 融合Dify分数和BM25的排名,只保留前 keep 个候选
+
+    Args:
+        query: 查询文本
+        segments: 候选文档片段
+        keep: 保留的候选数量
+
+    Returns:
+        List[DocumentSegment]: 按融合排名排序的候选(不修改原片段)
+    """
+    if len(segments) <= keep:
+        return segments
+    lexical = bm25_scores(query, [seg.content for seg in segments])
+    dify_scores = np.array([seg.score for seg in segments])
+    fused = reciprocal_rank_fusion(dify_scores, lexical)
+    return [segments[index] for index in np.argsort(-fused, kind="stable")[:keep]]
+
+
+def lexical_rerank(query: str, segments: List[DocumentSegment], top_k: int) -> List[DocumentSegment]:
+    """
+    使用本地BM25对文档片段重排序(不修改原片段)
+
+    分数归一化为相对最高分的比例;与查询没有共同词的片段按Dify分数排在后面,
+    所有片段都没有共同词时保持Dify分数和排序。
+
+    Args:
+        query: 查询文本
+        segments: 待排序的文档片段列表
+        top_k: 返回的top-k结果数量
+
+    Returns:
+        List[DocumentSegment]: 重排序后的文档片段
+    """
+    if not segments:
+        return []
+
+    scores = bm25_scores(query, [seg.content for seg in segments])
+    dify_scores = np.array([seg.score for seg in segments])
+    order = np.lexsort((-dify_scores, -scores))[:top_k]
+
+    best = scores.max()
+    if best <= 0:
+        return [segments[index] for index in order]
+    return [
+        segments[index].model_copy(update={"score": float(scores[index] / best)})
+        for index in order
+    ]
@@ -1,8 +1,122 @@
+import asyncio
 import json
-from typing import List
+from typing import List, Optional, Any, AsyncIterator, Tuple, Union
 import httpx
+from pydantic import ValidationError
 from models import DatasetInfo, LLMDecision, RetrievalQuery
 from config import settings
+from http_pool import create_http_client
+from cache import TTLCache, normalize_text, hash_text
+from singleflight import SingleFlight
+from metrics import fallbacks_total
+from deadline import Deadline
+from circuit_breaker import CircuitOpenError, upstream_breaker
+from rate_limit import RateGovernor, RateLimitedError, key_pool
+from document_condenser import document_condenser
+
+
+class DecisionStreamParser:
+    """
+    LLM判断结果的增量JSON解析器
+
+    逐块输入流式返回的文本,在 retrieval_queries 数组中的每个对象闭合时立即产出,
+    并在读到 need_retrieval 的取值时立即报告。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.need_retrieval: Optional[bool] = None
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_key: Optional[str] = None
+        self._key: Optional[str] = None
+        self._scalar: Optional[str] = None
+        self._object_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """
+        输入一段文本,返回新解析出的事件
+
+        Args:
+            chunk: 新收到的文本片段
+
+        Returns:
+            List[Tuple[str, Any]]: 事件列表, ("need_retrieval", bool) 或 ("query", dict)
+        """
+        self.text += chunk
+        events: List[Tuple[str, Any]] = []
+
+        while self._pos < len(self.text):
+            i = self._pos
+            ch = self.text[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        try:
+                            self._last_key = json.loads(self.text[self._string_start:i + 1])
+                        except json.JSONDecodeError:
+                            self._last_key = None
+                continue
+
+            # 顶层对象开始之前的内容直接忽略
+            if not self._stack and ch != "{":
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+                if len(self._stack) == 1:
+                    self._scalar = None
+            elif ch in "{[":
+                if self._stack == ["{", "["] and ch == "{" and self._key == "retrieval_queries":
+                    self._object_start = i
+                if len(self._stack) == 1:
+                    self._scalar = None
+                self._stack.append(ch)
+            elif ch in "}]":
+                if len(self._stack) == 1:
+                    self._finish_scalar(events)
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._stack == ["{", "["] and self._object_start is not None:
+                    try:
+                        events.append(("query", json.loads(self.text[self._object_start:i + 1])))
+                    except json.JSONDecodeError:
+                        pass
+                    self._object_start = None
+            elif len(self._stack) == 1:
+                if ch == ":":
+                    self._key = self._last_key
+                    self._scalar = ""
+                elif ch == ",":
+                    self._finish_scalar(events)
+                elif self._scalar is not None and not ch.isspace():
+                    self._scalar += ch
+                    # 不等待分隔符,读到完整的布尔值立即报告
+                    self._finish_scalar(events, complete=False)
+
+        return events
+
+    def _finish_scalar(self, events: List[Tuple[str, Any]], complete: bool = True):
+        """处理顶层标量值"""
+        if self._scalar is None:
+            return
+        if self._key == "need_retrieval" and self.need_retrieval is None and self._scalar in ("true", "false"):
+            self.need_retrieval = self._scalar == "true"
+            events.append(("need_retrieval", self.need_retrieval))
+            self._scalar = None
+        elif complete:
+            self._scalar = None
 
 
 class LLMService:
@@ -11,7 +125,41 @@ class LLMService:
     def __init__(self):
         self.api_base_url = settings.llm_api_base_url
         self.api_key = settings.llm_api_key
+        self.api_keys = key_pool(settings.llm_api_key, settings.llm_api_key_pool)
         self.model = settings.llm_model
+        self.timeout = 30.0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight = SingleFlight("llm", enabled=settings.singleflight_enabled)
+        self._governor = RateGovernor(
+            "llm",
+            rate=settings.llm_rate_limit,
+            burst=settings.llm_rate_burst,
+            max_wait=settings.rate_limit_max_wait
+        )
+        self.decision_cache: Optional[TTLCache] = None
+        if settings.decision_cache_enabled:
+            self.decision_cache = TTLCache(
+                "decision",
+                ttl=settings.decision_cache_ttl,
+                max_size=settings.decision_cache_max_size
+            )
+
+    async def start(self):
+        """创建长连接HTTP客户端(应用启动时调用)"""
+        if self._client is None:
+            self._client = create_http_client("llm", self.timeout, settings.llm_max_connections)
+
+    async def close(self):
+        """关闭HTTP客户端(应用关闭时调用)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """获取共享HTTP客户端,未启动时按需创建"""
+        if self._client is None:
+            self._client = create_http_client("llm", self.timeout, settings.llm_max_connections)
+        return self._client
 
     def _create_system_prompt(self, datasets: List[DatasetInfo]) -> str:
         """创建系统提示词"""
@@ -48,8 +196,10 @@ class LLMService:
 - 查询语句应该提取问题的核心关键词和语义"""
 
     def _create_user_prompt(self, question: str, document: str = None) -> str:
-        """创建用户提示词"""
+        """创建用户提示词(过长的文档只保留与问题最相关的句子)"""
         if document:
+            if settings.document_llm_max_tokens > 0:
+                document = document_condenser.condense(document, question, settings.document_llm_max_tokens)
             return f"""相关文档内容:
 {document}
 
@@ -63,11 +213,73 @@ class LLMService:
 
 请分析是否需要从知识库检索信息。"""
 
+    def _build_payload(self, question: str, datasets: List[DatasetInfo], document: str = None, stream: bool = False) -> dict:
+        """构建chat/completions请求体"""
+        payload = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": self._create_system_prompt(datasets)},
+                {"role": "user", "content": self._create_user_prompt(question, document)}
+            ],
+            "temperature": 0.3,
+            "response_format": {"type": "json_object"}
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _headers(self, api_key: str) -> dict:
+        """构建请求头"""
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _fallback_decision(self, question: str, datasets: List[DatasetInfo]) -> LLMDecision:
+        """出错时的默认判断: 需要检索,并对所有知识库使用原始问题"""
+        return LLMDecision(
+            need_retrieval=True,
+            retrieval_queries=[
+                RetrievalQuery(dataset_id=ds.dataset_id, query=question)
+                for ds in datasets
+            ],
+            reason=None
+        )
+
+    def _cache_key(self, question: str, datasets: List[DatasetInfo], document: str = None) -> tuple:
+        """生成判断结果缓存键: 归一化问题 + 文档哈希 + 知识库 + 模型"""
+        dataset_key = tuple(sorted(
+            (ds.dataset_id, normalize_text(ds.description)) for ds in datasets
+        ))
+        document_hash = hash_text(normalize_text(document)) if document else None
+        return normalize_text(question), document_hash, dataset_key, self.model
+
+    def has_cached_decision(self, question: str, datasets: List[DatasetInfo], document: str = None) -> bool:
+        """判断是否已缓存该问题的判断结果"""
+        if self.decision_cache is None:
+            return False
+        return self.decision_cache.contains(self._cache_key(question, datasets, document))
+
+    def _get_cached_decision(self, cache_key: tuple) -> Optional[LLMDecision]:
+        """读取缓存的判断结果(返回副本)"""
+        if self.decision_cache is None:
+            return None
+        decision = self.decision_cache.get(cache_key)
+        if decision is None:
+            return None
+        return decision.model_copy(deep=True)
+
+    def _set_cached_decision(self, cache_key: tuple, decision: LLMDecision):
+        """缓存判断结果"""
+        if self.decision_cache is not None:
+            self.decision_cache.set(cache_key, decision.model_copy(deep=True))
+
     async def decide_retrieval(
         self,
         question: str,
         datasets: List[DatasetInfo],
-        document: str = None
+        document: str = None,
+        deadline: Optional[Deadline] = None
     ) -> LLMDecision:
         """
         判断是否需要检索以及生成检索查询
@@ -76,70 +288,216 @@ class LLMService:
             question: 用户问题
             datasets: 可用的知识库列表
             document: 相关文档(可选)
+            deadline: 该阶段的截止时间(可选),超时后返回默认判断
 
         Returns:
             LLMDecision: 判断结果
         """
-        system_prompt = self._create_system_prompt(datasets)
-        user_prompt = self._create_user_prompt(question, document)
+        cache_key = self._cache_key(question, datasets, document)
+        cached = self._get_cached_decision(cache_key)
+        if cached is not None:
+            return cached
 
+        # 相同的并发判断请求共享同一次LLM调用
+        call = self._inflight.do(
+            cache_key,
+            lambda: self._request_decision(cache_key, question, datasets, document, deadline)
+        )
+        if deadline is None:
+            decision = await call
+        else:
+            try:
+                decision = await asyncio.wait_for(call, timeout=deadline.remaining())
+            except asyncio.TimeoutError:
+                print("[LLM] 超出时间预算,使用默认判断")
+                fallbacks_total.inc("llm", "deadline")
+                return self._fallback_decision(question, datasets)
+        return decision.model_copy(deep=True)
+
+    async def _request_decision(
+        self,
+        cache_key: tuple,
+        question: str,
+        datasets: List[DatasetInfo],
+        document: str = None,
+        deadline: Optional[Deadline] = None
+    ) -> LLMDecision:
+        """调用LLM获取判断结果,成功时写入缓存,失败时返回默认判断"""
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.api_base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        "temperature": 0.3,
-                        "response_format": {"type": "json_object"}
-                    }
+            client = self._get_client()
+            async with upstream_breaker.guard("llm"):
+                # 从Key池中选择可用的Key排队,收到429时按Retry-After等待后重试
+                response = await self._governor.send(
+                    self.api_keys,
+                    lambda api_key: client.post(
+                        f"{self.api_base_url}/chat/completions",
+                        headers=self._headers(api_key),
+                        json=self._build_payload(question, datasets, document),
+                        timeout=deadline.clamp(self.timeout) if deadline is not None else self.timeout,
+                        extensions={"deadline": deadline}
+                    ),
+                    max_wait=deadline.remaining() if deadline is not None else None
                 )
                 response.raise_for_status()
 
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                # 解析JSON响应
-                decision_data = json.loads(content)
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
 
-                return LLMDecision(
-                    need_retrieval=decision_data.get("need_retrieval", False),
-                    retrieval_queries=[
-                        RetrievalQuery(**query)
-                        for query in decision_data.get("retrieval_queries", [])
-                    ],
-                    reason=None
-                )
+            # 解析JSON响应
+            decision_data = json.loads(content)
 
-        except httpx.HTTPError as e:
-            print(f"[LLM] API请求失败: {e}")
-            # 发生错误时默认需要检索，使用原始问题
-            return LLMDecision(
-                need_retrieval=True,
+            decision = LLMDecision(
+                need_retrieval=decision_data.get("need_retrieval", False),
                 retrieval_queries=[
-                    RetrievalQuery(dataset_id=ds.dataset_id, query=question)
-                    for ds in datasets
+                    RetrievalQuery(**query)
+                    for query in decision_data.get("retrieval_queries", [])
                 ],
                 reason=None
             )
+            self._set_cached_decision(cache_key, decision)
+            return decision
+
+        except CircuitOpenError as e:
+            print(f"[LLM] {e},使用默认判断")
+            fallbacks_total.inc("llm", "circuit_open")
+            return self._fallback_decision(question, datasets)
+        except RateLimitedError as e:
+            print(f"[LLM] {e},使用默认判断")
+            fallbacks_total.inc("llm", "rate_limited")
+            return self._fallback_decision(question, datasets)
+        except httpx.HTTPError as e:
+            print(f"[LLM] API请求失败: {e}")
+            fallbacks_total.inc("llm", "http_error")
+            # 发生错误时默认需要检索，使用原始问题
+            return self._fallback_decision(question, datasets)
         except (json.JSONDecodeError, KeyError) as e:
             print(f"[LLM] 解析响应失败: {e}")
+            fallbacks_total.inc("llm", "parse_error")
             # 解析失败时默认需要检索
-            return LLMDecision(
-                need_retrieval=True,
-                retrieval_queries=[
-                    RetrievalQuery(dataset_id=ds.dataset_id, query=question)
-                    for ds in datasets
-                ],
-                reason=None
+            return self._fallback_decision(question, datasets)
+
+    async def stream_decision(
+        self,
+        question: str,
+        datasets: List[DatasetInfo],
+        document: str = None,
+        deadline: Optional[Deadline] = None
+    ) -> AsyncIterator[Union[RetrievalQuery, LLMDecision]]:
+        """
+        流式判断是否需要检索,每生成一个检索查询立即产出
+
+        依次产出 RetrievalQuery (每个查询对象闭合时),最后产出完整的 LLMDecision。
+        读到 "need_retrieval": false 时立即产出判断结果并结束,不再等待剩余输出。
+        超出截止时间时停止读取,使用已产出的查询(没有时使用默认判断)。
+
+        Args:
+            question: 用户问题
+            datasets: 可用的知识库列表
+            document: 相关文档(可选)
+            deadline: 该阶段的截止时间(可选)
+
+        Yields:
+            Union[RetrievalQuery, LLMDecision]: 检索查询或最终判断结果
+        """
+        cache_key = self._cache_key(question, datasets, document)
+        cached = self._get_cached_decision(cache_key)
+        if cached is not None:
+            for query in cached.retrieval_queries:
+                yield query
+            yield cached
+            return
+
+        parser = DecisionStreamParser()
+        queries: List[RetrievalQuery] = []
+        failed = False
+
+        try:
+            client = self._get_client()
+            api_key = await self._governor.acquire(
+                self.api_keys,
+                max_wait=deadline.remaining() if deadline is not None else None
             )
+            async with upstream_breaker.guard("llm"), client.stream(
+                "POST",
+                f"{self.api_base_url}/chat/completions",
+                headers=self._headers(api_key),
+                json=self._build_payload(question, datasets, document, stream=True),
+                timeout=deadline.clamp(self.timeout) if deadline is not None else self.timeout,
+                extensions={"deadline": deadline}
+            ) as response:
+                self._governor.observe(api_key, response)
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if deadline is not None and deadline.expired:
+                        print("[LLM] 超出时间预算,停止读取流式响应")
+                        fallbacks_total.inc("llm", "deadline")
+                        failed = True
+                        break
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+
+                    chunk = json.loads(data)
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta", {}).get("content") or ""
+
+                    for event, value in parser.feed(delta):
+                        if event == "need_retrieval" and value is False:
+                            # 不需要检索,立即结束
+                            decision = LLMDecision(need_retrieval=False, retrieval_queries=[], reason=None)
+                            self._set_cached_decision(cache_key, decision)
+                            yield decision
+                            return
+                        if event == "query":
+                            try:
+                                query = RetrievalQuery(**value)
+                            except (ValidationError, TypeError) as e:
+                                print(f"[LLM] 忽略无效的检索查询: {e}")
+                                continue
+                            queries.append(query)
+                            yield query
+
+            if not failed and parser.need_retrieval is None:
+                # 流结束仍未读到判断结果,按完整JSON再解析一次
+                decision_data = json.loads(parser.text)
+                if not decision_data.get("need_retrieval", False):
+                    decision = LLMDecision(need_retrieval=False, retrieval_queries=[], reason=None)
+                    self._set_cached_decision(cache_key, decision)
+                    yield decision
+                    return
+
+        except CircuitOpenError as e:
+            print(f"[LLM] {e},使用默认判断")
+            fallbacks_total.inc("llm", "circuit_open")
+            failed = True
+        except RateLimitedError as e:
+            print(f"[LLM] {e},使用默认判断")
+            fallbacks_total.inc("llm", "rate_limited")
+            failed = True
+        except httpx.HTTPError as e:
+            print(f"[LLM] 流式API请求失败: {e}")
+            fallbacks_total.inc("llm", "http_error")
+            failed = True
+        except (json.JSONDecodeError, KeyError, IndexError, AttributeError) as e:
+            print(f"[LLM] 解析流式响应失败: {e}")
+            fallbacks_total.inc("llm", "parse_error")
+            failed = True
+
+        if failed and not queries:
+            # 出错且尚未产出任何查询时,默认对所有知识库使用原始问题
+            fallback = self._fallback_decision(question, datasets)
+            for query in fallback.retrieval_queries:
+                yield query
+            yield fallback
+            return
+
+        decision = LLMDecision(need_retrieval=True, retrieval_queries=queries, reason=None)
+        if not failed:
+            self._set_cached_decision(cache_key, decision)
+        yield decision
 
 
 # 创建全局实例
@@ -0,0 +1,305 @@
+"""
+开环压测工具 - 以固定到达率驱动 /api/v1/retrieve 并输出延迟报告
+
+按预先计算的到达时间发送请求(泊松或恒定间隔),不等待上一个请求完成,
+延迟从"计划发送时间"开始计算,从而校正协调遗漏(coordinated omission)。
+各阶段耗时取自服务端返回的 Server-Timing 响应头。
+
+使用方法:
+    python load_test.py --url http://localhost:8000 --rate 20 --duration 60 \\
+        --templates examples.json --output results.json --label baseline
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def load_templates(path: str) -> List[Dict[str, Any]]:
+    """
+    加载请求模板
+
+    支持:
+    - examples.json 格式(收集所有 "request" 字段)
+    - 请求对象数组
+    - JSONL(每行一个请求对象)
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    templates: List[Dict[str, Any]] = []
+
+    def collect(node: Any):
+        if isinstance(node, dict):
+            if "request" in node and isinstance(node["request"], dict):
+                templates.append(node["request"])
+            elif "datasets" in node and "question" in node:
+                templates.append(node)
+            else:
+                for value in node.values():
+                    collect(value)
+        elif isinstance(node, list):
+            for item in node:
+                collect(item)
+
+    collect(data)
+    if not templates:
+        raise ValueError(f"未在 {path} 中找到请求模板")
+    return templates
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """解析 Server-Timing 响应头,返回各阶段耗时(秒)"""
+    timings: Dict[str, float] = {}
+    if not header:
+        return timings
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    timings[name] = float(value) / 1000.0
+                except ValueError:
+                    pass
+    return timings
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """计算延迟统计(毫秒)"""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    summary = {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2)
+    }
+    for p in PERCENTILES:
+        summary[f"p{p:g}_ms"] = round(percentile(values, p) * 1000, 2)
+    return summary
+
+
+class LoadTest:
+    """开环压测"""
+
+    def __init__(self, args: argparse.Namespace, templates: List[Dict[str, Any]]):
+        self.args = args
+        self.templates = templates
+        self.rng = random.Random(args.seed)
+        self.results: List[Dict[str, Any]] = []
+        self.in_flight = 0
+        self.max_in_flight_seen = 0
+
+    def schedule(self) -> List[float]:
+        """生成相对开始时间的计划发送时间"""
+        times = []
+        t = 0.0
+        interval = 1.0 / self.args.rate
+        while True:
+            if self.args.arrival == "poisson":
+                t += self.rng.expovariate(self.args.rate)
+            else:
+                t += interval
+            if t >= self.args.duration:
+                return times
+            times.append(t)
+
+    async def send(self, client: httpx.AsyncClient, intended_at: float, offset: float):
+        """发送一次请求并记录结果"""
+        template = self.rng.choice(self.templates)
+        sent_at = time.perf_counter()
+        record: Dict[str, Any] = {"offset": offset, "send_lag": sent_at - intended_at}
+
+        self.in_flight += 1
+        self.max_in_flight_seen = max(self.max_in_flight_seen, self.in_flight)
+        try:
+            response = await client.post(f"{self.args.url}/api/v1/retrieve", json=template)
+            record["status"] = response.status_code
+            record["stages"] = parse_server_timing(response.headers.get("server-timing"))
+            if response.status_code != 200:
+                record["error"] = f"http_{response.status_code}"
+            else:
+                body = response.json()
+                if not body.get("success"):
+                    record["error"] = "app_error: " + str(body.get("error") or "")[:60]
+        except httpx.TimeoutException:
+            record["error"] = "timeout"
+        except httpx.HTTPError as e:
+            record["error"] = type(e).__name__
+        finally:
+            self.in_flight -= 1
+
+        done_at = time.perf_counter()
+        # 从计划发送时间开始计算,校正协调遗漏
+        record["latency"] = done_at - intended_at
+        record["service_time"] = done_at - sent_at
+        self.results.append(record)
+
+    async def run(self) -> Dict[str, Any]:
+        """执行压测并返回报告"""
+        schedule = self.schedule()
+        limits = httpx.Limits(max_connections=self.args.max_connections, max_keepalive_connections=self.args.max_connections)
+        dropped = 0
+
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits) as client:
+            tasks = []
+            start = time.perf_counter()
+            for offset in schedule:
+                intended_at = start + offset
+                delay = intended_at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.in_flight >= self.args.max_in_flight:
+                    # 客户端自身过载,计入错误而不是静默跳过
+                    dropped += 1
+                    self.results.append({
+                        "offset": offset,
+                        "error": "client_overload",
+                        "latency": None
+                    })
+                    continue
+                tasks.append(asyncio.create_task(self.send(client, intended_at, offset)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - start
+
+        return self.report(len(schedule), elapsed, dropped)
+
+    def report(self, scheduled: int, elapsed: float, dropped: int) -> Dict[str, Any]:
+        """生成报告"""
+        measured = [r for r in self.results if r["offset"] >= self.args.warmup]
+        completed = [r for r in measured if r.get("latency") is not None]
+        succeeded = [r for r in completed if "error" not in r]
+
+        errors: Dict[str, int] = {}
+        for r in measured:
+            if "error" in r:
+                errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+        stages: Dict[str, List[float]] = {}
+        for r in succeeded:
+            for stage, value in r.get("stages", {}).items():
+                stages.setdefault(stage, []).append(value)
+
+        window = max(self.args.duration - self.args.warmup, 1e-9)
+        return {
+            "label": self.args.label,
+            "config": {
+                "url": self.args.url,
+                "rate": self.args.rate,
+                "arrival": self.args.arrival,
+                "duration": self.args.duration,
+                "warmup": self.args.warmup,
+                "templates": len(self.templates),
+                "seed": self.args.seed
+            },
+            "requests": {
+                "scheduled": scheduled,
+                "measured": len(measured),
+                "succeeded": len(succeeded),
+                "failed": len(measured) - len(succeeded),
+                "dropped": dropped,
+                "max_in_flight": self.max_in_flight_seen
+            },
+            "throughput": {
+                "offered_rps": round(len(measured) / window, 2),
+                "success_rps": round(len(succeeded) / window, 2),
+                "wall_time_s": round(elapsed, 2)
+            },
+            "latency": summarize([r["latency"] for r in succeeded]),
+            "service_time": summarize([r["service_time"] for r in succeeded]),
+            "send_lag": summarize([r["send_lag"] for r in completed]),
+            "stages": {stage: summarize(values) for stage, values in stages.items()},
+            "errors": errors
+        }
+
+
+def print_report(report: Dict[str, Any]):
+    """打印报告"""
+    print("\n" + "=" * 70)
+    print(f"📊 压测报告 {report['label'] or ''}")
+    print("=" * 70)
+    req = report["requests"]
+    tp = report["throughput"]
+    print(f"请求: 计划 {req['scheduled']}, 统计 {req['measured']}, 成功 {req['succeeded']}, "
+          f"失败 {req['failed']}, 丢弃 {req['dropped']}, 最大并发 {req['max_in_flight']}")
+    print(f"吞吐: 到达 {tp['offered_rps']} req/s, 成功 {tp['success_rps']} req/s")
+
+    header = f"{'':<14}" + "".join(f"{name:>11}" for name in ("count", "p50", "p90", "p99", "p99.9", "max"))
+    print("\n" + header)
+    rows = [("总延迟", report["latency"]), ("服务时间", report["service_time"])]
+    rows += [(f"  {stage}", summary) for stage, summary in report["stages"].items()]
+    for name, summary in rows:
+        if not summary.get("count"):
+            continue
+        values = [summary["count"]] + [summary[f"p{p:g}_ms"] for p in PERCENTILES] + [summary["max_ms"]]
+        print(f"{name:<14}" + "".join(f"{v:>11}" for v in values))
+    print("(延迟单位: 毫秒;总延迟从计划发送时间起算)")
+
+    if report["errors"]:
+        print("\n错误:")
+        for error, count in sorted(report["errors"].items(), key=lambda item: -item[1]):
+            print(f"   {count:>6}  {error}")
+    print("=" * 70 + "\n")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="/api/v1/retrieve 开环压测工具")
+    parser.add_argument("--url", default="http://localhost:8000", help="检索服务地址")
+    parser.add_argument("--rate", type=float, default=10.0, help="到达率(请求/秒)")
+    parser.add_argument("--duration", type=float, default=30.0, help="压测时长(秒)")
+    parser.add_argument("--warmup", type=float, default=0.0, help="预热时长(秒),此期间的请求不计入统计")
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson", help="到达过程")
+    parser.add_argument("--templates", default="examples.json", help="请求模板文件(JSON或JSONL)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="单个请求超时(秒)")
+    parser.add_argument("--max-connections", type=int, default=1000, help="客户端最大连接数")
+    parser.add_argument("--max-in-flight", type=int, default=10000, help="客户端最大未完成请求数,超出时记为client_overload")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--label", default="", help="本次压测的标签(如构建版本),写入结果文件")
+    parser.add_argument("--output", default=None, help="结果JSON输出路径")
+    return parser.parse_args(argv)
+
+
+async def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    templates = load_templates(args.templates)
+    print(f"🚀 压测开始: {args.rate} req/s ({args.arrival}), 持续 {args.duration}s, {len(templates)} 个请求模板")
+
+    report = await LoadTest(args, templates).run()
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit(130)
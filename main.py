@@ -1,14 +1,27 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Header, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from contextlib import asynccontextmanager
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager, aclosing
+from pydantic import BaseModel
+import json
 import time
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-from models import QueryRequest, RetrievalResponse, RetrievalQuery
+from models import QueryRequest, RetrievalResponse
 from llm_service import llm_service
 from dify_client import dify_client
 from rerank_service import rerank_service
+from speculative_retrieval import speculative_retriever
+from retrieval_pipeline import run_pipeline, EVENT_RESULT
+from cache import caches
+from singleflight import singleflights
+from hedging import hedgers
+from circuit_breaker import breakers
+from rate_limit import governors
+from adaptive_limit import limiters
+from rerank_batcher import batchers
+from rerank_sharding import sizers
+from metrics import registry
 from config import settings
 
 
@@ -21,8 +34,18 @@ async def lifespan(app: FastAPI):
     print(f"   - Dify API: {settings.dify_api_base_url}")
     print(f"   - LLM Model: {settings.llm_model}")
     print(f"   - Reranker Model: {settings.reranker_model_name}")
-    yield
-    print("👋 Dify知识库检索增强API关闭")
+
+    # 创建各上游服务的长连接池
+    await dify_client.start()
+    await llm_service.start()
+    await rerank_service.start()
+    try:
+        yield
+    finally:
+        await dify_client.close()
+        await llm_service.close()
+        await rerank_service.close()
+        print("👋 Dify知识库检索增强API关闭")
 
 
 # 创建FastAPI应用
@@ -52,6 +75,10 @@ async def root():
         "status": "running",
         "endpoints": {
             "retrieve": "/api/v1/retrieve",
+            "retrieve_stream": "/api/v1/retrieve/stream",
+            "stats": "/api/v1/stats",
+            "metrics": "/metrics",
+            "flush_cache": "/api/v1/admin/cache/flush",
             "health": "/health"
         }
     }
@@ -66,8 +93,84 @@ async def health_check():
     }
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus指标"""
+    return PlainTextResponse(
+        registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/api/v1/stats")
+async def get_stats():
+    """运行统计信息"""
+    return {
+        "speculative_retrieval": speculative_retriever.snapshot(),
+        "caches": {name: cache.snapshot() for name, cache in caches.items()},
+        "coalescing": {name: flight.snapshot() for name, flight in singleflights.items()},
+        "hedging": {name: hedger.snapshot() for name, hedger in hedgers.items()},
+        "circuit_breakers": {name: breaker.snapshot() for name, breaker in breakers.items()},
+        "rate_limits": {name: governor.snapshot() for name, governor in governors.items()},
+        "concurrency": {name: limiter.snapshot() for name, limiter in limiters.items()},
+        "rerank_batching": {name: batcher.snapshot() for name, batcher in batchers.items()},
+        "rerank_sharding": {name: sizer.snapshot() for name, sizer in sizers.items()}
+    }
+
+
+@app.post("/api/v1/admin/cache/flush")
+async def flush_cache(
+    cache: Optional[str] = None,
+    x_admin_key: Optional[str] = Header(None)
+):
+    """
+    清空缓存
+
+    Args:
+        cache: 缓存名称,为空时清空所有缓存
+    """
+    if settings.admin_api_key and x_admin_key != settings.admin_api_key:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="无效的管理密钥")
+
+    if cache is not None and cache not in caches:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"缓存不存在: {cache}")
+
+    names = [cache] if cache is not None else list(caches)
+    flushed = {name: caches[name].clear() for name in names}
+    print(f"[Admin] 清空缓存: {flushed}")
+    return {"success": True, "flushed": flushed}
+
+
+@app.post("/api/v1/admin/cache/datasets/{dataset_id}/invalidate")
+async def invalidate_dataset_cache(
+    dataset_id: str,
+    x_admin_key: Optional[str] = Header(None)
+):
+    """
+    删除某个知识库的检索结果缓存(知识库内容更新后调用)
+
+    Args:
+        dataset_id: 知识库ID
+    """
+    if settings.admin_api_key and x_admin_key != settings.admin_api_key:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="无效的管理密钥")
+
+    removed = dify_client.invalidate_dataset(dataset_id)
+    print(f"[Admin] 删除知识库缓存: {dataset_id} ({removed}条)")
+    return {"success": True, "dataset_id": dataset_id, "removed": removed}
+
+
+def _server_timing(timings: Dict[str, float]) -> str:
+    """格式化 Server-Timing 响应头(毫秒)"""
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings.items())
+
+
 @app.post("/api/v1/retrieve", response_model=RetrievalResponse)
-async def retrieve_knowledge(request: QueryRequest):
+async def retrieve_knowledge(
+    request: QueryRequest,
+    response: Response,
+    x_request_timeout: Optional[float] = Header(None)
+):
     """
     知识库检索增强接口
 
@@ -81,119 +184,77 @@ async def retrieve_knowledge(request: QueryRequest):
 
     Args:
         request: 检索请求
+        response: 响应对象(通过 Server-Timing 头返回各阶段耗时)
+        x_request_timeout: 延迟预算(秒,可选)
 
     Returns:
         RetrievalResponse: 检索响应
     """
-    start_time = time.time()
-
+    # 各阶段耗时(秒)
+    timings: Dict[str, float] = {}
+    result = None
     try:
-        # 第一步: LLM判断是否需要检索
-        step1_start = time.time()
-        print(f"[Step 1] LLM判断是否需要检索...")
-        llm_decision = await llm_service.decide_retrieval(
-            question=request.question,
-            datasets=request.datasets,
-            document=request.document
-        )
-        step1_time = time.time() - step1_start
-
-        print(f"[Step 1] 判断结果: need_retrieval={llm_decision.need_retrieval} (耗时{step1_time:.2f}s)")
-
-        # 如果不需要检索,直接返回
-        if not llm_decision.need_retrieval:
-            return RetrievalResponse(
-                success=True,
-                need_retrieval=False,
-                retrieval_queries=[],
-                segments=[],
-                total_segments=0,
-                message="根据LLM判断,此问题不需要检索知识库"
-            )
-
-        # 如果没有生成检索查询,返回错误
-        if not llm_decision.retrieval_queries:
-            return RetrievalResponse(
-                success=False,
-                need_retrieval=True,
-                retrieval_queries=[],
-                segments=[],
-                total_segments=0,
-                error="LLM判断需要检索,但未生成有效的检索查询"
-            )
-
-        print(f"[Step 1] 生成 {len(llm_decision.retrieval_queries)} 个检索查询")
-
-        # 第二步: 并行检索所有知识库
-        step2_start = time.time()
-        print(f"[Step 2] 并行检索知识库...")
-        all_segments = await dify_client.batch_retrieve(
-            retrieval_queries=llm_decision.retrieval_queries,
-            api_key=request.dataset_api_key,
-            top_k=request.top_k,
-            score_threshold=request.score_threshold,
-            semantic_weight=request.semantic_weight
-        )
-        step2_time = time.time() - step2_start
-
-        print(f"[Step 2] 检索完成,共 {len(all_segments)} 个片段 (耗时{step2_time:.2f}s)")
-
-        # 如果没有检索到任何结果
-        if not all_segments:
-            return RetrievalResponse(
-                success=True,
-                need_retrieval=True,
-                retrieval_queries=llm_decision.retrieval_queries,
-                segments=[],
-                total_segments=0,
-                message="未检索到符合条件的文档片段"
-            )
-
-        # 第三步: 使用Reranker进行重排序
-        step3_start = time.time()
-        print(f"[Step 3] Rerank重排序 (top_k={request.rerank_top_k})...")
-
-        # 构建查询文本(合并原始问题和文档)
-        if request.document:
-            rerank_query = f"{request.document}\n\n{request.question}"
-        else:
-            rerank_query = request.question
-
-        # 执行rerank
-        reranked_segments = await rerank_service.rerank_segments(
-            query=rerank_query,
-            segments=all_segments,
-            top_k=request.rerank_top_k
-        )
-        step3_time = time.time() - step3_start
-
-        print(f"[Step 3] Rerank完成,返回 {len(reranked_segments)} 个片段 (耗时{step3_time:.2f}s)")
-
-        # 计算总耗时
-        elapsed_time = time.time() - start_time
-        print(f"[完成] 总耗时: {elapsed_time:.2f}s (LLM:{step1_time:.2f}s + 检索:{step2_time:.2f}s + Rerank:{step3_time:.2f}s)\n")
-
-        # 返回最终结果
-        return RetrievalResponse(
-            success=True,
-            need_retrieval=True,
-            retrieval_queries=llm_decision.retrieval_queries,
-            segments=reranked_segments,
-            total_segments=len(reranked_segments),
-            message=f"检索成功,返回{len(reranked_segments)}个相关文档片段 (耗时{elapsed_time:.2f}秒)"
-        )
-
-    except Exception as e:
-        print(f"[错误] 检索异常: {str(e)}")
-
-        return RetrievalResponse(
-            success=False,
-            need_retrieval=True,
-            retrieval_queries=[],
-            segments=[],
-            total_segments=0,
-            error=f"检索异常: {str(e)}"
-        )
+        async for event, payload in run_pipeline(request, timings, x_request_timeout):
+            if event == EVENT_RESULT:
+                result = payload
+    finally:
+        response.headers["Server-Timing"] = _server_timing(timings)
+    return result
+
+
+def _format_event(event: str, payload: Any, fmt: str) -> str:
+    """将流水线事件编码为SSE或NDJSON"""
+    if isinstance(payload, BaseModel):
+        data = payload.model_dump(mode="json")
+    else:
+        data = payload
+    if fmt == "ndjson":
+        return json.dumps({"event": event, "data": data}, ensure_ascii=False) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/v1/retrieve/stream")
+async def retrieve_knowledge_stream(
+    request: QueryRequest,
+    format: str = "sse",
+    x_request_timeout: Optional[float] = Header(None)
+):
+    """
+    知识库检索增强接口(流式)
+
+    随流水线推进依次推送事件:
+    - query: 流式判断时每生成一个检索查询(仅 stream_decision 开启时)
+    - decision: LLM判断结果
+    - dataset: 每个检索查询的Dify原始结果(按完成顺序)
+    - result: 最终的检索响应(与 /api/v1/retrieve 相同)
+    - done: 各阶段耗时(毫秒)
+
+    Args:
+        request: 检索请求
+        format: 输出格式, sse(默认) 或 ndjson
+        x_request_timeout: 延迟预算(秒,可选)
+
+    Returns:
+        StreamingResponse: 事件流
+    """
+    if format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"不支持的格式: {format}")
+
+    async def event_stream():
+        timings: Dict[str, float] = {}
+        # 客户端断开时 StreamingResponse 关闭生成器,流水线在 finally 中取消未完成的检索
+        async with aclosing(run_pipeline(request, timings, x_request_timeout)) as events:
+            async for event, payload in events:
+                yield _format_event(event, payload, format)
+        done = {stage: round(elapsed * 1000, 1) for stage, elapsed in timings.items()}
+        yield _format_event("done", done, format)
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/event-stream"
+    return StreamingResponse(
+        event_stream(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.exception_handler(Exception)
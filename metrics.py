@@ -0,0 +1,218 @@
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from bisect import bisect_left
+import math
+from config import settings
+
+
+# 默认延迟分桶(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    """格式化Prometheus标签"""
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + body + "}"
+
+
+def _format_value(value: float) -> str:
+    """格式化数值"""
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """指标基类"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterable[str]:
+        """生成指标样本行"""
+        return []
+
+    def render(self) -> str:
+        """按Prometheus文本格式输出"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    计数器
+
+    所有记录都发生在事件循环线程中,直接修改字典即可,无需加锁。
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        """增加计数"""
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    """
+    直方图
+
+    记录时只递增落入的单个分桶(O(log n)),输出时再累加为Prometheus要求的累计分桶。
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各分桶计数..., +Inf分桶计数, 总和]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        """记录一次观测值"""
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, series in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series[:-1]):
+                cumulative += count
+                label_str = _format_labels(self.labelnames, labels, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{label_str} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(series[-1])}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+class CallbackMetric(Metric):
+    """抓取时通过回调函数计算取值的指标(用于连接池、缓存等已有统计)"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[LabelValues, float]],
+        type: str = "gauge"
+    ):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.callback = callback
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.callback().items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """注册指标,同名指标只保留第一个"""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[LabelValues, float]],
+        type: str = "gauge"
+    ) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, labelnames, callback, type))
+
+    def render(self) -> str:
+        """输出所有指标"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# 创建全局实例
+registry = Registry()
+
+# 未单独输出的知识库的标签值
+OTHER_DATASET = "other"
+_METRIC_DATASETS = frozenset(
+    dataset_id.strip() for dataset_id in settings.metrics_dataset_ids.split(",") if dataset_id.strip()
+)
+
+
+def dataset_label(dataset_id: object) -> str:
+    """
+    知识库的指标标签值
+
+    知识库ID来自请求,只有 METRICS_DATASET_IDS 中列出的知识库单独输出,其余汇总为 other,
+    避免任意请求产生新的时间序列。
+    """
+    dataset_id = str(dataset_id)
+    return dataset_id if dataset_id in _METRIC_DATASETS else OTHER_DATASET
+
+
+# 流水线指标
+stage_duration = registry.histogram(
+    "retrieval_stage_duration_seconds",
+    "Duration of each retrieval pipeline stage",
+    ["stage"]
+)
+dataset_duration = registry.histogram(
+    "dify_dataset_retrieve_duration_seconds",
+    "Duration of Dify retrieval per dataset",
+    ["dataset_id"]
+)
+segments_total = registry.counter(
+    "retrieval_segments_total",
+    "Retrieved segments before and after dedupe",
+    ["phase"]
+)
+fallbacks_total = registry.counter(
+    "retrieval_fallbacks_total",
+    "Fallback paths taken when an upstream call fails",
+    ["component", "reason"]
+)
+
+# 上游请求指标
+upstream_responses_total = registry.counter(
+    "upstream_responses_total",
+    "Upstream responses by status code (or error type)",
+    ["upstream", "status"]
+)
+upstream_duration = registry.histogram(
+    "upstream_request_duration_seconds",
+    "Upstream request duration until response headers",
+    ["upstream"]
+)
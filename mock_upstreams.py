@@ -0,0 +1,339 @@
+"""
+本地模拟上游服务 - 用于离线压测和基准测试
+
+在一个进程中同时模拟 Dify 知识库检索、LLM chat/completions(含流式)和 Reranker 接口,
+支持配置延迟分布、错误率、返回数据量和合成语料。
+
+使用方法:
+    python mock_upstreams.py --port 9000 --dify-latency lognormal:0.3,0.5 --llm-latency constant:1.0
+
+然后将检索服务指向模拟服务:
+    DIFY_API_BASE_URL=http://127.0.0.1:9000/v1
+    LLM_API_BASE_URL=http://127.0.0.1:9000/v1
+    RERANKER_API_URL=http://127.0.0.1:9000/v1/rerank
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+# 合成语料使用的词表
+VOCABULARY = [
+    "数据", "导入", "导出", "接口", "API", "配置", "权限", "用户", "密码", "重置",
+    "知识库", "检索", "文档", "模型", "部署", "服务", "日志", "错误", "异常", "超时",
+    "缓存", "性能", "优化", "安全", "认证", "令牌", "网络", "连接", "数据库", "备份",
+    "恢复", "版本", "升级", "安装", "依赖", "参数", "请求", "响应", "格式", "字段",
+    "python", "docker", "http", "json", "token", "query", "index", "search", "rerank", "embedding"
+]
+
+GREETINGS = ("你好", "您好", "hello", "hi", "谢谢", "再见")
+
+
+class LatencyModel:
+    """
+    延迟分布
+
+    支持的格式:
+        constant:秒
+        uniform:最小值,最大值
+        normal:均值,标准差
+        lognormal:中位数,sigma
+        exponential:均值
+    """
+
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        name, _, args = spec.partition(":")
+        self.name = name.strip().lower()
+        self.args = [float(x) for x in args.split(",") if x.strip()]
+
+        expected = {"constant": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1}
+        if self.name not in expected or len(self.args) != expected[self.name]:
+            raise ValueError(f"无效的延迟分布: {spec}")
+
+    def sample(self) -> float:
+        """采样一次延迟(秒)"""
+        if self.name == "constant":
+            value = self.args[0]
+        elif self.name == "uniform":
+            value = self.rng.uniform(self.args[0], self.args[1])
+        elif self.name == "normal":
+            value = self.rng.gauss(self.args[0], self.args[1])
+        elif self.name == "lognormal":
+            value = self.rng.lognormvariate(math.log(self.args[0]), self.args[1])
+        else:
+            value = self.rng.expovariate(1.0 / self.args[0])
+        return max(0.0, value)
+
+
+class SyntheticCorpus:
+    """按知识库ID生成的确定性合成语料,也可从JSON文件加载"""
+
+    def __init__(self, segments_per_dataset: int, segment_chars: int, seed: int, corpus_file: Optional[str] = None):
+        self.segments_per_dataset = segments_per_dataset
+        self.segment_chars = segment_chars
+        self.seed = seed
+        self._datasets: Dict[str, List[Dict[str, Any]]] = {}
+        self._shared: Optional[List[Dict[str, Any]]] = None
+
+        if corpus_file:
+            self._load(corpus_file)
+
+    def _load(self, corpus_file: str):
+        """
+        加载语料文件
+
+        格式: [{"dataset_id": "可选", "content": "片段内容", "document_name": "可选"}, ...]
+        未指定 dataset_id 的片段对所有知识库可见。
+        """
+        with open(corpus_file, "r", encoding="utf-8") as f:
+            items = json.load(f)
+
+        shared = []
+        for i, item in enumerate(items):
+            segment = self._make_segment(
+                item.get("dataset_id", "shared"),
+                i,
+                item["content"],
+                item.get("document_name")
+            )
+            if "dataset_id" in item:
+                self._datasets.setdefault(item["dataset_id"], []).append(segment)
+            else:
+                shared.append(segment)
+        self._shared = shared
+
+    def _make_segment(self, dataset_id: str, index: int, content: str, document_name: Optional[str] = None) -> Dict[str, Any]:
+        document_index = index // 5
+        return {
+            "id": f"{dataset_id}-seg-{index}",
+            "document_id": f"{dataset_id}-doc-{document_index}",
+            "document_name": document_name or f"文档{document_index}",
+            "position": index % 5 + 1,
+            "content": content,
+            "chars": set(content)
+        }
+
+    def _generate(self, dataset_id: str) -> List[Dict[str, Any]]:
+        rng = random.Random(f"{self.seed}:{dataset_id}")
+        segments = []
+        for i in range(self.segments_per_dataset):
+            words = []
+            length = 0
+            while length < self.segment_chars:
+                word = rng.choice(VOCABULARY)
+                words.append(word)
+                length += len(word)
+            segments.append(self._make_segment(dataset_id, i, "".join(words)[:self.segment_chars]))
+        return segments
+
+    def segments(self, dataset_id: str) -> List[Dict[str, Any]]:
+        """获取知识库的全部片段"""
+        if dataset_id not in self._datasets:
+            if self._shared is not None:
+                return self._shared
+            self._datasets[dataset_id] = self._generate(dataset_id)
+        return self._datasets[dataset_id] + (self._shared or [])
+
+
+def overlap_score(query: str, chars: set) -> float:
+    """按字符重叠计算的简单相关性分数(0~1)"""
+    query_chars = set(query)
+    if not query_chars:
+        return 0.0
+    return len(query_chars & chars) / len(query_chars)
+
+
+class MockUpstreams:
+    """模拟上游服务状态"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.dify_latency = LatencyModel(args.dify_latency, self.rng)
+        self.llm_latency = LatencyModel(args.llm_latency, self.rng)
+        self.rerank_latency = LatencyModel(args.rerank_latency, self.rng)
+        self.corpus = SyntheticCorpus(args.segments_per_dataset, args.segment_chars, args.seed, args.corpus)
+
+    def should_fail(self, rate: float) -> bool:
+        return rate > 0 and self.rng.random() < rate
+
+    def error_response(self, upstream: str) -> JSONResponse:
+        status = self.args.error_status
+        headers = {"Retry-After": "1"} if status == 429 else None
+        return JSONResponse(
+            status_code=status,
+            content={"code": "mock_error", "message": f"模拟{upstream}错误"},
+            headers=headers
+        )
+
+
+def _parse_prompt(messages: List[Dict[str, str]]) -> Tuple[List[str], str]:
+    """从LLM请求中解析知识库ID列表和用户问题"""
+    system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+    user = next((m["content"] for m in messages if m.get("role") == "user"), "")
+    dataset_ids = re.findall(r"知识库ID:\s*(\S+)", system)
+    match = re.search(r"用户问题:\s*\n(.*?)\n\n", user, re.S)
+    question = match.group(1).strip() if match else user.strip()
+    return dataset_ids, question
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    """创建模拟上游应用"""
+    app = FastAPI(title="Mock Upstreams")
+    state = MockUpstreams(args)
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy"}
+
+    @app.post("/v1/datasets/{dataset_id}/retrieve")
+    async def dify_retrieve(dataset_id: str, request: Request):
+        body = await request.json()
+        await asyncio.sleep(state.dify_latency.sample())
+        if state.should_fail(args.dify_error_rate):
+            return state.error_response("Dify")
+
+        query = body.get("query", "")
+        retrieval_model = body.get("retrieval_model", {})
+        top_k = int(retrieval_model.get("top_k", 10))
+        threshold = float(retrieval_model.get("score_threshold", 0.0)) if retrieval_model.get("score_threshold_enabled") else 0.0
+
+        scored = []
+        for segment in state.corpus.segments(dataset_id):
+            score = overlap_score(query, segment["chars"])
+            if score >= threshold:
+                scored.append((score, segment))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        records = [
+            {
+                "score": round(score, 4),
+                "segment": {
+                    "id": segment["id"],
+                    "document_id": segment["document_id"],
+                    "position": segment["position"],
+                    "content": segment["content"],
+                    "document": {"name": segment["document_name"], "doc_metadata": {}}
+                }
+            }
+            for score, segment in scored[:top_k]
+        ]
+        return {"query": {"content": query}, "records": records}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        dataset_ids, question = _parse_prompt(body.get("messages", []))
+
+        need_retrieval = not question.lower().startswith(GREETINGS)
+        if need_retrieval and state.rng.random() < args.llm_no_retrieval_rate:
+            need_retrieval = False
+
+        queries = []
+        if need_retrieval:
+            for dataset_id in dataset_ids:
+                query = question if args.llm_query_mode == "raw" else f"{question} 相关文档"
+                queries.append({"dataset_id": dataset_id, "query": query})
+        content = json.dumps({"need_retrieval": need_retrieval, "retrieval_queries": queries}, ensure_ascii=False)
+
+        await asyncio.sleep(state.llm_latency.sample())
+        if state.should_fail(args.llm_error_rate):
+            return state.error_response("LLM")
+
+        if not body.get("stream"):
+            return {
+                "id": "mock-completion",
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+            }
+
+        async def event_stream():
+            size = max(1, args.llm_chunk_chars)
+            for i in range(0, len(content), size):
+                chunk = {
+                    "id": "mock-completion",
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": content[i:i + size]}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                if args.llm_chunk_delay > 0:
+                    await asyncio.sleep(args.llm_chunk_delay)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    @app.post("/v1/rerank")
+    async def rerank(request: Request):
+        body = await request.json()
+        query = body.get("query", "")
+        documents = body.get("documents", [])
+
+        await asyncio.sleep(state.rerank_latency.sample() + args.rerank_per_doc_latency * len(documents))
+        if state.should_fail(args.rerank_error_rate):
+            return state.error_response("Reranker")
+
+        results = [
+            {"index": i, "relevance_score": round(overlap_score(query, set(doc)), 4)}
+            for i, doc in enumerate(documents)
+        ]
+        results.sort(key=lambda item: item["relevance_score"], reverse=True)
+        top_n = body.get("top_n")
+        if top_n:
+            results = results[:top_n]
+        if body.get("return_documents"):
+            for item in results:
+                item["document"] = {"text": documents[item["index"]]}
+        return {"id": "mock-rerank", "results": results}
+
+    return app
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="本地模拟 Dify / LLM / Reranker 上游服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+
+    parser.add_argument("--dify-latency", default="lognormal:0.3,0.5", help="Dify检索延迟分布")
+    parser.add_argument("--llm-latency", default="lognormal:1.5,0.4", help="LLM首个token前的延迟分布")
+    parser.add_argument("--rerank-latency", default="lognormal:0.15,0.3", help="Reranker基础延迟分布")
+    parser.add_argument("--rerank-per-doc-latency", type=float, default=0.002, help="Reranker每个文档增加的延迟(秒)")
+    parser.add_argument("--llm-chunk-chars", type=int, default=8, help="流式输出每个chunk的字符数")
+    parser.add_argument("--llm-chunk-delay", type=float, default=0.02, help="流式输出chunk间隔(秒)")
+
+    parser.add_argument("--dify-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--rerank-error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503, help="注入错误时返回的状态码(429时附带Retry-After)")
+
+    parser.add_argument("--segments-per-dataset", type=int, default=200, help="每个知识库的合成片段数")
+    parser.add_argument("--segment-chars", type=int, default=300, help="每个合成片段的字符数")
+    parser.add_argument("--corpus", default=None, help="语料JSON文件(替代合成语料)")
+
+    parser.add_argument("--llm-query-mode", choices=["raw", "rewrite"], default="rewrite",
+                        help="LLM生成的检索查询: raw=原始问题, rewrite=改写后的问题")
+    parser.add_argument("--llm-no-retrieval-rate", type=float, default=0.0, help="LLM判断不需要检索的比例")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    base_url = f"http://{args.host}:{args.port}/v1"
+    print("🧪 模拟上游服务启动")
+    print(f"   DIFY_API_BASE_URL={base_url}")
+    print(f"   LLM_API_BASE_URL={base_url}")
+    print(f"   RERANKER_API_URL={base_url}/rerank")
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
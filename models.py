@@ -1,4 +1,4 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal
 from pydantic import BaseModel, Field
 
 
@@ -21,6 +21,29 @@ class QueryRequest(BaseModel):
     score_threshold: float = Field(0.4, description="分数阈值", ge=0.0, le=1.0)
     semantic_weight: float = Field(0.7, description="混合检索中语义检索的权重", ge=0.0, le=1.0)
 
+    # 流水线选项
+    speculative_retrieval: Optional[bool] = Field(
+        None,
+        description="是否在LLM判断的同时用原始问题推测检索(默认使用服务端配置)"
+    )
+    stream_decision: Optional[bool] = Field(
+        None,
+        description="是否流式解析LLM判断并在每个查询生成时立即检索(默认使用服务端配置)"
+    )
+    timeout: Optional[float] = Field(
+        None,
+        description="整体延迟预算(秒),超出时降级返回已有结果(也可通过 X-Request-Timeout 请求头传入)",
+        gt=0.0
+    )
+    rerank_mode: Optional[Literal["remote", "local"]] = Field(
+        None,
+        description="重排序模式: remote 调用Reranker, local 使用本地BM25(默认使用服务端配置)"
+    )
+    multi_query_rerank: Optional[bool] = Field(
+        None,
+        description="是否同时用LLM生成的检索查询重排序并融合(默认使用服务端配置)"
+    )
+
 
 class RetrievalQuery(BaseModel):
     """单个检索查询"""
@@ -51,6 +74,15 @@ class DocumentSegment(BaseModel):
     metadata: Optional[Dict[str, Any]] = Field(default_factory=dict, description="额外元数据")
 
 
+class DatasetRetrievalResult(BaseModel):
+    """单个检索查询的Dify原始结果(流式接口事件)"""
+    dataset_id: str = Field(..., description="知识库ID")
+    query: str = Field(..., description="检索查询语句")
+    segments: List[DocumentSegment] = Field(default_factory=list, description="检索到的文档片段(未重排序)")
+    failed: bool = Field(False, description="检索是否失败(失败时片段为空,与没有命中的结果区分)")
+    reason: Optional[str] = Field(None, description="失败原因(如 circuit_open、read_timeout、http_status)")
+
+
 class RetrievalResponse(BaseModel):
     """检索响应模型"""
     success: bool = Field(..., description="请求是否成功")
@@ -64,6 +96,10 @@ class RetrievalResponse(BaseModel):
         description="检索到的文档片段(已排序)"
     )
     total_segments: int = Field(0, description="总片段数")
+    skipped_datasets: List[str] = Field(
+        default_factory=list,
+        description="因超出时间预算或已满足法定数量而未等待其结果,或检索失败的知识库ID"
+    )
     message: Optional[str] = Field(None, description="响应消息")
     error: Optional[str] = Field(None, description="错误信息")
 
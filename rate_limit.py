@@ -0,0 +1,257 @@
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import time
+import httpx
+from circuit_breaker import RejectedError
+from metrics import registry
+
+
+# 所有已创建的限流器,用于统计接口
+governors: Dict[str, "RateGovernor"] = {}
+
+# 429 未带 Retry-After 时的默认等待时间(秒)
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class RateLimitedError(RejectedError):
+    """排队时间超过上限,调用被本地拒绝"""
+
+    def __init__(self, upstream: str, wait: float):
+        super().__init__(f"{upstream} 限流: 需要排队{wait:.2f}秒")
+        self.upstream = upstream
+        self.wait = wait
+
+
+def parse_retry_after(response: httpx.Response) -> float:
+    """
+    解析 Retry-After 响应头(秒数或HTTP日期)
+
+    Returns:
+        float: 需要等待的秒数,缺失或无法解析时返回默认值
+    """
+    value = response.headers.get("retry-after")
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class TokenBucket:
+    """
+    单个API Key的令牌桶
+
+    令牌不足时预约未来的令牌(令牌数可为负),调用方按预约顺序排队;
+    收到 429 后在 Retry-After 时间内暂停发放。
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        Args:
+            rate: 每秒补充的令牌数,0表示不限速(只处理429)
+            burst: 桶容量
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """获取一个令牌需要等待的时间(不预约)"""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.rate > 0 and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def reserve(self, now: float) -> float:
+        """预约一个令牌,返回需要等待的时间"""
+        wait = self.wait_time(now)
+        if self.rate > 0:
+            self.tokens -= 1
+        return wait
+
+    def cancel(self):
+        """取消预约"""
+        if self.rate > 0:
+            self.tokens += 1
+
+    def block(self, seconds: float):
+        """暂停发放令牌(收到429时)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateGovernor:
+    """
+    上游限流器: 每个API Key一个令牌桶
+
+    请求前按令牌桶排队(最多等待 max_wait 秒),配置了多个Key时选择最先可用的Key;
+    收到 429 时按 Retry-After 暂停该Key并重试一次。
+    """
+
+    def __init__(self, name: str, rate: float = 0.0, burst: int = 10, max_wait: float = 2.0):
+        """
+        Args:
+            name: 上游名称
+            rate: 每个Key每秒的请求数,0表示不限速(只处理429)
+            burst: 每个Key允许的突发请求数
+            max_wait: 最长排队时间(秒),超过时抛出 RateLimitedError
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.requests = 0
+        self.queued = 0
+        self.queued_seconds = 0.0
+        self.rejected = 0
+        self.throttled = 0
+        governors[name] = self
+
+    def _get_bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    async def acquire(self, keys: List[str], max_wait: Optional[float] = None) -> str:
+        """
+        从Key池中选择最先可用的Key并等待其令牌
+
+        Args:
+            keys: 可用的API Key列表
+            max_wait: 本次最长排队时间(秒),为None时使用默认值
+
+        Returns:
+            str: 本次请求使用的API Key
+
+        Raises:
+            RateLimitedError: 需要排队的时间超过上限时
+        """
+        max_wait = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+        now = time.monotonic()
+        key = min(keys, key=lambda k: self._get_bucket(k).wait_time(now))
+        bucket = self._get_bucket(key)
+
+        self.requests += 1
+        wait = bucket.reserve(now)
+        if wait > max_wait:
+            bucket.cancel()
+            self.rejected += 1
+            raise RateLimitedError(self.name, wait)
+        if wait > 0:
+            self.queued += 1
+            self.queued_seconds += wait
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                bucket.cancel()
+                raise
+        return key
+
+    def observe(self, key: str, response: httpx.Response) -> bool:
+        """
+        记录上游响应,429时按 Retry-After 暂停该Key
+
+        Returns:
+            bool: 是否被上游限流
+        """
+        if response.status_code != 429:
+            return False
+        retry_after = parse_retry_after(response)
+        self.throttled += 1
+        self._get_bucket(key).block(retry_after)
+        print(f"[限流] {self.name} 返回429,暂停该Key {retry_after:.1f}秒")
+        return True
+
+    async def send(
+        self,
+        keys: List[str],
+        send: Callable[[str], Awaitable[httpx.Response]],
+        max_wait: Optional[float] = None
+    ) -> httpx.Response:
+        """
+        在限流保护下发送请求,收到429时等待 Retry-After (或换用其他Key)后重试一次
+
+        Args:
+            keys: 可用的API Key列表
+            send: 使用指定Key发送请求的函数
+            max_wait: 本次最长排队时间(秒)
+
+        Returns:
+            httpx.Response: 上游响应(重试后仍为429时返回该响应)
+
+        Raises:
+            RateLimitedError: 需要排队的时间超过上限时
+        """
+        response = None
+        for _ in range(2):
+            key = await self.acquire(keys, max_wait)
+            response = await send(key)
+            if not self.observe(key, response):
+                return response
+        return response
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回限流统计信息"""
+        return {
+            "keys": len(self._buckets),
+            "requests": self.requests,
+            "queued": self.queued,
+            "queued_seconds": round(self.queued_seconds, 3),
+            "rejected": self.rejected,
+            "throttled_429": self.throttled
+        }
+
+
+def key_pool(primary: str, pool: str) -> List[str]:
+    """
+    合并主Key和逗号分隔的Key池(去重,保持顺序)
+
+    Args:
+        primary: 主API Key
+        pool: 额外的API Key,逗号分隔
+
+    Returns:
+        List[str]: API Key列表
+    """
+    keys = [primary] + [key.strip() for key in pool.split(",")]
+    return list(dict.fromkeys(key for key in keys if key))
+
+
+registry.callback(
+    "rate_limit_requests_total",
+    "Requests passed through the client-side rate governor by outcome",
+    ["upstream", "outcome"],
+    lambda: {
+        key: value
+        for name, governor in governors.items()
+        for key, value in (
+            ((name, "queued"), governor.queued),
+            ((name, "rejected"), governor.rejected),
+            ((name, "throttled_429"), governor.throttled),
+            ((name, "total"), governor.requests)
+        )
+    },
+    type="counter"
+)
+registry.callback(
+    "rate_limit_queued_seconds_total",
+    "Total time requests spent queued by the rate governor",
+    ["upstream"],
+    lambda: {(name,): governor.queued_seconds for name, governor in governors.items()},
+    type="counter"
+)
@@ -0,0 +1,203 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import asyncio
+from deadline import Deadline
+from metrics import registry
+
+# 发送一次Rerank请求: (查询, 文档列表, top_n, 截止时间) -> 文档下标到分数的映射
+SendRerank = Callable[[str, List[str], Optional[int], Optional[Deadline]], Awaitable[Dict[int, float]]]
+
+
+# 所有已创建的批处理器,用于统计接口
+batchers: Dict[str, "RerankBatcher"] = {}
+
+
+class _Job:
+    """等待合并发送的一次Rerank调用"""
+
+    def __init__(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: Optional[int],
+        deadline: Optional[Deadline],
+        future: asyncio.Future
+    ):
+        self.query = query
+        self.documents = documents
+        self.top_n = top_n
+        self.deadline = deadline
+        self.future = future
+
+
+class RerankBatcher:
+    """
+    跨请求合并Rerank调用(微批处理)
+
+    在 window 秒内(或待发送文档达到 max_documents 时)收集调用,
+    相同查询的调用合并为一次请求(文档按内容去重),不同查询的请求同时发出,
+    再把分数分发回各调用方。Reranker接口每次只接受一个查询,
+    因此合并主要来自同一请求的增量批次和并发的相同问题。
+    """
+
+    def __init__(self, name: str, send: SendRerank, window: float = 0.0, max_documents: int = 64):
+        """
+        Args:
+            name: 批处理器名称
+            send: 发送一次Rerank请求的函数
+            window: 收集调用的时间窗口(秒),为0时不合并
+            max_documents: 待发送文档达到该数量时立即发送
+        """
+        self.name = name
+        self.send = send
+        self.window = window
+        self.max_documents = max_documents
+        self._pending: List[_Job] = []
+        self._pending_documents = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running: Set[asyncio.Task] = set()
+        self.jobs = 0
+        self.requests = 0
+        self.documents_submitted = 0
+        self.documents_sent = 0
+        batchers[name] = self
+
+    async def submit(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: Optional[int],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[int, float]:
+        """
+        提交一次Rerank调用,等待所在批次返回
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_n: 返回的结果数量,为None时返回全部
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射
+
+        Raises:
+            asyncio.TimeoutError: 超出截止时间仍未返回
+        """
+        if self.window <= 0:
+            return await self.send(query, documents, top_n, deadline)
+
+        loop = asyncio.get_running_loop()
+        job = _Job(query, documents, top_n, deadline, loop.create_future())
+        self._pending.append(job)
+        self._pending_documents += len(documents)
+        if self._pending_documents >= self.max_documents:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        # 调用方被取消或超时时只放弃自身的结果,不影响同批次的其他调用
+        if deadline is None:
+            return await job.future
+        return await asyncio.wait_for(job.future, timeout=deadline.remaining())
+
+    def _flush(self):
+        """按查询分组发送当前批次"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        jobs, self._pending, self._pending_documents = self._pending, [], 0
+
+        groups: Dict[str, List[_Job]] = {}
+        for job in jobs:
+            if not job.future.done():
+                groups.setdefault(job.query, []).append(job)
+        for query, group in groups.items():
+            task = asyncio.create_task(self._send_group(query, group))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _send_group(self, query: str, jobs: List[_Job]):
+        """合并相同查询的调用并分发结果"""
+        documents: List[str] = []
+        positions: Dict[str, int] = {}
+        job_positions: List[List[int]] = []
+        for job in jobs:
+            indexes = []
+            for document in job.documents:
+                position = positions.get(document)
+                if position is None:
+                    position = positions[document] = len(documents)
+                    documents.append(document)
+                indexes.append(position)
+            job_positions.append(indexes)
+
+        # 单个调用原样发送;多个调用需要全部分数再各自截取top_n
+        top_n = jobs[0].top_n if len(jobs) == 1 else None
+        # 使用最晚的截止时间,避免较早的调用方缩短其他调用方的超时
+        deadlines = [job.deadline for job in jobs]
+        deadline = None if None in deadlines else max(deadlines, key=lambda d: d.expires_at)
+
+        self.jobs += len(jobs)
+        self.requests += 1
+        self.documents_submitted += sum(len(job.documents) for job in jobs)
+        self.documents_sent += len(documents)
+        try:
+            scores = await self.send(query, documents, top_n, deadline)
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        except BaseException:
+            for job in jobs:
+                job.future.cancel()
+            raise
+
+        for job, indexes in zip(jobs, job_positions):
+            if job.future.done():
+                continue
+            result = {index: scores[position] for index, position in enumerate(indexes) if position in scores}
+            if top_n is None and job.top_n is not None:
+                result = dict(sorted(result.items(), key=lambda item: item[1], reverse=True)[:job.top_n])
+            job.future.set_result(result)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回批处理统计信息"""
+        return {
+            "enabled": self.window > 0,
+            "jobs": self.jobs,
+            "requests": self.requests,
+            "documents_submitted": self.documents_submitted,
+            "documents_sent": self.documents_sent,
+            "pending": len(self._pending)
+        }
+
+
+registry.callback(
+    "rerank_batch_jobs_total",
+    "Rerank calls submitted to the micro-batcher",
+    ["batcher"],
+    lambda: {(name,): batcher.jobs for name, batcher in batchers.items()},
+    type="counter"
+)
+registry.callback(
+    "rerank_batch_requests_total",
+    "Upstream rerank requests sent by the micro-batcher",
+    ["batcher"],
+    lambda: {(name,): batcher.requests for name, batcher in batchers.items()},
+    type="counter"
+)
+registry.callback(
+    "rerank_batch_documents_total",
+    "Documents submitted to and sent by the micro-batcher",
+    ["batcher", "phase"],
+    lambda: {
+        key: value
+        for name, batcher in batchers.items()
+        for key, value in (
+            ((name, "submitted"), batcher.documents_submitted),
+            ((name, "sent"), batcher.documents_sent)
+        )
+    },
+    type="counter"
+)
@@ -1,7 +1,23 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+import asyncio
+import math
+import time
 import httpx
+import numpy as np
 from models import DocumentSegment, RerankRequest, RerankResult
 from config import settings
+from http_pool import create_http_client
+from cache import TTLCache, hash_text
+from singleflight import SingleFlight
+from metrics import fallbacks_total, segments_total
+from deadline import Deadline
+from circuit_breaker import CircuitOpenError, upstream_breaker
+from rate_limit import RateGovernor, RateLimitedError, key_pool
+from lexical_rerank import cascade_prefilter, lexical_rerank, reciprocal_rank_fusion
+from rerank_batcher import RerankBatcher
+from rerank_sharding import ShardSizer, merge_top_n
+from token_budget import TokenBudget, estimate_tokens
+from document_condenser import MIN_FRAGMENT_TOKENS, document_condenser
 
 
 class RerankService:
@@ -10,13 +26,92 @@ class RerankService:
     def __init__(self):
         self.api_url = settings.reranker_api_url
         self.api_key = settings.reranker_api_key
+        self.api_keys = key_pool(settings.reranker_api_key, settings.reranker_api_key_pool)
         self.model_name = settings.reranker_model_name
+        self.timeout = 30.0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight = SingleFlight("rerank", enabled=settings.singleflight_enabled)
+        # 按模型的最大token数压缩查询、截断文档
+        self._budget = TokenBudget(
+            self.model_name,
+            overrides=settings.reranker_max_tokens,
+            query_share=settings.rerank_query_token_share,
+            enabled=settings.rerank_token_budget_enabled
+        )
+        # 候选较多时拆分为多个分片并发发送
+        self._sharding = ShardSizer(
+            "reranker",
+            max_batch=settings.rerank_max_batch,
+            min_shard=settings.rerank_min_shard,
+            target_latency=settings.rerank_shard_target_latency
+        )
+        # 跨请求合并短时间内的Rerank调用
+        self._batcher = RerankBatcher(
+            "reranker",
+            self._request_scores,
+            window=settings.rerank_microbatch_window,
+            max_documents=settings.rerank_microbatch_max_documents
+        )
+        self._governor = RateGovernor(
+            "reranker",
+            rate=settings.reranker_rate_limit,
+            burst=settings.reranker_rate_burst,
+            max_wait=settings.rate_limit_max_wait
+        )
+        self.score_cache: Optional[TTLCache] = None
+        if settings.rerank_cache_enabled:
+            self.score_cache = TTLCache(
+                "rerank",
+                ttl=settings.rerank_cache_ttl,
+                max_size=settings.rerank_cache_max_size
+            )
+
+    async def start(self):
+        """创建长连接HTTP客户端(应用启动时调用)"""
+        if self._client is None:
+            self._client = create_http_client("reranker", self.timeout, settings.reranker_max_connections)
+
+    async def close(self):
+        """关闭HTTP客户端(应用关闭时调用)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """获取共享HTTP客户端,未启动时按需创建"""
+        if self._client is None:
+            self._client = create_http_client("reranker", self.timeout, settings.reranker_max_connections)
+        return self._client
+
+    def build_query(self, question: str, document: Optional[str] = None) -> str:
+        """
+        构建Rerank查询(合并文档和问题)
+
+        文档超出查询的token预算时只保留与问题最相关的句子,问题占满预算时只使用问题。
+
+        Args:
+            question: 用户问题
+            document: 携带的文档(可选)
+
+        Returns:
+            str: Rerank查询
+        """
+        if not document:
+            return question
+        if self._budget.enabled:
+            budget = self._budget.query_tokens - estimate_tokens(question) - 1
+            if budget < MIN_FRAGMENT_TOKENS:
+                return question
+            document = document_condenser.condense(document, question, budget, target="rerank")
+        return f"{document}\n\n{question}"
 
     async def rerank_segments(
         self,
         query: str,
         segments: List[DocumentSegment],
-        top_k: int = 5
+        top_k: int = 5,
+        deadline: Optional[Deadline] = None,
+        mode: Optional[str] = None
     ) -> List[DocumentSegment]:
         """
         对文档片段进行重排序
@@ -25,6 +120,8 @@ class RerankService:
             query: 原始查询
             segments: 待排序的文档片段列表
             top_k: 返回的top-k结果数量
+            deadline: 请求截止时间(可选),上游超时不超过剩余时间
+            mode: 重排序模式(默认使用服务端配置)
 
         Returns:
             List[DocumentSegment]: 重排序后的文档片段
@@ -32,72 +129,364 @@ class RerankService:
         if not segments:
             return []
 
-        # 如果片段数量小于等于top_k,直接返回
+        # 如果片段数量小于等于top_k,无需重排序,按Dify分数返回
         if len(segments) <= top_k:
-            return segments
+            return sorted(segments, key=lambda seg: seg.score, reverse=True)
+
+        if (mode or settings.rerank_mode) == "local":
+            return lexical_rerank(query, segments, top_k)
+
+        segments = self._cascade(query, segments, top_k)
 
         # 准备文档内容列表
         documents = [seg.content for seg in segments]
 
+        try:
+            scores = await self._score_documents(query, documents, top_k, deadline)
+
+            # 根据rerank分数重新排序segments
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            # 返回分数为rerank分数的副本(输入片段可能被缓存或其他查询共享)
+            return [segments[index].model_copy(update={"score": relevance_score}) for index, relevance_score in ranked]
+
+        except CircuitOpenError as e:
+            print(f"Rerank跳过: {e}")
+            fallbacks_total.inc("rerank", "circuit_open")
+            return self._fallback(query, segments, top_k)
+        except RateLimitedError as e:
+            print(f"Rerank跳过: {e}")
+            fallbacks_total.inc("rerank", "rate_limited")
+            return self._fallback(query, segments, top_k)
+        except asyncio.TimeoutError:
+            print("[Rerank] 超出时间预算,跳过重排序")
+            fallbacks_total.inc("rerank", "deadline")
+            return self._fallback(query, segments, top_k)
+        except httpx.HTTPError as e:
+            print(f"Rerank API请求失败: {e}")
+            fallbacks_total.inc("rerank", "http_error")
+            return self._fallback(query, segments, top_k)
+        except Exception as e:
+            print(f"Rerank处理失败: {e}")
+            fallbacks_total.inc("rerank", "error")
+            return self._fallback(query, segments, top_k)
+
+    def _cascade(self, query: str, segments: List[DocumentSegment], top_k: int) -> List[DocumentSegment]:
+        """
+        级联重排序的第一阶段: 候选较多时只保留粗排后的前M个发送给Reranker
+
+        Args:
+            query: 原始查询
+            segments: 候选文档片段
+            top_k: 返回的top-k结果数量
+
+        Returns:
+            List[DocumentSegment]: 发送给Reranker的候选
+        """
+        if settings.rerank_cascade_factor <= 0:
+            return segments
+        keep = max(settings.rerank_cascade_min, math.ceil(settings.rerank_cascade_factor * top_k))
+        if len(segments) <= keep:
+            return segments
+        candidates = cascade_prefilter(query, segments, keep)
+        segments_total.inc("before_cascade", amount=len(segments))
+        segments_total.inc("after_cascade", amount=len(candidates))
+        return candidates
+
+    def _fallback(self, query: str, segments: List[DocumentSegment], top_k: int) -> List[DocumentSegment]:
+        """
+        Reranker不可用时的降级排序: 本地BM25,或按Dify检索分数
+
+        Args:
+            query: 原始查询
+            segments: 待排序的文档片段列表
+            top_k: 返回的top-k结果数量
+
+        Returns:
+            List[DocumentSegment]: 降级排序后的文档片段
+        """
+        if settings.rerank_lexical_fallback:
+            return lexical_rerank(query, segments, top_k)
+        return sorted(segments, key=lambda seg: seg.score, reverse=True)[:top_k]
+
+    def incremental(
+        self,
+        query: str,
+        top_k: int = 5,
+        deadline: Optional[Deadline] = None,
+        mode: Optional[str] = None,
+        extra_queries: Sequence[str] = ()
+    ) -> "IncrementalRerank":
+        """
+        创建增量重排序器,检索结果陆续到达时分批发送Reranker
+
+        Args:
+            query: 原始查询
+            top_k: 返回的top-k结果数量
+            deadline: 请求截止时间(可选),超出时跳过重排序
+            mode: 重排序模式(默认使用服务端配置)
+            extra_queries: 额外的查询,与原始查询同时重排序后融合
+
+        Returns:
+            IncrementalRerank: 增量重排序器
+        """
+        return IncrementalRerank(
+            self,
+            query,
+            top_k,
+            settings.rerank_batch_size,
+            deadline,
+            local=(mode or settings.rerank_mode) == "local",
+            extra_queries=extra_queries,
+            fusion=settings.multi_query_rerank_fusion
+        )
+
+    async def score_documents(
+        self,
+        query: str,
+        documents: List[str],
+        top_k: Optional[int] = None,
+        deadline: Optional[Deadline] = None,
+        use_cache: bool = True
+    ) -> Dict[int, float]:
+        """
+        获取文档的rerank分数(与重排序使用相同的token预算和分数缓存,不处理异常)
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_k: 需要的top-k数量,为None时返回全部分数
+            deadline: 请求截止时间(可选)
+            use_cache: 是否使用分数缓存(评估上游延迟时关闭)
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射
+        """
+        return await self._score_documents(query, documents, top_k, deadline, use_cache)
+
+    async def _score_documents(
+        self,
+        query: str,
+        documents: List[str],
+        top_k: Optional[int],
+        deadline: Optional[Deadline] = None,
+        use_cache: bool = True
+    ) -> Dict[int, float]:
+        """
+        获取文档的rerank分数,优先使用缓存,仅将未缓存的文档发送给Reranker
+
+        查询和文档先按token预算压缩,缓存以压缩后的内容为键。
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_k: 需要的top-k数量(未启用缓存时作为top_n,为None时返回全部)
+            deadline: 请求截止时间(可选)
+            use_cache: 是否使用分数缓存
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射(未启用缓存时只包含top_k个)
+        """
+        query = self._budget.fit_query(query)
+        documents = self._budget.fit_documents(query, documents)
+
+        if self.score_cache is None or not use_cache:
+            return await self._call_reranker(query, documents, top_n=top_k, deadline=deadline)
+
+        query_hash = hash_text(f"{self.model_name}\n{query}")
+        scores: Dict[int, float] = {}
+        # 内容哈希 -> 需要该分数的文档下标(相同内容只发送一次)
+        pending: Dict[str, List[int]] = {}
+
+        for index, document in enumerate(documents):
+            content_hash = hash_text(document)
+            cached = self.score_cache.get((query_hash, content_hash))
+            if cached is not None:
+                scores[index] = cached
+            else:
+                pending.setdefault(content_hash, []).append(index)
+
+        if pending:
+            content_hashes = list(pending)
+            uncached_documents = [documents[pending[h][0]] for h in content_hashes]
+            # 需要全部分数才能写入缓存,因此不限制top_n
+            fresh = await self._call_reranker(query, uncached_documents, top_n=None, deadline=deadline)
+            for position, relevance_score in fresh.items():
+                content_hash = content_hashes[position]
+                self.score_cache.set((query_hash, content_hash), relevance_score)
+                for index in pending[content_hash]:
+                    scores[index] = relevance_score
+
+        return scores
+
+    async def _call_reranker(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: Optional[int],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[int, float]:
+        """
+        调用Reranker接口,短时间内相同查询的调用合并发送(不处理异常)
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_n: 返回的结果数量,为None时返回全部
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射
+        """
+        return await self._batcher.submit(query, documents, top_n, deadline)
+
+    async def _request_scores(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: Optional[int],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[int, float]:
+        """
+        发送Reranker调用,文档超过分片大小时拆分为多个分片并发发送,再按分数归并
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_n: 返回的结果数量,为None时返回全部
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射
+        """
+        shards = self._sharding.plan(len(documents))
+        if len(shards) == 1:
+            return await self._request_shard(query, documents, top_n, deadline)
+
+        # 每个分片只需返回其top_n(全局top_n必然在各分片top_n的并集中)
+        tasks = [
+            asyncio.create_task(self._request_shard(query, documents[start:end], top_n, deadline))
+            for start, end in shards
+        ]
+        try:
+            shard_scores = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return merge_top_n(shard_scores, [start for start, _ in shards], top_n)
+
+    async def _request_shard(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: Optional[int],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[int, float]:
+        """
+        发送一次Reranker调用,相同的并发请求共享同一次调用
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_n: 返回的结果数量,为None时返回全部
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射
+        """
+        key = (
+            hash_text(f"{self.model_name}\n{query}"),
+            tuple(hash_text(document) for document in documents),
+            top_n
+        )
+        scores = await self._inflight.do(
+            key,
+            lambda: upstream_breaker.call("reranker", lambda: self._post_rerank(query, documents, top_n, deadline))
+        )
+        return dict(scores)
+
+    async def _post_rerank(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: Optional[int],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[int, float]:
+        """
+        发送Reranker请求
+
+        Args:
+            query: 查询文本
+            documents: 文档内容列表
+            top_n: 返回的结果数量,为None时返回全部
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            Dict[int, float]: 文档下标到rerank分数的映射
+        """
         # 构建rerank请求
         rerank_request = RerankRequest(
             model=self.model_name,
             query=query,
             documents=documents,
-            top_n=top_k,
+            top_n=top_n,
             return_documents=True
         )
 
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    self.api_url,
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=rerank_request.model_dump()
-                )
-                response.raise_for_status()
-
-                result = response.json()
-                rerank_results = result.get("results", [])
-
-                # 根据rerank结果重新排序segments
-                reranked_segments = []
-                for rerank_result in rerank_results:
-                    index = rerank_result.get("index")
-                    relevance_score = rerank_result.get("relevance_score", 0.0)
-
-                    if 0 <= index < len(segments):
-                        segment = segments[index]
-                        # 更新分数为rerank分数
-                        segment.score = relevance_score
-                        reranked_segments.append(segment)
-
-                return reranked_segments
+        client = self._get_client()
+        payload = rerank_request.model_dump()
 
-        except httpx.HTTPError as e:
-            print(f"Rerank API请求失败: {e}")
-            # 如果rerank失败,返回原始排序的top_k结果
-            return segments[:top_k]
-        except Exception as e:
-            print(f"Rerank处理失败: {e}")
-            return segments[:top_k]
+        async def post(api_key: str) -> httpx.Response:
+            start_time = time.perf_counter()
+            response = await client.post(
+                self.api_url,
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                json=payload,
+                timeout=deadline.clamp(self.timeout) if deadline is not None else self.timeout,
+                extensions={"deadline": deadline}
+            )
+            # 记录Reranker吞吐(不含限流排队),用于决定分片大小
+            if response.is_success:
+                self._sharding.observe(len(documents), time.perf_counter() - start_time)
+            return response
+
+        # 从Key池中选择可用的Key排队,收到429时按Retry-After等待后重试
+        response = await self._governor.send(
+            self.api_keys,
+            post,
+            max_wait=deadline.remaining() if deadline is not None else None
+        )
+        response.raise_for_status()
+
+        result = response.json()
+        scores: Dict[int, float] = {}
+        for rerank_result in result.get("results", []):
+            index = rerank_result.get("index")
+            relevance_score = rerank_result.get("relevance_score", 0.0)
+            if index is not None and 0 <= index < len(documents):
+                scores[index] = relevance_score
+        return scores
 
     async def rerank_with_multiple_queries(
         self,
         queries: List[str],
         segments: List[DocumentSegment],
-        top_k: int = 5
+        top_k: int = 5,
+        deadline: Optional[Deadline] = None
     ) -> List[DocumentSegment]:
         """
-        使用多个查询进行rerank(取平均分)
+        使用多个查询同时rerank,按 MULTI_QUERY_RERANK_FUSION 融合(倒数排名融合或平均分)
+
+        所有查询并发发送,延迟为一次Rerank往返;返回分数为各查询rerank分数的平均值的副本。
 
         Args:
             queries: 多个查询语句
-            segments: 待排序的文档片段列表
+            segments: 待排序的(已去重的)文档片段列表
             top_k: 返回的top-k结果数量
+            deadline: 请求截止时间(可选)
 
         Returns:
             List[DocumentSegment]: 重排序后的文档片段
@@ -105,27 +494,203 @@ class RerankService:
         if not segments or not queries:
             return segments[:top_k]
 
-        # 为每个query单独rerank,收集分数
-        segment_scores: Dict[str, List[float]] = {}
-
-        for query in queries:
-            reranked = await self.rerank_segments(query, segments, len(segments))
-            for seg in reranked:
-                seg_key = f"{seg.dataset_id}_{seg.segment_id}"
-                if seg_key not in segment_scores:
-                    segment_scores[seg_key] = []
-                segment_scores[seg_key].append(seg.score)
-
-        # 计算平均分数
-        for segment in segments:
-            seg_key = f"{segment.dataset_id}_{segment.segment_id}"
-            if seg_key in segment_scores:
-                scores = segment_scores[seg_key]
-                segment.score = sum(scores) / len(scores)
-
-        # 按平均分数排序并返回top-k
-        segments.sort(key=lambda x: x.score, reverse=True)
-        return segments[:top_k]
+        reranker = self.incremental(queries[0], top_k, deadline, extra_queries=queries[1:])
+        reranker.add(segments)
+        return await reranker.finish()
+
+
+class IncrementalRerank:
+    """
+    增量重排序: 去重后的片段每积累 batch_size 个就发送一批Reranker请求,
+    最后合并各批次的分数取全局top_k。
+
+    每批只需返回其top_k(全局top_k必然在各批top_k的并集中),
+    因此较慢的知识库不会阻塞已到达片段的重排序。
+
+    有多个查询时每批同时按所有查询打分(需要全部分数),最后融合各查询的排名或分数。
+    """
+
+    def __init__(
+        self,
+        service: RerankService,
+        query: str,
+        top_k: int,
+        batch_size: int,
+        deadline: Optional[Deadline] = None,
+        local: bool = False,
+        extra_queries: Sequence[str] = (),
+        fusion: str = "rrf"
+    ):
+        """
+        Args:
+            service: Rerank服务
+            query: 原始查询(降级排序和粗排也使用该查询)
+            top_k: 返回的top-k结果数量
+            batch_size: 每批发送的片段数量,为0时等所有结果到达后一次性发送
+            deadline: 请求截止时间(可选),超出时跳过重排序
+            local: 是否只使用本地BM25(不调用Reranker)
+            extra_queries: 额外的查询,与原始查询同时重排序
+            fusion: 多查询的融合方式,rrf(倒数排名融合)或 mean(平均分)
+        """
+        self.service = service
+        self.query = query
+        self.queries = list(dict.fromkeys([query, *extra_queries]))
+        self.fusion = fusion
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.local = local
+        # 级联重排序需要全部候选才能粗排,到齐后再统一发送
+        self.cascade = settings.rerank_cascade_factor > 0
+        self.segments: List[DocumentSegment] = []
+        self._pending: List[DocumentSegment] = []
+        # 每批片段及各查询的打分任务
+        self._batches: List[Tuple[List[DocumentSegment], List[asyncio.Task]]] = []
+
+    def add(self, segments: List[DocumentSegment]):
+        """
+        加入新到达的(已去重的)片段,满一批时立即发送
+
+        Args:
+            segments: 新增的文档片段
+        """
+        self.segments.extend(segments)
+        self._pending.extend(segments)
+        # 片段总数不超过top_k时无需重排序,等待更多结果
+        if not self.local and not self.cascade and self.batch_size > 0 and len(self.segments) > self.top_k:
+            while len(self._pending) >= self.batch_size:
+                batch = self._pending[:self.batch_size]
+                self._pending = self._pending[self.batch_size:]
+                self._dispatch(batch)
+
+    def _dispatch(self, batch: List[DocumentSegment]):
+        """按每个查询发送一批片段"""
+        documents = [seg.content for seg in batch]
+        # 融合多个查询需要每个片段的分数
+        top_n = self.top_k if len(self.queries) == 1 else len(documents)
+        tasks = [
+            asyncio.create_task(self.service._score_documents(query, documents, top_n, self.deadline))
+            for query in self.queries
+        ]
+        self._batches.append((batch, tasks))
+
+    async def finish(self) -> List[DocumentSegment]:
+        """
+        发送剩余片段并合并所有批次的结果
+
+        Returns:
+            List[DocumentSegment]: 重排序后的文档片段
+        """
+        if not self.segments:
+            return []
+
+        # 单个查询且片段数量小于等于top_k时无需重排序,按Dify分数返回(多个查询仍需打分融合)
+        if len(self.segments) <= self.top_k and len(self.queries) == 1:
+            return sorted(self.segments, key=lambda seg: seg.score, reverse=True)
+
+        if self.local:
+            return lexical_rerank(self.query, self.segments, self.top_k)
+
+        # 剩余时间不足以完成重排序时,直接按Dify分数返回
+        if self.deadline is not None and self.deadline.remaining() < settings.deadline_min_rerank:
+            return self._skip("剩余时间不足")
+
+        if self.cascade:
+            # 粗排后的候选仍按批并发发送
+            candidates = self.service._cascade(self.query, self.segments, self.top_k)
+            size = self.batch_size or len(candidates)
+            for start in range(0, len(candidates), size):
+                self._dispatch(candidates[start:start + size])
+            self._pending = []
+        elif self._pending:
+            self._dispatch(self._pending)
+            self._pending = []
+
+        try:
+            batches = asyncio.gather(*(task for _, tasks in self._batches for task in tasks), return_exceptions=True)
+            if self.deadline is not None:
+                all_scores = await asyncio.wait_for(batches, timeout=self.deadline.remaining())
+            else:
+                all_scores = await batches
+            for scores in all_scores:
+                if isinstance(scores, BaseException):
+                    raise scores
+
+            if len(self.queries) > 1:
+                return self._fuse(all_scores)
+
+            # 合并各批次的rerank分数并取全局top_k
+            scored = []
+            for (batch, _), scores in zip(self._batches, all_scores):
+                for index, relevance_score in scores.items():
+                    scored.append((relevance_score, batch[index]))
+            scored.sort(key=lambda item: item[0], reverse=True)
+
+            # 返回分数为rerank分数的副本
+            return [
+                segment.model_copy(update={"score": relevance_score})
+                for relevance_score, segment in scored[:self.top_k]
+            ]
+
+        except asyncio.TimeoutError:
+            return self._skip("超出时间预算")
+        except CircuitOpenError as e:
+            print(f"Rerank跳过: {e}")
+            fallbacks_total.inc("rerank", "circuit_open")
+            return self.service._fallback(self.query, self.segments, self.top_k)
+        except RateLimitedError as e:
+            print(f"Rerank跳过: {e}")
+            fallbacks_total.inc("rerank", "rate_limited")
+            return self.service._fallback(self.query, self.segments, self.top_k)
+        except httpx.HTTPError as e:
+            print(f"Rerank API请求失败: {e}")
+            fallbacks_total.inc("rerank", "http_error")
+            return self.service._fallback(self.query, self.segments, self.top_k)
+        except Exception as e:
+            print(f"Rerank处理失败: {e}")
+            fallbacks_total.inc("rerank", "error")
+            return self.service._fallback(self.query, self.segments, self.top_k)
+
+    def _fuse(self, all_scores: List[Dict[int, float]]) -> List[DocumentSegment]:
+        """
+        融合各查询对所有批次的打分
+
+        Args:
+            all_scores: 按 (批次, 查询) 顺序排列的打分结果
+
+        Returns:
+            List[DocumentSegment]: 融合排序后的top_k,分数为各查询rerank分数的平均值
+        """
+        candidates: List[DocumentSegment] = []
+        matrix = np.zeros((len(self.queries), sum(len(batch) for batch, _ in self._batches)))
+        results = iter(all_scores)
+        for batch, _ in self._batches:
+            offset = len(candidates)
+            candidates.extend(batch)
+            for row in range(len(self.queries)):
+                for index, relevance_score in next(results).items():
+                    matrix[row, offset + index] = relevance_score
+
+        mean = matrix.mean(axis=0)
+        fused = reciprocal_rank_fusion(*matrix) if self.fusion == "rrf" else mean
+        return [
+            candidates[index].model_copy(update={"score": float(mean[index])})
+            for index in np.argsort(-fused, kind="stable")[:self.top_k]
+        ]
+
+    def _skip(self, reason: str) -> List[DocumentSegment]:
+        """跳过重排序,使用降级排序返回top_k"""
+        print(f"[Rerank] {reason},跳过重排序")
+        fallbacks_total.inc("rerank", "deadline")
+        self.cancel()
+        return self.service._fallback(self.query, self.segments, self.top_k)
+
+    def cancel(self):
+        """取消未完成的批次(请求中止时调用)"""
+        for _, tasks in self._batches:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
 
 
 # 创建全局实例
@@ -0,0 +1,147 @@
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+import heapq
+import itertools
+import math
+import numpy as np
+from metrics import registry
+
+
+# 所有已创建的分片器,用于统计接口
+sizers: Dict[str, "ShardSizer"] = {}
+
+
+class ShardSizer:
+    """
+    根据观测到的Reranker吞吐决定分片大小
+
+    用最近的 (文档数, 延迟) 样本拟合 延迟 = 固定开销 + 单文档耗时 × 文档数,
+    使每个分片的预计延迟接近 target_latency;分片大小不超过 max_batch(Reranker单次上限)。
+    """
+
+    # 用于拟合的样本数
+    WINDOW = 100
+    MIN_SAMPLES = 10
+
+    def __init__(self, name: str, max_batch: int = 64, min_shard: int = 8, target_latency: float = 0.0):
+        """
+        Args:
+            name: 分片器名称
+            max_batch: 单次请求的最大文档数,0表示不限制
+            min_shard: 按吞吐计算时的最小分片大小
+            target_latency: 单个分片的目标延迟(秒),0表示只按 max_batch 拆分
+        """
+        self.name = name
+        self.max_batch = max_batch
+        self.min_shard = min_shard
+        self.target_latency = target_latency
+        self._samples: Deque[Tuple[int, float]] = deque(maxlen=self.WINDOW)
+        self._size: Optional[int] = None
+        self.sharded = 0
+        self.shards = 0
+        sizers[name] = self
+
+    def observe(self, documents: int, latency: float):
+        """记录一次Reranker请求的文档数和延迟"""
+        self._samples.append((documents, latency))
+        self._size = None
+
+    def _fit(self) -> Optional[Tuple[float, float]]:
+        """拟合 (固定开销, 单文档耗时),样本不足时返回None"""
+        if len(self._samples) < self.MIN_SAMPLES:
+            return None
+        counts = np.array([sample[0] for sample in self._samples], dtype=np.float64)
+        latencies = np.array([sample[1] for sample in self._samples])
+        if np.ptp(counts) > 0:
+            per_document, overhead = np.polyfit(counts, latencies, 1)
+        else:
+            per_document, overhead = latencies.mean() / max(counts[0], 1.0), 0.0
+        if per_document <= 0:
+            return None
+        return max(float(overhead), 0.0), float(per_document)
+
+    def shard_size(self) -> int:
+        """
+        当前的分片大小
+
+        Returns:
+            int: 每个分片的最大文档数(0表示不拆分)
+        """
+        if self._size is not None:
+            return self._size
+
+        size = self.max_batch
+        fit = self._fit() if self.target_latency > 0 else None
+        if fit is not None:
+            overhead, per_document = fit
+            by_throughput = max(self.min_shard, int((self.target_latency - overhead) / per_document))
+            size = min(size, by_throughput) if size > 0 else by_throughput
+        self._size = size
+        return size
+
+    def plan(self, count: int) -> List[Tuple[int, int]]:
+        """
+        把 count 个文档均匀拆分为不超过分片大小的区间
+
+        Returns:
+            List[Tuple[int, int]]: 各分片的 [起始, 结束) 下标
+        """
+        size = self.shard_size()
+        if size <= 0 or count <= size:
+            return [(0, count)]
+        shards = math.ceil(count / size)
+        bounds = [round(i * count / shards) for i in range(shards + 1)]
+        self.sharded += 1
+        self.shards += shards
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回分片统计信息"""
+        fit = self._fit()
+        return {
+            "shard_size": self.shard_size(),
+            "overhead_ms": round(fit[0] * 1000, 1) if fit else None,
+            "per_document_ms": round(fit[1] * 1000, 3) if fit else None,
+            "sharded_requests": self.sharded,
+            "shards": self.shards
+        }
+
+
+def merge_top_n(
+    shard_scores: List[Dict[int, float]],
+    offsets: List[int],
+    top_n: Optional[int]
+) -> Dict[int, float]:
+    """
+    按分数k路归并各分片的结果
+
+    Args:
+        shard_scores: 各分片的文档下标到分数的映射(下标相对于分片)
+        offsets: 各分片在原文档列表中的起始下标
+        top_n: 返回的结果数量,为None时返回全部
+
+    Returns:
+        Dict[int, float]: 原文档下标到分数的映射
+    """
+    def ranked(scores: Dict[int, float], offset: int) -> Iterator[Tuple[float, int]]:
+        return ((-score, offset + index) for index, score in sorted(scores.items(), key=lambda item: -item[1]))
+
+    merged = heapq.merge(*(ranked(scores, offset) for scores, offset in zip(shard_scores, offsets)))
+    if top_n is not None:
+        merged = itertools.islice(merged, top_n)
+    return {index: -negative for negative, index in merged}
+
+
+registry.callback(
+    "rerank_shard_size",
+    "Current rerank shard size (0 = unlimited)",
+    ["reranker"],
+    lambda: {(name,): sizer.shard_size() for name, sizer in sizers.items()}
+)
+registry.callback(
+    "rerank_sharded_requests_total",
+    "Rerank requests split into concurrent shards",
+    ["reranker"],
+    lambda: {(name,): sizer.sharded for name, sizer in sizers.items()},
+    type="counter"
+)
@@ -0,0 +1,268 @@
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import time
+
+from models import (
+    QueryRequest, RetrievalResponse, LLMDecision, DatasetRetrievalResult
+)
+from llm_service import llm_service
+from dify_client import dify_client, failure_reason, incomplete_datasets, is_answered, SegmentMerger
+from rerank_service import rerank_service
+from speculative_retrieval import speculative_retriever
+from metrics import stage_duration
+from deadline import Deadline, MIN_TIMEOUT
+from config import settings
+
+
+# 流水线事件类型
+EVENT_QUERY = "query"          # 流式判断时每生成一个检索查询
+EVENT_DECISION = "decision"    # LLM判断结果
+EVENT_DATASET = "dataset"      # 单个检索查询的Dify原始结果
+EVENT_RESULT = "result"        # 最终的检索响应
+
+PipelineEvent = Tuple[str, Any]
+
+
+def _dify_budget(deadline: Optional[Deadline]) -> Optional[float]:
+    """Dify检索阶段的时间预算: 取配置的时间预算与延迟预算分配值中较小者"""
+    if deadline is None:
+        return None
+    budget = max(MIN_TIMEOUT, deadline.remaining() * settings.deadline_dify_share)
+    if settings.dify_soft_deadline > 0:
+        budget = min(budget, settings.dify_soft_deadline)
+    return budget
+
+
+async def run_pipeline(
+    request: QueryRequest,
+    timings: Dict[str, float],
+    timeout: Optional[float] = None
+) -> AsyncIterator[PipelineEvent]:
+    """
+    执行检索流水线,在各阶段完成时产出事件
+
+    工作流程:
+    1. LLM判断是否需要检索以及生成检索查询
+    2. 如果不需要检索,直接返回
+    3. 如果需要检索,并行调用Dify知识库检索,每个查询完成时产出原始结果
+       (满足法定数量或超出时间预算时不再等待其余知识库)
+    4. 按完成顺序增量去重,每积累一批片段即发送Reranker
+    5. 合并各批次的重排序结果
+    6. 产出最终结果(最后一个事件总是 EVENT_RESULT)
+
+    指定延迟预算时按比例分给各阶段: 超时的LLM判断使用默认判断,
+    超时的知识库被跳过,剩余时间不足时跳过重排序并按Dify分数返回。
+
+    Args:
+        request: 检索请求
+        timings: 用于记录各阶段耗时(秒)
+        timeout: 延迟预算(秒,来自请求头),请求体中的 timeout 优先
+
+    Yields:
+        PipelineEvent: (事件类型, 数据)
+    """
+    start_time = time.perf_counter()
+    reranker = None
+
+    # 整体延迟预算
+    budget = request.timeout or timeout or settings.default_request_timeout
+    deadline = Deadline(budget) if budget and budget > 0 else None
+
+    # 推测检索: 在LLM判断的同时用原始问题检索所有知识库
+    use_speculative = request.speculative_retrieval
+    if use_speculative is None:
+        use_speculative = settings.speculative_retrieval_enabled
+    # 判断结果已缓存时Step 1几乎零耗时,无需推测
+    if use_speculative and llm_service.has_cached_decision(request.question, request.datasets, request.document):
+        use_speculative = False
+    speculation = None
+    if use_speculative:
+        speculation = speculative_retriever.start(
+            question=request.question,
+            datasets=request.datasets,
+            api_key=request.dataset_api_key,
+            top_k=request.top_k,
+            score_threshold=request.score_threshold,
+            semantic_weight=request.semantic_weight,
+            deadline=deadline
+        )
+
+    # 流式判断: 每生成一个检索查询立即启动检索
+    use_streaming = request.stream_decision
+    if use_streaming is None:
+        use_streaming = settings.llm_streaming_enabled
+    tasks: List[asyncio.Task] = []
+
+    try:
+        # 第一步: LLM判断是否需要检索
+        step1_start = time.perf_counter()
+        llm_deadline = deadline.stage(settings.deadline_llm_share) if deadline is not None else None
+        if use_streaming:
+            llm_decision = None
+            async for item in llm_service.stream_decision(
+                question=request.question,
+                datasets=request.datasets,
+                document=request.document,
+                deadline=llm_deadline
+            ):
+                if isinstance(item, LLMDecision):
+                    llm_decision = item
+                    continue
+                tasks.append(speculative_retriever.start_task(
+                    speculation,
+                    item,
+                    api_key=request.dataset_api_key,
+                    top_k=request.top_k,
+                    score_threshold=request.score_threshold,
+                    semantic_weight=request.semantic_weight,
+                    deadline=deadline
+                ))
+                yield EVENT_QUERY, item
+            speculative_retriever.close(speculation)
+        else:
+            llm_decision = await llm_service.decide_retrieval(
+                question=request.question,
+                datasets=request.datasets,
+                document=request.document,
+                deadline=llm_deadline
+            )
+        timings["llm"] = time.perf_counter() - step1_start
+
+        yield EVENT_DECISION, llm_decision
+
+        # 如果不需要检索,直接返回
+        if not llm_decision.need_retrieval:
+            yield EVENT_RESULT, RetrievalResponse(
+                success=True,
+                need_retrieval=False,
+                retrieval_queries=[],
+                segments=[],
+                total_segments=0,
+                message="根据LLM判断,此问题不需要检索知识库"
+            )
+            return
+
+        # 如果没有生成检索查询,返回错误
+        if not llm_decision.retrieval_queries:
+            yield EVENT_RESULT, RetrievalResponse(
+                success=False,
+                need_retrieval=True,
+                retrieval_queries=[],
+                segments=[],
+                total_segments=0,
+                error="LLM判断需要检索,但未生成有效的检索查询"
+            )
+            return
+
+        # 第二步: 并行检索所有知识库
+        step2_start = time.perf_counter()
+        if not use_streaming:
+            tasks = speculative_retriever.start_tasks(
+                speculation,
+                llm_decision.retrieval_queries,
+                api_key=request.dataset_api_key,
+                top_k=request.top_k,
+                score_threshold=request.score_threshold,
+                semantic_weight=request.semantic_weight,
+                deadline=deadline
+            )
+
+        # 构建查询文本(合并原始问题和压缩后的文档)
+        rerank_query = rerank_service.build_query(request.question, request.document)
+
+        # 多查询重排序: 同时用LLM生成的各检索查询打分并融合
+        use_multi_query = request.multi_query_rerank
+        if use_multi_query is None:
+            use_multi_query = settings.multi_query_rerank_enabled
+        extra_queries = [query.query for query in llm_decision.retrieval_queries] if use_multi_query else []
+
+        # 按完成顺序增量去重,满一批即开始重排序,慢的知识库不阻塞已到达的结果
+        reranker = rerank_service.incremental(
+            rerank_query,
+            top_k=request.rerank_top_k,
+            deadline=deadline,
+            mode=request.rerank_mode,
+            extra_queries=extra_queries
+        )
+        merger = SegmentMerger()
+        queries = llm_decision.retrieval_queries
+        dataset_ids = [query.dataset_id for query in queries]
+        results: List[Any] = [None] * len(queries)
+        async for index, result in dify_client.iter_completed(
+            tasks,
+            dataset_ids=dataset_ids,
+            soft_deadline=_dify_budget(deadline)
+        ):
+            results[index] = result
+            reranker.add(merger.add(result))
+            yield EVENT_DATASET, DatasetRetrievalResult(
+                dataset_id=queries[index].dataset_id,
+                query=queries[index].query,
+                segments=result if isinstance(result, list) else [],
+                failed=not is_answered(result),
+                reason=failure_reason(result)
+            )
+
+        all_segments = merger.finish()
+        timings["dify"] = time.perf_counter() - step2_start
+
+        # 超出时间预算或已满足法定数量时未等待的知识库,以及检索失败的知识库
+        skipped_datasets = incomplete_datasets(dataset_ids, results)
+
+        # 如果没有检索到任何结果
+        if not all_segments:
+            yield EVENT_RESULT, RetrievalResponse(
+                success=True,
+                need_retrieval=True,
+                retrieval_queries=llm_decision.retrieval_queries,
+                segments=[],
+                total_segments=0,
+                skipped_datasets=skipped_datasets,
+                message="未检索到符合条件的文档片段"
+            )
+            return
+
+        # 第三步: 合并各批次的重排序结果(此处只统计最后一个知识库返回后的等待时间)
+        step3_start = time.perf_counter()
+        reranked_segments = await reranker.finish()
+        timings["rerank"] = time.perf_counter() - step3_start
+
+        # 计算总耗时
+        elapsed_time = time.perf_counter() - start_time
+        message = f"检索成功,返回{len(reranked_segments)}个相关文档片段 (耗时{elapsed_time:.2f}秒)"
+        if skipped_datasets:
+            message += f",跳过{len(skipped_datasets)}个未及时返回或检索失败的知识库"
+
+        # 返回最终结果
+        yield EVENT_RESULT, RetrievalResponse(
+            success=True,
+            need_retrieval=True,
+            retrieval_queries=llm_decision.retrieval_queries,
+            segments=reranked_segments,
+            total_segments=len(reranked_segments),
+            skipped_datasets=skipped_datasets,
+            message=message
+        )
+
+    except Exception as e:
+        print(f"[错误] 检索异常: {str(e)}")
+
+        yield EVENT_RESULT, RetrievalResponse(
+            success=False,
+            need_retrieval=True,
+            retrieval_queries=[],
+            segments=[],
+            total_segments=0,
+            error=f"检索异常: {str(e)}"
+        )
+    finally:
+        timings["total"] = time.perf_counter() - start_time
+        for stage, elapsed in timings.items():
+            stage_duration.observe(elapsed, stage)
+        # 丢弃未被复用的推测检索和已启动的检索(不需要检索、异常或客户端断开时)
+        speculative_retriever.close(speculation)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        if reranker is not None:
+            reranker.cancel()
@@ -0,0 +1,104 @@
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+import asyncio
+from metrics import registry
+
+T = TypeVar("T")
+
+
+# 所有已创建的合并器,用于统计接口
+singleflights: Dict[str, "SingleFlight"] = {}
+
+
+class _Call:
+    """一次进行中的上游调用"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    合并相同的并发上游调用
+
+    同一个键同时只有一个调用在执行,其余调用方共享其结果。
+    某个调用方被取消(如客户端断开)时只会停止自身的等待,
+    只有当所有调用方都已取消时才取消底层调用。
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        """
+        Args:
+            name: 合并器名称
+            enabled: 是否启用合并,关闭时每次调用都直接执行
+        """
+        self.name = name
+        self.enabled = enabled
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.coalesced = 0
+        singleflights[name] = self
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        执行调用,若相同键的调用正在进行则等待其结果
+
+        Args:
+            key: 调用键,相同输入应生成相同的键
+            factory: 创建实际调用的函数
+
+        Returns:
+            T: 调用结果(多个调用方共享同一对象,可变结果需由调用方复制)
+        """
+        self.calls += 1
+        if not self.enabled:
+            return await factory()
+
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # 最后一个调用方放弃等待时取消底层调用
+            if call.waiters == 1 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, key: Hashable, call: _Call):
+        """移除已结束或已取消的调用"""
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回合并统计信息"""
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls)
+        }
+
+
+registry.callback(
+    "singleflight_calls_total",
+    "Upstream calls requested through single-flight",
+    ["upstream"],
+    lambda: {(name,): flight.calls for name, flight in singleflights.items()},
+    type="counter"
+)
+registry.callback(
+    "singleflight_coalesced_total",
+    "Calls that joined an identical in-flight upstream call",
+    ["upstream"],
+    lambda: {(name,): flight.coalesced for name, flight in singleflights.items()},
+    type="counter"
+)
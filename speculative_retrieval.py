@@ -0,0 +1,250 @@
+from typing import List, Dict, Tuple, Optional, Any
+import asyncio
+import time
+from models import DatasetInfo, DocumentSegment, RetrievalQuery
+from dify_client import dify_client
+from deadline import Deadline
+from metrics import registry
+
+
+def _query_key(dataset_id: str, query: str) -> Tuple[str, str]:
+    """生成用于匹配推测检索的键(忽略空白和大小写差异)"""
+    return dataset_id, " ".join(query.split()).casefold()
+
+
+class SpeculativeRetrieval:
+    """单次请求的推测检索句柄"""
+
+    def __init__(self, tasks: Dict[Tuple[str, str], asyncio.Task]):
+        self.tasks = tasks
+        self.started_at = time.time()
+        # 记录每个推测任务完成所耗时间
+        self.durations: Dict[Tuple[str, str], float] = {}
+        # 记录每个被复用任务被认领时已经过的时间
+        self.claimed: Dict[Tuple[str, str], float] = {}
+        self.closed = False
+
+
+class SpeculativeRetriever:
+    """
+    推测检索
+
+    在LLM判断的同时,使用原始问题并行检索所有知识库。
+    LLM生成的查询与原始问题一致时直接复用结果,否则丢弃。
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.launched = 0
+        self.reused = 0
+        self.wasted = 0
+        self.saved_seconds = 0.0
+
+    def start(
+        self,
+        question: str,
+        datasets: List[DatasetInfo],
+        api_key: str,
+        top_k: int = 10,
+        score_threshold: float = 0.4,
+        semantic_weight: float = 0.7,
+        deadline: Optional[Deadline] = None
+    ) -> SpeculativeRetrieval:
+        """
+        使用原始问题对所有知识库发起推测检索
+
+        Args:
+            question: 用户原始问题
+            datasets: 知识库列表
+            api_key: API密钥
+            top_k: 每个知识库返回的结果数量
+            score_threshold: 分数阈值
+            semantic_weight: 语义检索权重
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            SpeculativeRetrieval: 推测检索句柄
+        """
+        tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+        handle = SpeculativeRetrieval(tasks)
+
+        for ds in datasets:
+            key = _query_key(ds.dataset_id, question)
+            if key in tasks:
+                continue
+            tasks[key] = asyncio.create_task(self._timed_retrieve(
+                handle,
+                key,
+                dify_client.retrieve_from_dataset(
+                    dataset_id=ds.dataset_id,
+                    query=question,
+                    api_key=api_key,
+                    top_k=top_k,
+                    score_threshold=score_threshold,
+                    semantic_weight=semantic_weight,
+                    deadline=deadline
+                )
+            ))
+
+        self.requests += 1
+        self.launched += len(tasks)
+        return handle
+
+    async def _timed_retrieve(self, handle: SpeculativeRetrieval, key: Tuple[str, str], coro) -> List[DocumentSegment]:
+        """执行检索并记录耗时"""
+        result = await coro
+        handle.durations[key] = time.time() - handle.started_at
+        return result
+
+    def claim(self, handle: Optional[SpeculativeRetrieval], query: RetrievalQuery) -> Optional[asyncio.Task]:
+        """
+        认领与LLM查询匹配的推测检索任务
+
+        Args:
+            handle: 推测检索句柄
+            query: LLM生成的检索查询
+
+        Returns:
+            Optional[asyncio.Task]: 匹配的推测任务,不匹配或已被认领时返回None
+        """
+        if handle is None or handle.closed:
+            return None
+        key = _query_key(query.dataset_id, query.query)
+        task = handle.tasks.get(key)
+        if task is None or key in handle.claimed:
+            return None
+        handle.claimed[key] = time.time() - handle.started_at
+        return task
+
+    def start_task(
+        self,
+        handle: Optional[SpeculativeRetrieval],
+        query: RetrievalQuery,
+        api_key: str,
+        top_k: int = 10,
+        score_threshold: float = 0.4,
+        semantic_weight: float = 0.7,
+        deadline: Optional[Deadline] = None
+    ) -> asyncio.Task:
+        """
+        为单个LLM生成的查询启动检索任务,匹配的推测任务直接复用
+
+        Args:
+            handle: 推测检索句柄(可选)
+            query: LLM生成的检索查询
+            api_key: API密钥
+            top_k: 每个知识库返回的结果数量
+            score_threshold: 分数阈值
+            semantic_weight: 语义检索权重
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            asyncio.Task: 检索任务
+        """
+        task = self.claim(handle, query)
+        if task is None:
+            task = asyncio.create_task(dify_client.retrieve_from_dataset(
+                dataset_id=query.dataset_id,
+                query=query.query,
+                api_key=api_key,
+                top_k=top_k,
+                score_threshold=score_threshold,
+                semantic_weight=semantic_weight,
+                deadline=deadline
+            ))
+        return task
+
+    def start_tasks(
+        self,
+        handle: Optional[SpeculativeRetrieval],
+        retrieval_queries: List[RetrievalQuery],
+        api_key: str,
+        top_k: int = 10,
+        score_threshold: float = 0.4,
+        semantic_weight: float = 0.7,
+        deadline: Optional[Deadline] = None
+    ) -> List[asyncio.Task]:
+        """
+        为LLM生成的查询启动检索任务,复用匹配的推测结果并丢弃其余推测任务
+
+        Args:
+            handle: 推测检索句柄(可选)
+            retrieval_queries: LLM生成的检索查询列表
+            api_key: API密钥
+            top_k: 每个知识库返回的结果数量
+            score_threshold: 分数阈值
+            semantic_weight: 语义检索权重
+            deadline: 请求截止时间(可选)
+
+        Returns:
+            List[asyncio.Task]: 与查询一一对应的检索任务
+        """
+        tasks = [
+            self.start_task(handle, query, api_key, top_k, score_threshold, semantic_weight, deadline)
+            for query in retrieval_queries
+        ]
+
+        # 丢弃未被复用的推测任务
+        self.close(handle)
+        return tasks
+
+    def close(self, handle: Optional[SpeculativeRetrieval]):
+        """
+        结束推测检索: 取消未被认领的任务并记录统计(可重复调用)
+
+        Args:
+            handle: 推测检索句柄
+        """
+        if handle is None or handle.closed:
+            return
+        handle.closed = True
+
+        for key, task in handle.tasks.items():
+            if key in handle.claimed:
+                continue
+            if not task.done():
+                task.cancel()
+            self.wasted += 1
+
+        if handle.claimed:
+            self.reused += len(handle.claimed)
+            # 推测任务在被需要之前已执行的时间即为节省的延迟
+            saved = max(
+                min(elapsed, handle.durations.get(key, elapsed))
+                for key, elapsed in handle.claimed.items()
+            )
+            self.saved_seconds += saved
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回推测检索统计信息"""
+        return {
+            "requests": self.requests,
+            "launched": self.launched,
+            "reused": self.reused,
+            "wasted": self.wasted,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "avg_saved_seconds": round(self.saved_seconds / self.requests, 3) if self.requests else 0.0
+        }
+
+
+# 创建全局实例
+speculative_retriever = SpeculativeRetriever()
+
+registry.callback(
+    "speculative_retrieval_calls_total",
+    "Speculative Dify calls by outcome",
+    ["outcome"],
+    lambda: {
+        ("launched",): speculative_retriever.launched,
+        ("reused",): speculative_retriever.reused,
+        ("wasted",): speculative_retriever.wasted
+    },
+    type="counter"
+)
+registry.callback(
+    "speculative_retrieval_saved_seconds_total",
+    "Estimated latency saved by speculative retrieval",
+    [],
+    lambda: {(): speculative_retriever.saved_seconds},
+    type="counter"
+)
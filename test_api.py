@@ -1,5 +1,7 @@
 """
 测试脚本 - 用于测试 Dify 知识库检索增强 API
+
+本脚本按顺序发送单个请求,用于功能验证;性能压测请使用 load_test.py。
 """
 
 import asyncio
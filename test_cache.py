@@ -0,0 +1,28 @@
+"""
+缓存键归一化测试
+
+运行: python -m pytest -q test_cache.py
+"""
+
+import os
+
+# 配置中的必填项(测试不访问上游)
+for name in ("DIFY_API_KEY", "LLM_API_KEY", "RERANKER_API_URL", "RERANKER_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from cache import hash_text, normalize_text
+
+
+def test_width_case_whitespace_and_trailing_punctuation_are_folded():
+    assert normalize_text("  如何配置  ＡＰＩ　Key？ ") == normalize_text("如何配置 api key")
+    assert normalize_text("数据库连接池怎么配置。。。") == normalize_text("数据库连接池怎么配置")
+
+
+def test_symbols_inside_tokens_are_kept():
+    assert normalize_text("什么是C#") != normalize_text("什么是C")
+    assert normalize_text("C++入门") != normalize_text("C入门")
+    assert normalize_text("node.js 版本?") == "node.js 版本"
+
+
+def test_hash_text_accepts_lone_surrogates():
+    assert hash_text("问题\ud800") != hash_text("问题")
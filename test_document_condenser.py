@@ -0,0 +1,63 @@
+"""
+文档压缩测试
+
+运行: python -m pytest -q test_document_condenser.py
+"""
+
+import os
+
+# 配置中的必填项(测试不访问上游)
+for name in ("DIFY_API_KEY", "LLM_API_KEY", "RERANKER_API_URL", "RERANKER_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from document_condenser import document_condenser
+from rerank_service import rerank_service
+from token_budget import estimate_tokens
+
+# 没有标点的长段落: 每个200字的切分块都超出小预算
+UNPUNCTUATED = "数据管理模块支持批量操作和字段映射" * 40 + "权限设置在系统管理页面中配置" + "日志每天归档一次并保留三十天" * 40
+
+
+def test_condense_falls_back_to_window_when_no_sentence_fits():
+    condensed = document_condenser.condense(UNPUNCTUATED, "权限", 150)
+    assert condensed
+    assert "权限" in condensed
+    assert estimate_tokens(condensed) <= 150
+
+
+def test_rerank_query_keeps_document_for_long_question():
+    question = "请问" * 60 + "权限在哪里设置"
+    query = rerank_service.build_query(question, UNPUNCTUATED)
+    document, _, tail = query.rpartition("\n\n")
+    assert tail == question
+    assert "权限" in document
+
+
+def test_condense_keeps_relevant_sentence():
+    document = "公司年度销售额增长了百分之十二。" * 200 + "退货运费由买家承担。" + "员工满意度调查结果良好。" * 200
+    condensed = document_condenser.condense(document, "退货运费谁承担", 100)
+    assert "退货运费由买家承担" in condensed
+    assert estimate_tokens(condensed) <= 100
+
+
+def test_short_document_is_unchanged():
+    assert document_condenser.condense("短文档。", "问题", 100) == "短文档。"
+
+
+def test_condense_accepts_lone_surrogates():
+    # 上游截断的emoji会留下孤立的代理字符
+    document = "退货运费由买家承担\ud83d。" + "员工满意度调查结果良好。" * 200
+    condensed = document_condenser.condense(document, "退货运费\ude00", 60)
+    assert "退货运费由买家承担" in condensed
+    assert estimate_tokens(condensed) <= 60
+
+
+def test_condense_never_exceeds_small_budget():
+    assert document_condenser.condense(UNPUNCTUATED, "权限", 0) == ""
+    assert document_condenser.condense(UNPUNCTUATED, "权限", 8) == ""
+
+
+def test_rerank_query_drops_document_when_question_fills_budget():
+    question = "请问" * 130 + "权限在哪里设置"
+    assert estimate_tokens(question) >= rerank_service._budget.query_tokens
+    assert rerank_service.build_query(question, UNPUNCTUATED) == question
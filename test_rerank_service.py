@@ -0,0 +1,54 @@
+"""
+重排序测试(Reranker打分使用本地替身)
+
+运行: python -m pytest -q test_rerank_service.py
+"""
+
+import asyncio
+import os
+
+# 配置中的必填项(测试不访问上游)
+for name in ("DIFY_API_KEY", "LLM_API_KEY", "RERANKER_API_URL", "RERANKER_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from models import DocumentSegment
+from rerank_service import rerank_service
+
+
+def _segment(segment_id: str, score: float) -> DocumentSegment:
+    return DocumentSegment(
+        dataset_id="ds",
+        document_id="doc",
+        segment_id=segment_id,
+        content=f"片段{segment_id}",
+        score=score,
+        position=1
+    )
+
+
+def test_multi_query_scores_and_fuses_when_candidates_fit_top_k(monkeypatch):
+    # 两个查询都认为 c 最相关,Dify分数却最低
+    relevance = {"片段a": 0.1, "片段b": 0.2, "片段c": 0.9}
+    calls = []
+
+    async def score_documents(query, documents, top_n, deadline=None):
+        calls.append(query)
+        return {index: relevance[document] for index, document in enumerate(documents)}
+
+    monkeypatch.setattr(rerank_service, "_score_documents", score_documents)
+    segments = [_segment("a", 0.9), _segment("b", 0.8), _segment("c", 0.5)]
+    ranked = asyncio.run(rerank_service.rerank_with_multiple_queries(["查询1", "查询2"], segments, top_k=5))
+
+    assert sorted(calls) == ["查询1", "查询2"]
+    assert [seg.segment_id for seg in ranked] == ["c", "b", "a"]
+    assert ranked[0].score == 0.9
+
+
+def test_single_query_with_few_candidates_sorts_by_dify_score(monkeypatch):
+    async def score_documents(query, documents, top_n, deadline=None):
+        raise AssertionError("不应调用Reranker")
+
+    monkeypatch.setattr(rerank_service, "_score_documents", score_documents)
+    segments = [_segment("a", 0.5), _segment("b", 0.9)]
+    ranked = asyncio.run(rerank_service.rerank_segments("查询", segments, top_k=5))
+    assert [seg.segment_id for seg in ranked] == ["b", "a"]
@@ -0,0 +1,42 @@
+"""
+Reranker token预算测试
+
+运行: python -m pytest -q test_token_budget.py
+"""
+
+import os
+
+# 配置中的必填项(测试不访问上游)
+for name in ("DIFY_API_KEY", "LLM_API_KEY", "RERANKER_API_URL", "RERANKER_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from token_budget import MIN_DOCUMENT_TOKENS, TokenBudget, condense_query, estimate_tokens
+
+
+DOCUMENT = "数据管理模块支持批量操作和字段映射。" * 500
+
+
+def test_long_question_keeps_question_and_drops_document():
+    budget = TokenBudget("bge-reranker-v2-m3")
+    question = "请问" * 100 + "权限在哪里设置"
+    assert estimate_tokens(question) > budget.query_tokens - MIN_DOCUMENT_TOKENS
+
+    fitted = budget.fit_query(f"{DOCUMENT}\n\n{question}")
+    assert fitted == question
+    assert estimate_tokens(fitted) <= budget.query_tokens
+
+
+def test_question_over_budget_keeps_its_tail():
+    question = "请问" * 200 + "权限在哪里设置"
+    condensed = condense_query(f"{DOCUMENT}\n\n{question}", 64)
+    assert condensed.endswith("权限在哪里设置")
+    assert "数据管理" not in condensed
+    assert estimate_tokens(condensed) <= 64
+
+
+def test_short_question_keeps_relevant_context():
+    query = "数据管理" * 300 + "权限设置在系统管理页面中配置。" + "日志归档" * 300 + "\n\n权限在哪里设置"
+    condensed = condense_query(query, 128)
+    assert condensed.endswith("\n\n权限在哪里设置")
+    assert "权限设置" in condensed
+    assert estimate_tokens(condensed) <= 128
@@ -0,0 +1,247 @@
+from functools import lru_cache
+from typing import Dict, List
+import numpy as np
+from lexical_rerank import match_positions
+from metrics import registry
+
+
+# 各Reranker模型单个 (查询, 文档) 对的最大token数(超出部分会被模型截断,发送只会增加传输和计算)
+MODEL_MAX_TOKENS: Dict[str, int] = {
+    "bge-reranker-v2-m3": 1024,
+    "bge-reranker-v2-gemma": 1024,
+    "bge-reranker-large": 512,
+    "bge-reranker-base": 512,
+    "bce-reranker-base_v1": 512,
+    "jina-reranker-v2-base-multilingual": 1024,
+    "gte-multilingual-reranker-base": 1024,
+}
+DEFAULT_MAX_TOKENS = 512
+
+# token数估算: 中日韩字符约1个token/字,其他字符(拉丁字母、数字、空白等)约3.3字符/token,
+# 基本多文种平面以外的字符(emoji等)约2个token
+CJK_TOKENS_PER_CHAR = 1.0
+OTHER_TOKENS_PER_CHAR = 0.3
+SUPPLEMENTARY_TOKENS_PER_CHAR = 2.0
+# 中日韩标点、假名、汉字, 韩文音节, 兼容汉字, 全角字符
+_CJK_RANGES = ((0x3000, 0x9FFF), (0xAC00, 0xD7AF), (0xF900, 0xFAFF), (0xFF00, 0xFFEF))
+
+# [CLS]、[SEP] 等特殊token
+SPECIAL_TOKENS = 4
+# 每个文档至少保留的token数
+MIN_DOCUMENT_TOKENS = 64
+
+
+rerank_truncated_total = registry.counter(
+    "rerank_truncated_total",
+    "Rerank queries and documents truncated to the reranker token budget",
+    ["kind"]
+)
+rerank_truncated_tokens_total = registry.counter(
+    "rerank_truncated_tokens_total",
+    "Estimated tokens removed from rerank queries and documents",
+    ["kind"]
+)
+
+
+def token_weights(text: str) -> np.ndarray:
+    """
+    估算每个字符的token数
+
+    Args:
+        text: 文本
+
+    Returns:
+        np.ndarray: 与字符一一对应的token数估算
+    """
+    # 保留孤立的代理字符(如截断的emoji),使结果仍与字符一一对应
+    codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    cjk = np.zeros(len(codes), dtype=bool)
+    for low, high in _CJK_RANGES:
+        cjk |= (codes >= low) & (codes <= high)
+    weights = np.where(cjk, CJK_TOKENS_PER_CHAR, OTHER_TOKENS_PER_CHAR)
+    weights[codes > 0xFFFF] = SUPPLEMENTARY_TOKENS_PER_CHAR
+    return weights
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数"""
+    return int(np.ceil(token_weights(text).sum()))
+
+
+def estimate_tokens_many(texts: List[str]) -> np.ndarray:
+    """
+    一次性估算多个文本的token数(以换行拼接,换行计入前一个文本,略微高估)
+
+    Args:
+        texts: 文本列表
+
+    Returns:
+        np.ndarray: 每个文本的token数估算
+    """
+    weights = token_weights("\n".join(texts))
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)) + 1
+    owners = np.repeat(np.arange(len(texts)), lengths)[:len(weights)]
+    return np.bincount(owners, weights=weights, minlength=len(texts))
+
+
+def _prefix(text: str) -> np.ndarray:
+    """token数的前缀和: prefix[i] 为 text[:i] 的token数"""
+    return np.concatenate([[0.0], np.cumsum(token_weights(text))])
+
+
+def _end(prefix: np.ndarray, start: int, max_tokens: float) -> int:
+    """从 start 开始不超过 max_tokens 的最远结束位置"""
+    return int(np.searchsorted(prefix, prefix[start] + max_tokens, side="right")) - 1
+
+
+def window(query: str, text: str, max_tokens: int) -> str:
+    """
+    截取文本中与查询最相关的一段,使其不超过 max_tokens
+
+    以每个命中查询词的位置为起点计算窗口覆盖的查询词权重,取覆盖最多的窗口,
+    再把窗口向前移动使命中区间两侧的上下文大致相等;没有命中时保留开头。
+
+    Args:
+        query: 查询文本
+        text: 待截取的文本
+        max_tokens: 最大token数
+
+    Returns:
+        str: 截取后的文本(未超出时原样返回)
+    """
+    prefix = _prefix(text)
+    if prefix[-1] <= max_tokens:
+        return text
+
+    positions, weights = match_positions(query, text)
+    if len(positions) == 0:
+        return text[:_end(prefix, 0, max_tokens)]
+
+    density = np.bincount(positions, weights=weights, minlength=len(text))
+    hits = np.concatenate([[0.0], np.cumsum(density)])
+    starts = np.flatnonzero(density)
+    ends = np.searchsorted(prefix, prefix[starts] + max_tokens, side="right") - 1
+    best = int(np.argmax(hits[ends] - hits[starts]))
+    start, end = int(starts[best]), int(ends[best])
+
+    # 剩余的token一半留给命中区间之前的上下文
+    inside = positions[(positions >= start) & (positions < end)]
+    slack = prefix[end] - prefix[int(inside.max()) + 1]
+    start = int(np.searchsorted(prefix, prefix[start] - slack / 2, side="left"))
+    end = _end(prefix, start, max_tokens)
+    if end == len(text):
+        start = int(np.searchsorted(prefix, prefix[end] - max_tokens, side="left"))
+    return text[start:end]
+
+
+def condense_query(query: str, max_tokens: int) -> str:
+    """
+    压缩过长的查询
+
+    查询通常为 "文档\\n\\n问题":完整保留最后一段(问题),前文按问题截取最相关的一段;
+    剩余预算不足 MIN_DOCUMENT_TOKENS 时丢弃前文只保留问题,问题本身超出预算时保留其结尾(提问通常在最后)。
+
+    Args:
+        query: 查询文本
+        max_tokens: 最大token数
+
+    Returns:
+        str: 压缩后的查询(未超出时原样返回)
+    """
+    if estimate_tokens(query) <= max_tokens:
+        return query
+
+    context, separator, question = query.rpartition("\n\n")
+    remaining = max_tokens - estimate_tokens(question) - 1
+    if not separator or remaining < MIN_DOCUMENT_TOKENS:
+        prefix = _prefix(question)
+        start = int(np.searchsorted(prefix, prefix[-1] - max_tokens, side="left"))
+        return question[start:]
+    return f"{window(question, context, remaining)}\n\n{question}"
+
+
+def parse_model_limits(value: str) -> Dict[str, int]:
+    """
+    解析按模型配置的最大token数
+
+    Args:
+        value: 逗号分隔的 "模型=token数",不带模型名的数值作用于所有模型(键为空字符串)
+
+    Returns:
+        Dict[str, int]: 模型名(小写)到最大token数的映射
+    """
+    limits: Dict[str, int] = {}
+    for item in value.split(","):
+        model, _, tokens = item.strip().rpartition("=")
+        if tokens.strip():
+            limits[model.strip().lower()] = int(tokens)
+    return limits
+
+
+class TokenBudget:
+    """
+    Reranker的token预算
+
+    每个 (查询, 文档) 对不超过模型的最大token数: 查询最多占 query_share,
+    文档使用剩余的预算,超出时截取与查询最相关的一段。
+    """
+
+    def __init__(self, model: str, overrides: str = "", query_share: float = 0.25, enabled: bool = True):
+        """
+        Args:
+            model: Reranker模型名(可带 "组织/" 前缀)
+            overrides: 按模型覆盖内置最大token数,格式见 parse_model_limits
+            query_share: 查询最多占用的比例
+            enabled: 是否启用截断
+        """
+        limits = parse_model_limits(overrides)
+        name = model.lower()
+        short_name = name.rsplit("/", 1)[-1]
+        self.max_tokens = limits.get(
+            name,
+            limits.get(short_name, limits.get("", MODEL_MAX_TOKENS.get(short_name, DEFAULT_MAX_TOKENS)))
+        )
+        self.query_tokens = int(self.max_tokens * query_share)
+        self.enabled = enabled and self.max_tokens > 0
+        # 增量重排序的每个批次都使用同一查询,缓存压缩结果
+        self.fit_query = lru_cache(maxsize=256)(self._fit_query)
+
+    def _fit_query(self, query: str) -> str:
+        """压缩超出查询预算的查询"""
+        if not self.enabled:
+            return query
+        condensed = condense_query(query, self.query_tokens)
+        if condensed is not query:
+            rerank_truncated_total.inc("query")
+            rerank_truncated_tokens_total.inc("query", amount=estimate_tokens(query) - estimate_tokens(condensed))
+        return condensed
+
+    def fit_documents(self, query: str, documents: List[str]) -> List[str]:
+        """
+        截断超出预算的文档
+
+        Args:
+            query: (已压缩的)查询
+            documents: 文档内容列表
+
+        Returns:
+            List[str]: 截断后的文档列表(未超出的文档原样保留)
+        """
+        if not self.enabled or not documents:
+            return documents
+
+        budget = max(MIN_DOCUMENT_TOKENS, self.max_tokens - estimate_tokens(query) - SPECIAL_TOKENS)
+        tokens = estimate_tokens_many(documents)
+
+        over = np.flatnonzero(tokens > budget)
+        if len(over) == 0:
+            return documents
+        fitted = list(documents)
+        for index in over:
+            fitted[index] = window(query, documents[index], budget)
+        rerank_truncated_total.inc("document", amount=len(over))
+        rerank_truncated_tokens_total.inc(
+            "document",
+            amount=float(tokens[over].sum()) - sum(estimate_tokens(fitted[index]) for index in over)
+        )
+        return fitted